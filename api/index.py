@@ -2,8 +2,12 @@
 
 import os
 import sys
+import time
 import logging
 
+# Marca de arranque: mide el cold start (import de la app) en cada instancia
+_T0 = time.perf_counter()
+
 # === Config de paths ===
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))        # .../api
 ROOT_DIR = os.path.abspath(os.path.join(BASE_DIR, ".."))     # proyecto
@@ -12,9 +16,10 @@ SRC_DIR  = os.path.join(ROOT_DIR, "src")                     # .../src
 if SRC_DIR not in sys.path:
     sys.path.insert(0, SRC_DIR)
 
-# === Logging verboso para ver errores en Vercel ===
+# === Logging: INFO por defecto; LOG_LEVEL=DEBUG para depurar en Vercel ===
+# (DEBUG agrega overhead por request, por eso no es el default)
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=getattr(logging, os.environ.get("LOG_LEVEL", "INFO").upper(), logging.INFO),
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
 )
 log = logging.getLogger("api.index")
@@ -24,7 +29,10 @@ try:
     from app import app  # ← tu archivo src/app.py debe definir `app = Flask(__name__, ...)`
     # Modo debug para que los stacktraces aparezcan en Logs de Vercel
     app.config.setdefault("DEBUG", True)
-    log.info("Flask app importada correctamente desde src/app.py")
+    # Métrica de cold start, expuesta en /health
+    app.config["COLD_START_MS"] = round((time.perf_counter() - _T0) * 1000, 1)
+    log.info("Flask app importada correctamente desde src/app.py (cold start %.1f ms)",
+             app.config["COLD_START_MS"])
 
 except Exception as e:
     # Fallback: si falló el import, exponemos una mini app para ver el error
@@ -45,4 +53,26 @@ except Exception as e:
 
     @app.get("/health")
     def _fallback_health():
-        return {"ok": False, "reason": "import_failed"}, 500
\ No newline at end of file
+        return {"ok": False, "reason": "import_failed"}, 500
+
+if __name__ == "__main__":
+    # Reporte de cold start: python api/index.py [top_n]
+    # Corre `python -X importtime -c "import index"` en un proceso limpio y
+    # lista los módulos con más tiempo acumulado de import.
+    import subprocess
+
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import index"],
+                          cwd=BASE_DIR, capture_output=True, text=True)
+    filas = []
+    for linea in proc.stderr.splitlines():
+        if not linea.startswith("import time:") or "cumulative" in linea:
+            continue
+        propio, acumulado, modulo = linea[len("import time:"):].split("|", 2)
+        filas.append((int(acumulado), int(propio), modulo))
+    # los de primer nivel (sin sangría extra) suman el total
+    total = sum(f[0] for f in filas if not f[2][1:].startswith(" "))
+    print(f"import index: {total / 1000:.1f} ms acumulados ({len(filas)} módulos)")
+    print(f"{'acum. ms':>9} {'propio ms':>9}  módulo")
+    for acumulado, propio, modulo in sorted(filas, reverse=True)[:top]:
+        print(f"{acumulado / 1000:9.1f} {propio / 1000:9.1f}  {modulo.rstrip()}")
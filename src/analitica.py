@@ -0,0 +1,175 @@
+# analitica.py
+"""
+Rollups de tickets mantenidos en forma incremental.
+
+ticket_stats guarda, para cada dimensión (total, prioridad, tipo,
+tecnico_id, barrio), cuántos tickets hay por valor, día de alta y estado
+actual. Además de las filas por día hay una fila de "todo el período"
+(dia = ''), así "abiertos por barrio" es una lectura directa.
+
+Las rutas que crean o modifican tickets llaman a sumar()/mover() dentro
+de su transacción. El barrio sale del cliente, así que las rutas que
+cambian el barrio de un cliente (o lo borran) llaman a mover_barrio().
+reconstruir() recalcula todo desde asistencias (también:
+python analitica.py --rebuild [ruta_db]).
+"""
+import sys
+import sqlite3
+
+DIMENSIONES = ("total", "prioridad", "tipo", "tecnico_id", "barrio")
+ABIERTOS = ("pendiente", "en_progreso")
+
+
+_SQL_FILA = """
+    SELECT a.id, a.estado, a.prioridad, a.tipo, a.tecnico_id, c.barrio,
+           substr(a.fecha, 1, 10) AS dia, a.cliente_id
+      FROM asistencias a
+      LEFT JOIN clientes c ON c.id = a.cliente_id
+"""
+
+
+def _fila(r):
+    return {
+        "estado": r[1] or "pendiente",
+        "total": "",
+        "prioridad": r[2] or "",
+        "tipo": r[3] or "",
+        "tecnico_id": "" if r[4] is None else str(r[4]),
+        "barrio": r[5] or "",
+        "dia": r[6] or "",
+    }
+
+
+def fila_ticket(conn, tid):
+    """Valores del ticket que alimentan los rollups (None si no existe)."""
+    r = conn.execute(_SQL_FILA + " WHERE a.id = ?", (tid,)).fetchone()
+    return _fila(r) if r else None
+
+
+def filas_tickets(conn, ids):
+    """fila_ticket() de varios tickets en una consulta: {id: fila}."""
+    ids = list(ids)
+    filas = {}
+    for i in range(0, len(ids), 500):
+        parte = ids[i:i + 500]
+        for r in conn.execute(_SQL_FILA + f" WHERE a.id IN ({', '.join('?' * len(parte))})", parte):
+            filas[r[0]] = _fila(r)
+    return filas
+
+
+def _deltas(fila, signo, acum):
+    for dim in DIMENSIONES:
+        for dia in {fila["dia"], ""}:
+            clave = (dim, fila[dim], dia, fila["estado"])
+            acum[clave] = acum.get(clave, 0) + signo
+    return acum
+
+
+def _escribir(conn, deltas):
+    conn.executemany("""
+        INSERT INTO ticket_stats (dimension, valor, dia, estado, n) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(dimension, valor, dia, estado) DO UPDATE SET n = n + excluded.n
+    """, [clave + (n,) for clave, n in deltas.items() if n])
+
+
+def _aplicar(conn, fila, signo):
+    _escribir(conn, _deltas(fila, signo, {}))
+
+
+def sumar(conn, tid):
+    """Alta de ticket: +1 en cada dimensión."""
+    fila = fila_ticket(conn, tid)
+    if fila:
+        _aplicar(conn, fila, 1)
+
+
+def mover(conn, antes, despues):
+    """Cambio de estado/técnico/etc.: resta la foto vieja y suma la nueva."""
+    if antes == despues:
+        return
+    if antes:
+        _aplicar(conn, antes, -1)
+    if despues:
+        _aplicar(conn, despues, 1)
+
+
+def mover_barrio(conn, barrios_previos):
+    """
+    Clientes que cambiaron de barrio o se borraron ({cliente_id: barrio
+    anterior}); se llama después del UPDATE/DELETE. Pasa los tickets de
+    esos clientes del barrio viejo al actual en los rollups.
+    """
+    previos = {cid: b or "" for cid, b in barrios_previos.items()}
+    cids = list(previos)
+    deltas = {}
+    for i in range(0, len(cids), 500):
+        parte = cids[i:i + 500]
+        for r in conn.execute(_SQL_FILA + f" WHERE a.cliente_id IN ({', '.join('?' * len(parte))})", parte):
+            fila = _fila(r)
+            antes = dict(fila, barrio=previos[r[7]])
+            if antes != fila:
+                _deltas(antes, -1, deltas)
+                _deltas(fila, 1, deltas)
+    _escribir(conn, deltas)
+
+
+def reconstruir(conn):
+    """Recalcula ticket_stats desde cero (por si hubo escrituras por fuera de la app)."""
+    conn.execute("DELETE FROM ticket_stats")
+    expr = {
+        "total": "''",
+        "prioridad": "IFNULL(a.prioridad,'')",
+        "tipo": "IFNULL(a.tipo,'')",
+        "tecnico_id": "IFNULL(CAST(a.tecnico_id AS TEXT),'')",
+        "barrio": "IFNULL(c.barrio,'')",
+    }
+    for dim, valor in expr.items():
+        for dia, filtro in (("substr(a.fecha, 1, 10)", "IFNULL(a.fecha,'') <> ''"), ("''", "1")):
+            conn.execute(f"""
+                INSERT INTO ticket_stats (dimension, valor, dia, estado, n)
+                SELECT '{dim}', {valor}, {dia}, IFNULL(NULLIF(a.estado,''),'pendiente'), COUNT(*)
+                  FROM asistencias a
+                  LEFT JOIN clientes c ON c.id = a.cliente_id
+                 WHERE {filtro}
+                 GROUP BY 2, 3, 4
+            """)
+
+
+def consultar(conn, dimension, desde=None, hasta=None, estado=None, por_semana=False):
+    """
+    Conteos por valor (y estado) de una dimensión. Sin rango usa las filas de
+    todo el período; con rango suma las filas diarias (no toca asistencias).
+    """
+    if dimension not in DIMENSIONES:
+        raise ValueError(f"dimensión inválida: {dimension}")
+    periodo = "strftime('%Y-%W', dia)" if por_semana else "NULL"
+    sql = f"SELECT valor, estado, {periodo} AS periodo, SUM(n) AS n FROM ticket_stats WHERE dimension = ?"
+    params = [dimension]
+    if desde or hasta or por_semana:
+        sql += " AND dia <> '' AND dia BETWEEN ? AND ?"
+        params += [desde or "0000-00-00", hasta or "9999-99-99"]
+    else:
+        sql += " AND dia = ''"
+    if estado == "abiertos":
+        sql += f" AND estado IN ({', '.join('?' * len(ABIERTOS))})"
+        params += list(ABIERTOS)
+    elif estado:
+        sql += " AND estado = ?"
+        params.append(estado)
+    sql += " GROUP BY valor, estado, periodo HAVING SUM(n) <> 0 ORDER BY periodo, valor, estado"
+    return [{"valor": r[0], "estado": r[1], "periodo": r[2], "n": r[3]}
+            for r in conn.execute(sql, params).fetchall()]
+
+
+if __name__ == "__main__":
+    if "--rebuild" not in sys.argv:
+        print("Uso: python analitica.py --rebuild [ruta_db]")
+        sys.exit(1)
+    args = [a for a in sys.argv[1:] if a != "--rebuild"]
+    conn = sqlite3.connect(args[0] if args else "/tmp/asistencias.db")
+    from migraciones import migrar
+    migrar(conn)
+    reconstruir(conn)
+    conn.commit()
+    print(f"✅ ticket_stats reconstruida ({conn.execute('SELECT COUNT(*) FROM ticket_stats').fetchone()[0]} filas).")
+    conn.close()
@@ -1,21 +1,21 @@
 # app.py
 from flask import (
     Flask, render_template, request, redirect, jsonify, url_for,
-    send_file, session, flash
+    send_file, session, flash, has_request_context
 )
 import sqlite3
 import io
-import csv
 import re
 import os
+import csv
 import unicodedata
-from docx import Document
-from fpdf import FPDF
-from werkzeug.utils import secure_filename
 from datetime import datetime, date, timedelta
-from unicodedata import normalize
-from werkzeug.security import generate_password_hash, check_password_hash
-from app import app
+from cache import cache, cache_vista, tocar, stats as cache_stats_todos
+import analitica
+
+# Dependencias pesadas (python-docx, fpdf, werkzeug.security) se importan
+# dentro de las rutas que las usan: así el cold start en Vercel no las paga.
+# Los módulos de la stdlib (csv incluido) van arriba: su import es barato.
 
 # ===========================
 #  Configuración base
@@ -30,6 +30,22 @@ UPLOAD_FOLDER = "/tmp/uploads"
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024   # fotos de celular, con margen
+HISTORIAL_POR_PAGINA = 10
+# Dispositivos viejos que mandan solo tecnico_id (sin token); apagar cuando migren
+GPS_PERMITIR_SIN_TOKEN = os.environ.get("GPS_PERMITIR_SIN_TOKEN", "0") == "1"
+DB_PATH = os.path.join("/tmp", "asistencias.db")
+# Jobs programados (cron de Vercel): mandan "Authorization: Bearer <CRON_SECRET>"
+CRON_SECRET = os.environ.get("CRON_SECRET")
+
+# Snapshots de la BD (opcional): SNAPSHOT_DIR activa el almacén local
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR")
+SNAPSHOT_CADA_CAMBIOS = int(os.environ.get("SNAPSHOT_CADA_CAMBIOS", "30"))    # segundos
+SNAPSHOT_CADA_COMPLETO = int(os.environ.get("SNAPSHOT_CADA_COMPLETO", "3600"))
+
+# Cache de páginas/JSON de lectura (ver cache.py)
+cache.ttl = int(os.environ.get("CACHE_TTL", "30"))            # segundos
+cache.max_items = int(os.environ.get("CACHE_MAX_ITEMS", "256"))
 
 # ===========================
 #  Utilidades
@@ -37,12 +53,36 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+_ESQUEMA_OK = False
+_REPLICADOR = None
+
+def get_replicador():
+    global _REPLICADOR
+    if _REPLICADOR is None and SNAPSHOT_DIR:
+        from snapshots import Replicador, AlmacenDirectorio
+        _REPLICADOR = Replicador(DB_PATH, AlmacenDirectorio(SNAPSHOT_DIR))
+    return _REPLICADOR
+
 def get_db():
+    global _ESQUEMA_OK
     # BD en /tmp para que sea escribible en serverless
-    db_path = os.path.join("/tmp", "asistencias.db")
     os.makedirs("/tmp", exist_ok=True)
-    conn = sqlite3.connect(db_path)
+    if not _ESQUEMA_OK and not os.path.exists(DB_PATH) and get_replicador():
+        # Instancia nueva: arrancamos desde el último snapshot publicado
+        try:
+            get_replicador().restaurar()
+        except Exception:
+            app.logger.exception("No se pudo restaurar el snapshot de la BD")
+    conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
+    if not _ESQUEMA_OK:
+        # Primera conexión del proceso: crea/actualiza el esquema si hace falta
+        # (con la BD al día cuesta un PRAGMA user_version)
+        from migraciones import migrar
+        migrar(conn)
+        _ESQUEMA_OK = True
+        import sla
+        sla.iniciar(DB_PATH)
     return conn
 
 def col(row, key, default=None):
@@ -67,21 +107,21 @@ def update_user_fields(conn, user_id, fields: dict):
     params = list(data.values()) + [user_id]
     conn.execute(sql, params)
     conn.commit()
+    tocar("usuarios")
 
-def insert_row(conn, table, data: dict):
+def insert_row(conn, table, data: dict, commit=True):
+    # commit=False: el que llama agrega más escrituras y confirma todo junto
     cols = table_columns(conn, table)
     filt = {k: v for k, v in data.items() if k in cols}
     if not filt:
         return None
     placeholders = ", ".join(["?"] * len(filt))
     sql = f"INSERT INTO {table} ({', '.join(filt.keys())}) VALUES ({placeholders})"
-    conn.execute(sql, list(filt.values()))
-    conn.commit()
-    try:
-        rid = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-        return rid
-    except Exception:
-        return None
+    cur = conn.execute(sql, list(filt.values()))
+    if commit:
+        conn.commit()
+    tocar(table)
+    return cur.lastrowid
 
 # -------------------- Importación CSV tolerante --------------------
 def _norm_key(s: str) -> str:
@@ -132,6 +172,15 @@ def _parse_date_to_iso(v):
         return s
     return s
 
+def _parse_programada(v):
+    """Horario de una cita (datetime-local o ISO) → 'YYYY-MM-DD HH:MM'; ValueError si no es fecha."""
+    if v is None or (isinstance(v, str) and not v.strip()):
+        return None
+    try:
+        return datetime.fromisoformat(str(v).strip()).strftime("%Y-%m-%d %H:%M")
+    except ValueError:
+        raise ValueError("Fecha/hora inválida.") from None
+
 def _only_digits(s):
     return re.sub(r"\D+", "", str(s or ""))
 
@@ -163,12 +212,55 @@ def _split_tipo_valor(raw_tipo_o_tv, raw_valor):
             valor = m.group(1).strip()
     return tipo, (valor or None)
 
+@app.url_defaults
+def _fingerprint_static(endpoint, values):
+    # url_for('static', ...) → /static/...?v=<hash>: cambia solo si cambia el archivo
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        from archivos import version_estatico
+        v = version_estatico(app.static_folder, values["filename"])
+        if v:
+            values["v"] = v
+
+@app.after_request
+def _cache_static(resp):
+    # Con fingerprint la URL es inmutable: browsers y CDN la guardan un año
+    if request.endpoint == "static" and request.args.get("v") and resp.status_code in (200, 206, 304):
+        resp.cache_control.no_cache = None
+        resp.cache_control.public = True
+        resp.cache_control.max_age = 365 * 24 * 3600
+        resp.cache_control.immutable = True
+    return resp
+
+@app.after_request
+def _publicar_snapshot(resp):
+    # Si venció el intervalo, publica cambios/snapshot cuando la respuesta ya
+    # salió (call_on_close), así el backup + gzip no demora al usuario
+    rep = get_replicador()
+    if rep is not None and _ESQUEMA_OK and request.method != "GET" \
+            and rep.vencido(SNAPSHOT_CADA_CAMBIOS, SNAPSHOT_CADA_COMPLETO):
+        def publicar():
+            try:
+                rep.tal_vez_publicar(SNAPSHOT_CADA_CAMBIOS, SNAPSHOT_CADA_COMPLETO)
+            except Exception:
+                app.logger.exception("No se pudo publicar el snapshot de la BD")
+        resp.call_on_close(publicar)
+    return resp
+
 # ===========================
 #  Rutas de verificación
 # ===========================
 @app.get("/health")
 def health():
-    return {"ok": True}
+    # cold_start_ms lo completa api/index.py (None si se corre app.py directo)
+    from outbox import problema_transporte
+    return {"ok": True, "cold_start_ms": app.config.get("COLD_START_MS"),
+            "avisos": problema_transporte() or "ok"}
+
+@app.get("/api/cache_stats")
+def cache_stats():
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error": "no_auth"}), 401
+    return jsonify(cache_stats_todos())
 
 @app.get("/")
 def root():
@@ -198,6 +290,7 @@ def register():
 
         cols = table_columns(db, "usuarios")
         if "password_hash" in cols:
+            from werkzeug.security import generate_password_hash
             pwd_hash = generate_password_hash(contrasena)
             db.execute("""
                 INSERT INTO usuarios (usuario, password_hash, email, nombre, rol, foto_url, created_at, updated_at)
@@ -235,6 +328,7 @@ def forgot_password():
 
         cols = table_columns(db, "usuarios")
         if "password_hash" in cols:
+            from werkzeug.security import generate_password_hash
             pwd_hash = generate_password_hash(nueva)
             update_user_fields(db, col(user, "id"), {"password_hash": pwd_hash, "contrasena": None})
         else:
@@ -260,6 +354,7 @@ def login():
             pwd_hash = col(user, "password_hash")
             plano    = col(user, "contrasena")
             if pwd_hash:
+                from werkzeug.security import check_password_hash
                 ok = check_password_hash(pwd_hash, contrasena)
             elif plano is not None:
                 ok = (contrasena == plano)
@@ -309,24 +404,36 @@ def nuevo_ticket():
         prioridad      = request.form.get("prioridad") or "Media"
         tecnico_nombre = (request.form.get("tecnico") or "").strip()
         tecnico_id     = request.form.get("tecnico_id") or None
+        auto_asignar   = tecnico_id == "auto"
+        if auto_asignar:
+            tecnico_id, tecnico_nombre = None, ""
         problema       = (request.form.get("problema") or "").strip()
         cedula         = (request.form.get("cedula") or "").strip()
         pppoe          = (request.form.get("pppoe") or "").strip()
         canal          = (request.form.get("canal") or "web").strip()
         estado         = (request.form.get("estado") or "pendiente").strip()
 
-        programada_local = (request.form.get("programada_local") or "").strip()
-        programada_en = programada_local.replace("T", " ") if programada_local else None
+        try:
+            programada_en = _parse_programada(request.form.get("programada_local"))
+        except ValueError as e:
+            flash(str(e), "warning")
+            return redirect(url_for("nuevo_ticket"))
 
         if not pppoe and cliente:
-            slug = normalize("NFD", cliente.lower()).encode("ascii", "ignore").decode("ascii")
+            slug = unicodedata.normalize("NFD", cliente.lower()).encode("ascii", "ignore").decode("ascii")
             slug = "".join(ch for ch in slug if ch.isalnum())
             pppoe = f"{slug}@spynet.com"
 
         fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         db = get_db()
-        insert_row(db, "asistencias", {
+        # Si la dirección ya se resolvió antes, las coordenadas salen de la cache;
+        # si no, se geocodifica en segundo plano después del commit
+        from geocodificacion import desde_cache, encolar
+        import sla
+        pos = desde_cache(db, direccion) if direccion else None
+        due_at = sla.vence(fecha, prioridad, tipo)
+        tid = insert_row(db, "asistencias", {
             "cliente": cliente,
             "direccion": direccion,
             "tipo": tipo,
@@ -341,8 +448,25 @@ def nuevo_ticket():
             "estado": estado,
             "canal": canal,
             "tecnico_id": tecnico_id,
-        })
+            "lat": pos[0] if pos else None,
+            "lng": pos[1] if pos else None,
+            "due_at": due_at,
+        }, commit=False)
+        analitica.sumar(db, tid)
+        marcar_campos(db, tid, ["alta"])
+        if tecnico_id:
+            avisar_asignacion(db, [tid], tecnico_id)
+        if auto_asignar:
+            from asignacion import sugerir
+            candidatos, _ = sugerir(db, tid, k=1)
+            if candidatos:
+                asignar_tecnico(db, tid, candidatos[0]["tecnico_id"])
+        db.commit()
         db.close()
+        sla.programar(tid, due_at)
+        despachar_avisos()
+        if direccion and not pos:
+            encolar(DB_PATH, "asistencias", tid)
 
         flash("Asistencia registrada.", "success")
         return redirect(url_for("tickets"))
@@ -385,14 +509,16 @@ def nuevo_ticket():
     return render_template("nuevo_ticket.html", clientes=clientes, tecnicos=tecnicos)
 
 @app.route("/tickets")
+@cache_vista("asistencias", "tecnicos")
 def tickets():
     if "usuario" not in session and "usuario_id" not in session:
         return redirect(url_for("login"))
     db = get_db()
     rows = db.execute("SELECT * FROM asistencias ORDER BY datetime(fecha) DESC").fetchall()
     data = [dict(row) for row in rows]
+    tecnicos = db.execute("SELECT id, nombre FROM tecnicos WHERE activo=1 ORDER BY nombre").fetchall()
     db.close()
-    return render_template("tickets.html", tickets=data)
+    return render_template("tickets.html", tickets=data, tecnicos=tecnicos)
 
 # ===========================
 #  Descargas (PDF/WORD)
@@ -407,6 +533,7 @@ def descargar_pdf():
     tickets = [dict(row) for row in rows]
     db.close()
 
+    from fpdf import FPDF
     pdf = FPDF()
     pdf.add_page()
     pdf.set_font("Arial", size=12)
@@ -441,6 +568,7 @@ def descargar_word():
     tickets = [dict(row) for row in rows]
     db.close()
 
+    from docx import Document
     doc = Document()
     doc.add_heading("Tickets de Asistencia", 0)
 
@@ -481,43 +609,49 @@ def instalaciones():
     return render_template("instalaciones.html")
 
 @app.route("/equipos")
+@cache_vista("equipos", "herramientas", "uso_items")
 def equipos():
     if "usuario" not in session and "usuario_id" not in session:
         return redirect(url_for("login"))
 
+    # Historial paginado por cursor (fecha, id): el costo no crece con uso_items
+    antes_fecha = request.args.get("antes_fecha")
+    antes_id    = request.args.get("antes_id", type=int)
+
     conn = get_db()
     equipos = conn.execute("SELECT * FROM equipos").fetchall()
     herramientas = conn.execute("SELECT * FROM herramientas").fetchall()
-    historial = conn.execute("""
-        SELECT u.id, u.item_type, 
-               CASE 
-                 WHEN u.item_type = 'herramienta' THEN h.nombre 
-                 WHEN u.item_type = 'equipo' THEN e.nombre 
+
+    sql = """
+        SELECT u.id, u.item_type,
+               CASE
+                 WHEN u.item_type = 'herramienta' THEN h.nombre
+                 WHEN u.item_type = 'equipo' THEN e.nombre
                  ELSE 'Desconocido' END AS nombre_item,
                u.tecnico, u.fecha, u.servicio
         FROM uso_items u
         LEFT JOIN herramientas h ON u.item_type = 'herramienta' AND u.item_id = h.id
         LEFT JOIN equipos e ON u.item_type = 'equipo' AND u.item_id = e.id
-        ORDER BY datetime(u.fecha) DESC
-        LIMIT 10
-    """).fetchall()
-
-    total_equipos = conn.execute("SELECT COUNT(*) FROM equipos").fetchone()[0]
-    total_herramientas = conn.execute("SELECT COUNT(*) FROM herramientas").fetchone()[0]
-    total_items = total_equipos + total_herramientas
-
-    hoy_str = date.today().isoformat()
-    en_uso_equipos = conn.execute("""
-        SELECT COUNT(DISTINCT item_id) FROM uso_items 
-        WHERE item_type = 'equipo' AND fecha LIKE ?
-    """, (hoy_str + '%',)).fetchone()[0]
-
-    en_uso_herramientas = conn.execute("""
-        SELECT COUNT(DISTINCT item_id) FROM uso_items 
-        WHERE item_type = 'herramienta' AND fecha LIKE ?
-    """, (hoy_str + '%',)).fetchone()[0]
-
-    en_uso = en_uso_equipos + en_uso_herramientas
+    """
+    params = []
+    if antes_fecha and antes_id:
+        sql += " WHERE u.fecha < ? OR (u.fecha = ? AND u.id < ?)"
+        params += [antes_fecha, antes_fecha, antes_id]
+    sql += " ORDER BY u.fecha DESC, u.id DESC LIMIT ?"
+    params.append(HISTORIAL_POR_PAGINA + 1)
+    historial = conn.execute(sql, params).fetchall()
+
+    siguiente = None
+    if len(historial) > HISTORIAL_POR_PAGINA:
+        historial = historial[:HISTORIAL_POR_PAGINA]
+        ultimo = historial[-1]
+        siguiente = {"antes_fecha": ultimo["fecha"], "antes_id": ultimo["id"]}
+
+    # Totales: ya tenemos las listas; "en uso hoy" sale del resumen diario
+    total_items = len(equipos) + len(herramientas)
+    en_uso = conn.execute(
+        "SELECT COUNT(*) FROM uso_items_dia WHERE dia = ?", (date.today().isoformat(),)
+    ).fetchone()[0]
     disponibles = total_items - en_uso if total_items >= en_uso else 0
 
     conn.close()
@@ -526,7 +660,8 @@ def equipos():
     return render_template(
         "equipos.html",
         equipos=equipos, herramientas=herramientas, historial=historial,
-        total=total_items, en_uso=en_uso, disponibles=disponibles, now=now
+        total=total_items, en_uso=en_uso, disponibles=disponibles, now=now,
+        siguiente=siguiente, paginado=bool(antes_id)
     )
 
 @app.route('/registrar_equipo', methods=['POST'])
@@ -544,6 +679,7 @@ def registrar_equipo():
     """, (nombre, tipo, descripcion))
     conn.commit()
     conn.close()
+    tocar("equipos")
 
     flash("Equipo registrado correctamente.", "success")
     return redirect(url_for('equipos'))
@@ -580,8 +716,14 @@ def registrar_uso_item():
         INSERT INTO uso_items (item_type, item_id, tecnico, fecha, servicio)
         VALUES (?, ?, ?, ?, ?)
     """, (item_type, item_id, tecnico, fecha, servicio))
+    # Resumen diario (misma transacción): alimenta "En uso hoy" sin escanear uso_items
+    cursor.execute("""
+        INSERT INTO uso_items_dia (dia, item_type, item_id, usos) VALUES (?, ?, ?, 1)
+        ON CONFLICT(dia, item_type, item_id) DO UPDATE SET usos = usos + 1
+    """, (fecha[:10], item_type, item_id))
     conn.commit()
     conn.close()
+    tocar("uso_items")
 
     flash("Uso registrado correctamente.", "success")
     return redirect(url_for('equipos'))
@@ -601,10 +743,8 @@ def subir_imagen_herramienta():
         return redirect(url_for('equipos'))
 
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        from imagenes import guardar_subida
+        filename, _ = guardar_subida(file, app.config['UPLOAD_FOLDER'])
 
         herramienta_id = request.form.get('herramienta_id')
         if herramienta_id:
@@ -612,6 +752,7 @@ def subir_imagen_herramienta():
             conn.execute('UPDATE herramientas SET imagen = ? WHERE id = ?', (filename, herramienta_id))
             conn.commit()
             conn.close()
+            tocar("herramientas")
             flash('Imagen subida correctamente', 'success')
         else:
             flash('No se indicó la herramienta', 'danger')
@@ -627,33 +768,112 @@ def subir_foto_instalacion():
 
     foto = request.files.get("foto")
     descripcion = request.form.get("descripcion", "")
+    asistencia_id = request.form.get("asistencia_id", type=int)
     tecnico = session.get("usuario", "Desconocido")
     fecha_actual = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+    volver = request.referrer or url_for("equipos")
     if not foto or foto.filename == "":
         flash("No se seleccionó ninguna foto", "danger")
-        return redirect(url_for("equipos"))
+        return redirect(volver)
+    if not allowed_file(foto.filename):
+        flash("Formato de archivo no permitido", "danger")
+        return redirect(volver)
 
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    nombre_archivo = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secure_filename(foto.filename)}"
-    ruta_guardado = os.path.join(app.config['UPLOAD_FOLDER'], nombre_archivo)
-    foto.save(ruta_guardado)
+    # Se guarda por hash de contenido (misma foto = mismo archivo); la ruta
+    # en BD es relativa a UPLOAD_FOLDER
+    from imagenes import guardar_subida
+    ruta_guardado, _ = guardar_subida(foto, app.config['UPLOAD_FOLDER'])
 
     conn = get_db()
     conn.execute("""
         INSERT INTO fotos_asistencia (asistencia_id, tecnico, ruta_foto, descripcion, fecha)
         VALUES (?, ?, ?, ?, ?)
-    """, (None, tecnico, ruta_guardado, descripcion, fecha_actual))
+    """, (asistencia_id, tecnico, ruta_guardado, descripcion, fecha_actual))
     conn.commit()
     conn.close()
+    tocar("fotos_asistencia")
 
     flash("Foto subida correctamente.", "success")
-    return redirect(url_for("equipos"))
+    return redirect(volver)
+
+@app.route("/uploads/<path:nombre>")
+def uploads(nombre):
+    if "usuario" not in session and "usuario_id" not in session:
+        return redirect(url_for("login"))
+    from archivos import enviar_inmutable
+    return enviar_inmutable(app.config['UPLOAD_FOLDER'], nombre)
+
+@app.route("/fotos/<int:fid>")
+def foto_asistencia(fid):
+    if "usuario" not in session and "usuario_id" not in session:
+        return redirect(url_for("login"))
+    db = get_db()
+    row = db.execute("SELECT ruta_foto FROM fotos_asistencia WHERE id=?", (fid,)).fetchone()
+    db.close()
+    if not row:
+        return "Foto no encontrada", 404
+    # ruta_foto puede ser absoluta (subidas viejas) o relativa a UPLOAD_FOLDER
+    from archivos import enviar_inmutable
+    return enviar_inmutable(app.config['UPLOAD_FOLDER'], os.path.basename(row["ruta_foto"]))
+
+@app.route("/api/tickets/<int:tid>/fotos", endpoint="api_ticket_fotos")
+def api_ticket_fotos(tid):
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+
+    # Paginado por cursor (fecha, id) sobre idx_fotos_asistencia_fecha
+    limite      = min(request.args.get("limite", 24, type=int), 100)
+    antes_fecha = request.args.get("antes_fecha")
+    antes_id    = request.args.get("antes_id", type=int)
+
+    sql = """
+        SELECT id, ruta_foto, descripcion, tecnico, fecha
+          FROM fotos_asistencia
+         WHERE asistencia_id = ?
+    """
+    params = [tid]
+    if antes_fecha and antes_id:
+        sql += " AND (fecha < ? OR (fecha = ? AND id < ?))"
+        params += [antes_fecha, antes_fecha, antes_id]
+    sql += " ORDER BY fecha DESC, id DESC LIMIT ?"
+    params.append(limite + 1)
+
+    db = get_db()
+    rows = db.execute(sql, params).fetchall()
+    db.close()
+
+    siguiente = None
+    if len(rows) > limite:
+        rows = rows[:limite]
+        siguiente = {"antes_fecha": rows[-1]["fecha"], "antes_id": rows[-1]["id"]}
+
+    return jsonify({
+        "fotos": [{
+            "id": r["id"],
+            "descripcion": r["descripcion"],
+            "tecnico": r["tecnico"],
+            "fecha": r["fecha"],
+            "thumb_url": imagen_url(r["ruta_foto"], "thumb"),
+            "web_url": imagen_url(r["ruta_foto"], "web"),
+            "url": url_for("foto_asistencia", fid=r["id"]),
+        } for r in rows],
+        "siguiente": siguiente,
+    })
+
+@app.template_global()
+def imagen_url(nombre, variante="thumb"):
+    """URL de una imagen subida; 'thumb'/'web' si ya está generada, si no el original."""
+    if not nombre:
+        return None
+    from imagenes import ruta_variante
+    return url_for("uploads", nombre=ruta_variante(app.config['UPLOAD_FOLDER'], nombre, variante))
 
 # ===========================
 #  Clientes
 # ===========================
 @app.route("/clientes")
+@cache_vista("clientes")
 def clientes():
     if "usuario_id" not in session and "usuario" not in session:
     # ...resto igual...
@@ -742,8 +962,10 @@ def clientes_nuevo():
         if "tipo_valor" in cols and "tipo" not in cols and "valor" not in cols:
             data["tipo_valor"] = f"{tipo} {valor}" if valor else tipo
 
-        insert_row(db, "clientes", data)
+        cid = insert_row(db, "clientes", data)
         db.close()
+        from geocodificacion import encolar
+        encolar(DB_PATH, "clientes", cid)
         flash("Cliente creado.", "success")
         return redirect(url_for("clientes"))
     return render_template("cliente_form.html", mode="new", cliente=None)
@@ -759,13 +981,35 @@ def clientes_detalle(cid):
         db.close(); flash("Cliente no encontrado.", "warning")
         return redirect(url_for("clientes"))
 
-    full_name = f"{c['nombre']} {c['apellido']}".strip() if "apellido" in c.keys() else c["nombre"]
-    tickets = db.execute("""
-        SELECT * FROM asistencias WHERE cliente = ?
-        ORDER BY datetime(fecha) DESC LIMIT 10
-    """, (full_name,)).fetchall()
+    # Historial por cliente_id (idx_asistencias_cliente_fecha), paginado por cursor
+    antes_fecha = request.args.get("antes_fecha")
+    antes_id    = request.args.get("antes_id", type=int)
+    sql = "SELECT * FROM asistencias WHERE cliente_id = ?"
+    params = [cid]
+    if antes_fecha and antes_id:
+        sql += " AND (fecha < ? OR (fecha = ? AND id < ?))"
+        params += [antes_fecha, antes_fecha, antes_id]
+    sql += " ORDER BY fecha DESC, id DESC LIMIT ?"
+    params.append(HISTORIAL_POR_PAGINA + 1)
+    tickets = db.execute(sql, params).fetchall()
+
+    siguiente = None
+    if len(tickets) > HISTORIAL_POR_PAGINA:
+        tickets = tickets[:HISTORIAL_POR_PAGINA]
+        siguiente = {"antes_fecha": tickets[-1]["fecha"], "antes_id": tickets[-1]["id"]}
+
+    resumen = db.execute("""
+        SELECT COUNT(*) AS total,
+               SUM(estado IN ('pendiente','en_progreso')) AS abiertos,
+               SUM(estado = 'resuelto') AS resueltos,
+               MIN(fecha) AS primero,
+               MAX(fecha) AS ultimo
+          FROM asistencias
+         WHERE cliente_id = ?
+    """, (cid,)).fetchone()
     db.close()
-    return render_template("cliente_detalle.html", c=c, tickets=tickets)
+    return render_template("cliente_detalle.html", c=c, tickets=tickets, resumen=resumen,
+                           siguiente=siguiente, paginado=bool(antes_id))
 
 @app.route("/clientes/<int:cid>/editar", methods=["GET","POST"])
 def clientes_editar(cid):
@@ -805,10 +1049,18 @@ def clientes_editar(cid):
         if "valor" in cols: data["valor"] = valor
         if "tipo_valor" in cols and "tipo" not in cols and "valor" not in cols:
             data["tipo_valor"] = f"{tipo} {valor}" if valor else tipo
+        # Otra dirección: las coordenadas viejas ya no valen, se vuelve a geocodificar
+        if (c["referencia"] or "") != referencia or (c["barrio"] or "") != barrio:
+            data.update({"lat": None, "lng": None, "pos_manual": 0})
 
         sets = ", ".join([f"{k}=?" for k in data.keys()])
         db.execute(f"UPDATE clientes SET {sets} WHERE id=?", list(data.values())+[cid])
+        if (c["barrio"] or "") != (barrio or ""):
+            analitica.mover_barrio(db, {cid: c["barrio"]})
         db.commit(); db.close()
+        from geocodificacion import encolar
+        encolar(DB_PATH, "clientes", cid)
+        tocar("clientes")
         flash("Cliente actualizado.", "success")
         return redirect(url_for("clientes"))
     db.close()
@@ -824,6 +1076,7 @@ def clientes_toggle(cid):
         nuevo = 0 if cur["activo"]==1 else 1
         db.execute("UPDATE clientes SET activo=? WHERE id=?", (nuevo, cid))
         db.commit()
+        tocar("clientes")
         flash("Estado actualizado.", "success")
     db.close()
     return redirect(url_for("clientes"))
@@ -833,8 +1086,12 @@ def clientes_eliminar(cid):
     if "usuario_id" not in session and "usuario" not in session:
         return redirect(url_for("login"))
     db = get_db()
+    c = db.execute("SELECT barrio FROM clientes WHERE id=?", (cid,)).fetchone()
     db.execute("DELETE FROM clientes WHERE id=?", (cid,))
+    if c and c["barrio"]:
+        analitica.mover_barrio(db, {cid: c["barrio"]})
     db.commit(); db.close()
+    tocar("clientes")
     flash("Cliente eliminado.", "success")
     return redirect(url_for("clientes"))
 
@@ -842,6 +1099,7 @@ def clientes_eliminar(cid):
 #  Agenda + Acciones de tickets
 # ===========================
 @app.route("/agenda")
+@cache_vista("asistencias", "tecnicos", "clientes", "sla", "tecnico_pos")
 def agenda():
     if "usuario" not in session and "usuario_id" not in session:
         return redirect(url_for("login"))
@@ -880,10 +1138,9 @@ def agenda():
         FROM asistencias a
         {join_c}
         {join_t}
-       WHERE a.programada_en IS NOT NULL
-         AND date(a.programada_en) = ?
+       WHERE a.programada_en >= ? AND a.programada_en < date(?, '+1 day')
     """
-    params = [dia]
+    params = [dia, dia]
     if estado_f and "estado" in acols:
         sql += " AND a.estado = ?"
         params.append(estado_f)
@@ -893,6 +1150,22 @@ def agenda():
 
     sql += " ORDER BY time(a.programada_en) ASC"
     eventos = db.execute(sql, params).fetchall()
+
+    # Tickets que se pisan con otro del mismo técnico
+    from calendario import cargar, conflictos
+    choques = {i for par in conflictos(cargar(db, dia, dia)) for i in (par["a"], par["b"])}
+
+    # Orden de visita sugerido (solo con un técnico elegido)
+    ruta = None
+    if tecnico_f and request.args.get("orden") == "ruta":
+        ruta = plan_ruta(db, tecnico_f, dia)
+        por_id = {e["id"]: e for e in eventos}
+        eventos = [por_id[p["id"]] for p in ruta["orden"] if p["id"] in por_id] + \
+                  [e for e in eventos if e["id"] not in {p["id"] for p in ruta["orden"]}]
+
+    # Feed de SLA vencidos / por vencer (todos los días, no solo el de la agenda)
+    from sla import vencidos
+    sla_feed = vencidos(db, limite=20)
     db.close()
 
     d = datetime.strptime(dia, "%Y-%m-%d")
@@ -908,15 +1181,60 @@ def agenda():
         estado_f=estado_f,
         tecnico_f=tecnico_f,
         tecnicos=tecnicos,
+        ruta=ruta,
+        choques=choques,
+        sla_feed=sla_feed,
     )
 
+def plan_ruta(db, tecnico_id, dia):
+    """Ruta del día para el técnico: tickets abiertos agendados + su última posición."""
+    from rutas import planificar
+    paradas = [dict(r) for r in db.execute("""
+        SELECT a.id, a.cliente, a.direccion, a.programada_en,
+               COALESCE(a.lat, c.lat) AS lat, COALESCE(a.lng, c.lng) AS lng
+          FROM asistencias a
+          LEFT JOIN clientes c ON c.id = a.cliente_id
+         WHERE a.tecnico_id = ?
+           AND a.programada_en >= ? AND a.programada_en < date(?, '+1 day')
+           AND a.estado IN ('pendiente', 'en_progreso')
+         ORDER BY a.programada_en
+    """, (tecnico_id, dia, dia)).fetchall()]
+
+    pos = db.execute("""
+        SELECT lat, lng FROM tecnico_pos WHERE tecnico_id = ? ORDER BY ts DESC LIMIT 1
+    """, (tecnico_id,)).fetchone()
+    if pos is None:
+        pos = db.execute("SELECT lat, lng FROM tecnicos WHERE id = ? AND lat IS NOT NULL",
+                         (tecnico_id,)).fetchone()
+    origen = (pos["lat"], pos["lng"]) if pos else None
+
+    plan = planificar(origen, paradas)
+    plan["origen"] = origen
+    return plan
+
+@app.route("/api/agenda/ruta", endpoint="api_agenda_ruta")
+def api_agenda_ruta():
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    tecnico_id = request.args.get("tecnico_id", type=int)
+    if not tecnico_id:
+        return jsonify({"error": "falta tecnico_id"}), 400
+    dia = request.args.get("dia") or datetime.now().strftime("%Y-%m-%d")
+    db = get_db()
+    plan = plan_ruta(db, tecnico_id, dia)
+    db.close()
+    return jsonify(dict(plan, tecnico_id=tecnico_id, dia=dia))
+
 @app.route("/tickets/<int:tid>/programar", methods=["POST"])
 def tickets_programar(tid):
     if "usuario" not in session and "usuario_id" not in session:
         return redirect(url_for("login"))
 
-    prog = (request.form.get("programada_local") or "").strip()
-    programada_en = prog.replace("T", " ") if prog else None
+    try:
+        programada_en = _parse_programada(request.form.get("programada_local"))
+    except ValueError as e:
+        flash(str(e), "warning")
+        return redirect(request.referrer or url_for("agenda"))
 
     db = get_db()
     acols = table_columns(db, "asistencias")
@@ -925,11 +1243,16 @@ def tickets_programar(tid):
         flash("No existe la columna 'programada_en' en asistencias. Actualizá la BD.", "warning")
         return redirect(request.referrer or url_for("agenda"))
 
+    from calendario import choques_de
+    choques = choques_de(db, tid, programada_en=programada_en) if programada_en else []
     db.execute("UPDATE asistencias SET programada_en=? WHERE id=?", (programada_en, tid))
+    marcar_campos(db, tid, ["programada_en"])
     db.commit()
     db.close()
+    tocar("asistencias")
 
     flash("Cita reprogramada.", "success")
+    avisar_choques(choques)
     return redirect(request.referrer or url_for("agenda"))
 
 @app.route("/tickets/<int:tid>/estado", methods=["POST"])
@@ -950,9 +1273,13 @@ def tickets_cambiar_estado(tid):
         flash("Estado inválido.", "warning")
         return redirect(request.referrer or url_for("agenda"))
 
+    antes = analitica.fila_ticket(db, tid)
     db.execute("UPDATE asistencias SET estado=? WHERE id=?", (nuevo, tid))
+    analitica.mover(db, antes, analitica.fila_ticket(db, tid))
+    marcar_campos(db, tid, ["estado"])
     db.commit()
     db.close()
+    tocar("asistencias")
 
     flash("Estado actualizado.", "success")
     return redirect(request.referrer or url_for("agenda"))
@@ -971,11 +1298,228 @@ def tickets_asignar(tid):
         flash("No existe la columna 'tecnico_id' en asistencias. Actualizá la BD.", "warning")
         return redirect(request.referrer or url_for("agenda"))
 
-    db.execute("UPDATE asistencias SET tecnico_id=? WHERE id=?", (tecnico_id, tid))
+    from calendario import choques_de
+    choques = choques_de(db, tid, tecnico_id=tecnico_id) if tecnico_id else []
+    asignar_tecnico(db, tid, tecnico_id)
     db.commit()
     db.close()
+    despachar_avisos()
 
     flash("Técnico asignado.", "success")
+    avisar_choques(choques)
+    return redirect(request.referrer or url_for("agenda"))
+
+def avisar_choques(choques):
+    if choques:
+        lista = ", ".join(f"#{c['id']} ({c['programada_en'][11:16]} {c['cliente'] or ''})".strip()
+                          for c in choques)
+        flash(f"Atención: el técnico ya tiene otra cita en ese horario: {lista}", "warning")
+
+@app.route("/api/agenda", endpoint="api_agenda")
+def api_agenda():
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    from calendario import semana
+    hoy = datetime.now()
+    desde = request.args.get("desde") or (hoy - timedelta(days=hoy.weekday())).strftime("%Y-%m-%d")
+    db = get_db()
+    try:
+        datos = semana(db, desde, request.args.get("hasta"), request.args.get("tecnico_id", type=int))
+    except ValueError as e:
+        db.close()
+        return jsonify({"error": str(e)}), 400
+    db.close()
+    return jsonify(datos)
+
+def asignar_tecnico(db, tid, tecnico_id):
+    """UPDATE de tecnico_id + rollups; el que llama hace commit."""
+    antes = analitica.fila_ticket(db, tid)
+    db.execute("UPDATE asistencias SET tecnico_id=? WHERE id=?", (tecnico_id, tid))
+    analitica.mover(db, antes, analitica.fila_ticket(db, tid))
+    marcar_campos(db, tid, ["tecnico_id"])
+    if tecnico_id:
+        avisar_asignacion(db, [tid], tecnico_id)
+    tocar("asistencias")
+
+def avisar_asignacion(db, tids, tecnico_id):
+    """Encola el WhatsApp al técnico en la misma transacción (lo manda outbox.py); sin teléfono no hace nada."""
+    tec = db.execute("SELECT COALESCE(telefono_whatsapp, telefono) FROM tecnicos WHERE id = ?",
+                     (tecnico_id,)).fetchone()
+    if not tec or not tec[0]:
+        return
+    from outbox import encolar_muchos
+    mensajes = []
+    for i in range(0, len(tids), 500):
+        parte = list(tids)[i:i + 500]
+        for r in db.execute(f"""
+            SELECT id, cliente, direccion, tipo, prioridad, programada_en FROM asistencias
+             WHERE id IN ({', '.join('?' * len(parte))})
+        """, parte):
+            mensajes.append({
+                "canal": "whatsapp",
+                "destino": tec[0],
+                "asunto": f"Ticket #{r['id']} asignado",
+                "cuerpo": f"Ticket #{r['id']} asignado: {r['cliente'] or ''} — {r['direccion'] or 's/dirección'}. "
+                          f"{r['tipo'] or 'Asistencia'} / {r['prioridad'] or 'Media'}. "
+                          f"Agenda: {r['programada_en'] or 'sin horario'}",
+            })
+    encolar_muchos(db, mensajes)
+
+def despachar_avisos():
+    """Después del commit: despierta al despachador de la outbox."""
+    from outbox import despertar
+    despertar(DB_PATH)
+
+# ---------- Operaciones en lote ----------
+def aplicar_lote(db, ids, estado=None, tecnico_id=None, programada_en=None):
+    """
+    Aplica estado/técnico/horario a varios tickets en un solo UPDATE (sin commit).
+    Valida todo antes de escribir (ValueError con el motivo). Devuelve
+    (tickets actualizados, ids que quedaron con choque de horario).
+    """
+    try:
+        if isinstance(ids, (str, bytes)):
+            raise TypeError(ids)
+        ids = sorted({int(i) for i in ids})
+    except (TypeError, ValueError):
+        raise ValueError("Los ids de ticket tienen que ser números.") from None
+    if not ids:
+        raise ValueError("No se seleccionó ningún ticket.")
+    sets = {}
+    if estado:
+        if estado not in ("pendiente", "en_progreso", "resuelto", "cancelado"):
+            raise ValueError("Estado inválido.")
+        sets["estado"] = estado
+    if tecnico_id is not None:
+        if tecnico_id != "" and not db.execute(
+                "SELECT 1 FROM tecnicos WHERE id = ? AND activo = 1", (tecnico_id,)).fetchone():
+            raise ValueError("Técnico inexistente o inactivo.")
+        sets["tecnico_id"] = int(tecnico_id) if tecnico_id != "" else None
+    programada_en = _parse_programada(programada_en)
+    if programada_en:
+        sets["programada_en"] = programada_en
+    if not sets:
+        raise ValueError("No se indicó ningún cambio.")
+
+    antes = analitica.filas_tickets(db, ids)
+    ids = [i for i in ids if i in antes]            # ignora ids inexistentes
+    if not ids:
+        raise ValueError("Los tickets seleccionados no existen.")
+    for i in range(0, len(ids), 500):
+        parte = ids[i:i + 500]
+        db.execute(f"UPDATE asistencias SET {', '.join(f'{c} = ?' for c in sets)} "
+                   f"WHERE id IN ({', '.join('?' * len(parte))})", list(sets.values()) + parte)
+    despues = analitica.filas_tickets(db, ids)
+    for i in ids:
+        analitica.mover(db, antes[i], despues[i])
+    marcar_campos(db, ids, list(sets), origen="lote")
+    if sets.get("tecnico_id"):
+        avisar_asignacion(db, ids, sets["tecnico_id"])
+    tocar("asistencias")
+
+    # Choques: una lectura de la agenda de los días tocados
+    choques = set()
+    if "tecnico_id" in sets or "programada_en" in sets:
+        from calendario import cargar, conflictos
+        dias = []
+        for i in range(0, len(ids), 500):
+            parte = ids[i:i + 500]
+            dias += [r[0] for r in db.execute(
+                f"SELECT substr(programada_en, 1, 10) FROM asistencias WHERE programada_en IS NOT NULL "
+                f"AND id IN ({', '.join('?' * len(parte))})", parte)]
+        if dias:
+            elegidos = set(ids)
+            for par in conflictos(cargar(db, min(dias), max(dias))):
+                if par["a"] in elegidos or par["b"] in elegidos:
+                    choques.update((par["a"], par["b"]))
+    return len(ids), choques
+
+@app.route("/tickets/lote", methods=["POST"], endpoint="tickets_lote")
+def tickets_lote():
+    if "usuario" not in session and "usuario_id" not in session:
+        return redirect(url_for("login"))
+    volver = request.referrer or url_for("tickets")
+    accion = request.form.get("accion")
+    prog = request.form.get("programada_local")
+    db = get_db()
+    try:
+        n, choques = aplicar_lote(
+            db, request.form.getlist("ids", type=int),
+            estado=request.form.get("estado") if accion == "estado" else None,
+            tecnico_id=request.form.get("tecnico_id", "") if accion == "asignar" else None,
+            programada_en=prog if accion == "programar" else None,
+        )
+        db.commit()
+    except ValueError as e:
+        db.rollback(); db.close()
+        flash(str(e), "warning")
+        return redirect(volver)
+    db.close()
+    despachar_avisos()
+    flash(f"{n} ticket(s) actualizados.", "success")
+    if choques:
+        flash(f"Atención: {len(choques)} ticket(s) quedaron con choque de horario.", "warning")
+    return redirect(volver)
+
+@app.route("/api/tickets/lote", methods=["POST"], endpoint="api_tickets_lote")
+def api_tickets_lote():
+    """JSON {ids: [...], estado?, tecnico_id?, programada_en?} -> {actualizados, choques}."""
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    doc = request.get_json(silent=True) or {}
+    tecnico_id = None
+    if "tecnico_id" in doc:                     # null = desasignar
+        tecnico_id = "" if doc["tecnico_id"] is None else doc["tecnico_id"]
+    db = get_db()
+    try:
+        n, choques = aplicar_lote(
+            db, doc.get("ids") or [],
+            estado=doc.get("estado"),
+            tecnico_id=tecnico_id,
+            programada_en=doc.get("programada_en"),
+        )
+        db.commit()
+    except ValueError as e:
+        db.rollback(); db.close()
+        return jsonify({"error": str(e)}), 400
+    except TypeError:
+        db.rollback(); db.close()
+        return jsonify({"error": "Formato de pedido inválido."}), 400
+    db.close()
+    despachar_avisos()
+    return jsonify({"actualizados": n, "choques": sorted(choques)})
+
+def marcar_campos(db, tid, campos, origen="web"):
+    """Versión por campo (sync del móvil) + historial del ticket; el que llama hace commit."""
+    from sincronizacion import marcar
+    marcar(db, tid, campos, origen=origen, usuario=session.get("usuario") if has_request_context() else None)
+
+@app.route("/api/tickets/<int:tid>/sugerir_tecnico", endpoint="api_sugerir_tecnico")
+def api_sugerir_tecnico(tid):
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    from asignacion import sugerir
+    db = get_db()
+    candidatos, ms = sugerir(db, tid, k=request.args.get("k", 5, type=int))
+    db.close()
+    return jsonify({"ticket_id": tid, "candidatos": candidatos, "ms": ms})
+
+@app.route("/tickets/<int:tid>/auto_asignar", methods=["POST"])
+def tickets_auto_asignar(tid):
+    if "usuario" not in session and "usuario_id" not in session:
+        return redirect(url_for("login"))
+    from asignacion import sugerir
+    db = get_db()
+    candidatos, _ = sugerir(db, tid, k=1)
+    if not candidatos:
+        db.close()
+        flash("No hay técnicos disponibles para sugerir.", "warning")
+        return redirect(request.referrer or url_for("agenda"))
+    asignar_tecnico(db, tid, candidatos[0]["tecnico_id"])
+    db.commit()
+    db.close()
+    despachar_avisos()
+    flash(f"Técnico asignado automáticamente: {candidatos[0]['nombre']}.", "success")
     return redirect(request.referrer or url_for("agenda"))
 
 # ===========================
@@ -1013,6 +1557,8 @@ def clientes_importar():
     db = get_db()
     cols = table_columns(db, "clientes")
     ins = upd = 0
+    barrios_previos = {}   # clientes que cambiaron de barrio → rollups de sus tickets
+    regeocodificar = False # alguno cambió de dirección y quedó sin coordenadas
 
     for raw in reader:
         if not any((str(v or "").strip() for v in raw.values())):
@@ -1058,58 +1604,100 @@ def clientes_importar():
 
         row = None
         if ext_id:
-            row = db.execute("SELECT id FROM clientes WHERE external_id=?", (ext_id,)).fetchone()
+            row = db.execute("SELECT id, barrio, referencia FROM clientes WHERE external_id=?", (ext_id,)).fetchone()
         if not row and telefono:
-            row = db.execute("SELECT id FROM clientes WHERE telefono=?", (telefono,)).fetchone()
+            row = db.execute("SELECT id, barrio, referencia FROM clientes WHERE telefono=?", (telefono,)).fetchone()
 
         if row:
+            if (row["barrio"] or "") != (barrio or ""):
+                barrios_previos.setdefault(row["id"], row["barrio"])
+            if (row["referencia"] or "") != (referencia or "") or (row["barrio"] or "") != (barrio or ""):
+                data.update({"lat": None, "lng": None, "pos_manual": 0})
+                regeocodificar = True
             sets = ", ".join([f"{k}=?" for k in data.keys()])
             db.execute(f"UPDATE clientes SET {sets} WHERE id=?", list(data.values())+[row["id"]])
             upd += 1
         else:
             qs = ", ".join(["?"]*len(data))
-            db.execute(f"INSERT INTO clientes ({', '.join(data.keys())}) VALUES ({qs})", list(data.values()))
+            cur = db.execute(f"INSERT INTO clientes ({', '.join(data.keys())}) VALUES ({qs})", list(data.values()))
+            if barrio:   # un id reusado puede tener tickets viejos (barrio '' hasta ahora)
+                barrios_previos.setdefault(cur.lastrowid, None)
             ins += 1
 
+    if barrios_previos:
+        analitica.mover_barrio(db, barrios_previos)
     db.commit(); db.close()
+    if regeocodificar:
+        from geocodificacion import encolar
+        encolar(DB_PATH)
+    tocar("clientes")
     flash(f"Importación OK. Insertados {ins}, actualizados {upd}. (codificación {enc}, separador '{delim}')", "success")
     return redirect(url_for("clientes"))
 
+# ===========================
+#  Analítica (rollups)
+# ===========================
+@app.route("/api/analitica/<dimension>", endpoint="api_analitica")
+def api_analitica(dimension):
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    if dimension not in analitica.DIMENSIONES:
+        return jsonify({"error": "dimension_invalida", "validas": list(analitica.DIMENSIONES)}), 400
+
+    db = get_db()
+    datos = analitica.consultar(
+        db, dimension,
+        desde=request.args.get("desde"),
+        hasta=request.args.get("hasta"),
+        estado=request.args.get("estado"),          # un estado o 'abiertos'
+        por_semana=request.args.get("agrupar") == "semana",
+    )
+    db.close()
+    return jsonify({"dimension": dimension, "datos": datos})
+
+# ===========================
+#  Geocodificación
+# ===========================
+@app.route("/api/geocodificacion", methods=["GET", "POST"], endpoint="api_geocodificacion")
+def api_geocodificacion():
+    """GET: estado y pendientes. POST: lanza la geocodificación en segundo plano."""
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    import geocodificacion
+    if request.method == "POST":
+        geocodificacion.encolar(DB_PATH)
+    db = get_db()
+    faltan = {t: db.execute(f"SELECT COUNT(*) FROM {t} WHERE lat IS NULL OR lng IS NULL").fetchone()[0]
+              for t in ("clientes", "asistencias")}
+    cache_n = dict(db.execute("SELECT estado, COUNT(*) FROM geocache GROUP BY estado").fetchall())
+    db.close()
+    return jsonify(dict(geocodificacion.estado(), sin_coordenadas=faltan, cache=cache_n)), \
+        (202 if request.method == "POST" else 200)
+
 # ===========================
 #  API mapa y GPS
 # ===========================
 @app.route("/api/mapa_datos", endpoint="api_mapa_datos")
+@cache_vista("asistencias", "tecnicos", "tecnico_pos")
 def api_mapa_datos():
     if "usuario" not in session and "usuario_id" not in session:
         return jsonify({"error":"no_auth"}), 401
 
-    db = get_db()
-    tickets = db.execute("""
-        SELECT a.id, a.cliente, a.direccion, a.tipo, a.prioridad, a.estado,
-               a.programada_en, a.lat, a.lng,
-               COALESCE(t.nombre, a.tecnico) AS tecnico
-        FROM asistencias a
-        LEFT JOIN tecnicos t ON a.tecnico_id = t.id
-        WHERE a.lat IS NOT NULL AND a.lng IS NOT NULL
-          AND date(a.fecha) >= date('now','-15 day')
-    """).fetchall()
+    # Viewport opcional: bbox=oeste,sur,este,norte (orden de Leaflet toBBoxString) y zoom
+    bbox = None
+    if request.args.get("bbox"):
+        try:
+            oeste, sur, este, norte = (float(x) for x in request.args["bbox"].split(","))
+            bbox = (sur, oeste, norte, este)
+        except ValueError:
+            return jsonify({"error": "bbox inválido"}), 400
+    zoom = request.args.get("zoom", type=int)
 
-    pos = db.execute("""
-        SELECT tp.tecnico_id, tp.lat, tp.lng, tp.ts, te.nombre
-        FROM tecnico_pos tp
-        JOIN (
-            SELECT tecnico_id, MAX(ts) AS mts
-            FROM tecnico_pos GROUP BY tecnico_id
-        ) x ON x.tecnico_id = tp.tecnico_id AND x.mts = tp.ts
-        LEFT JOIN tecnicos te ON te.id = tp.tecnico_id
-    """).fetchall()
+    from mapa import consultar
+    db = get_db()
+    datos = consultar(db, bbox, zoom)
     db.close()
-
-    return jsonify({
-        "tickets": [dict(r) for r in tickets],
-        "tecnicos": [{"id": r["tecnico_id"], "nombre": r["nombre"],
-                      "lat": r["lat"], "lng": r["lng"], "ts": r["ts"]} for r in pos]
-    })
+    return jsonify(datos)
 
 @app.route("/api/tecnico_trayectoria/<int:tid>", endpoint="api_tecnico_trayectoria")
 def api_tecnico_trayectoria(tid):
@@ -1129,26 +1717,239 @@ def api_tecnico_trayectoria(tid):
     db.close()
     return jsonify([dict(r) for r in rows])
 
+@app.route("/api/tecnicos/<int:tid>/recorrido", endpoint="api_tecnico_recorrido")
+def api_tecnico_recorrido(tid):
+    """Km, paradas, tiempo en sitio por ticket y tiempo ocioso del técnico en el día."""
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    dia = request.args.get("dia") or datetime.now().strftime("%Y-%m-%d")
+    try:
+        datetime.strptime(dia, "%Y-%m-%d")
+    except ValueError:
+        return jsonify({"error": "dia inválido"}), 400
+    from recorridos import del_dia
+    db = get_db()
+    datos = del_dia(db, tid, dia)
+    db.close()
+    return jsonify(datos)
+
 @app.route("/gps", methods=["GET","POST"], endpoint="gps_ping")
 def gps_ping():
-    tecnico_id = request.values.get("tecnico_id")
-    lat = request.values.get("lat")
-    lng = request.values.get("lng")
-    if not tecnico_id or not lat or not lng:
-        return "Faltan parametros (tecnico_id, lat, lng)", 400
+    import ingesta
+    # Token del dispositivo: header "Authorization: Bearer <token>" o parámetro token
+    auth = request.headers.get("Authorization", "")
+    token = auth[7:].strip() if auth.startswith("Bearer ") else request.values.get("token")
+    lat = request.values.get("lat", type=float)
+    lng = request.values.get("lng", type=float)
+    if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return "Faltan parametros (lat, lng)", 400
+
+    db = None
+    if token:
+        tecnico_id, db = ingesta.autenticar(get_db, token)
+        if tecnico_id is None:
+            if db: db.close()
+            return "Token inválido", 401
+    elif GPS_PERMITIR_SIN_TOKEN and request.values.get("tecnico_id", type=int):
+        tecnico_id = request.values.get("tecnico_id", type=int)
+        token = f"id:{tecnico_id}"
+    else:
+        return "Falta token", 401
+
+    if not ingesta.permitir(token):
+        if db: db.close()
+        return "Demasiados pings", 429
+    try:
+        ts = ingesta.parsear_ts(request.values.get("ts")) or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        if db: db.close()
+        return "ts inválido", 400
+    db = db or get_db()
+    if not ingesta.aceptar_fix(db, tecnico_id, ts):
+        db.close()
+        return "ok (repetido)"
 
-    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    db = get_db()
     db.execute("INSERT INTO tecnico_pos (tecnico_id, lat, lng, ts) VALUES (?,?,?,?)",
-               (tecnico_id, float(lat), float(lng), ts))
+               (tecnico_id, lat, lng, ts))
+    db.execute("UPDATE tecnicos SET lat=?, lng=?, pos_updated_at=? WHERE id=?",
+               (lat, lng, ts, tecnico_id))
 
-    cols = table_columns(db, "tecnicos")
-    if {"lat","lng","pos_updated_at"} <= cols:
-        db.execute("UPDATE tecnicos SET lat=?, lng=?, pos_updated_at=? WHERE id=?",
-                   (float(lat), float(lng), ts, tecnico_id))
+    # Llegada/salida de los tickets abiertos del técnico
+    from geocercas import evaluar
+    eventos = evaluar(db, tecnico_id, lat, lng, ts)
     db.commit(); db.close()
+    ingesta.confirmar(tecnico_id, (ts, lat, lng), eventos)
+    tocar("tecnico_pos", "tecnicos")
     return "ok"
 
+@app.route("/api/telemetria", methods=["POST"], endpoint="api_telemetria")
+def api_telemetria():
+    """
+    Lote de fixes del dispositivo hacia tecnico_tracks. Cuerpo binario SPT1
+    (application/octet-stream) o JSON columnar; ver telemetria.py.
+    """
+    import ingesta, telemetria
+    auth = request.headers.get("Authorization", "")
+    token = auth[7:].strip() if auth.startswith("Bearer ") else request.args.get("token")
+    tecnico_id, db = ingesta.autenticar(get_db, token)
+    if tecnico_id is None:
+        if db: db.close()
+        return jsonify({"error": "token inválido"}), 401
+    if not ingesta.permitir(token):
+        if db: db.close()
+        return jsonify({"error": "demasiados lotes"}), 429
+
+    try:
+        if request.mimetype == "application/octet-stream":
+            fixes = telemetria.decodificar_binario(request.get_data())
+            movil, source = request.headers.get("X-Movil"), "bin"
+        else:
+            doc = request.get_json(silent=True) or {}
+            fixes = telemetria.decodificar_columnar(doc)
+            movil, source = doc.get("movil"), doc.get("source") or "json"
+    except telemetria.FormatoInvalido as e:
+        if db: db.close()
+        return jsonify({"error": str(e)}), 400
+    if len(fixes) > ingesta.MAX_FIXES_LOTE:
+        if db: db.close()
+        return jsonify({"error": f"máximo {ingesta.MAX_FIXES_LOTE} fixes por lote"}), 413
+
+    db = db or get_db()
+    cuenta = ingesta.guardar_lote(db, tecnico_id, fixes, movil, source)
+    db.commit(); db.close()
+    ingesta.confirmar(tecnico_id, cuenta.pop("ultimo"), cuenta.pop("eventos"))
+    del cuenta["motivos"]
+    if cuenta["aceptados"]:
+        tocar("tecnico_pos", "tecnico_tracks", "tecnicos")
+    return jsonify(cuenta)
+
+@app.route("/api/sync", methods=["POST"], endpoint="api_sync")
+def api_sync():
+    """Changelog offline del móvil (idempotente, una transacción) + delta desde su cursor."""
+    import ingesta, sincronizacion
+    auth = request.headers.get("Authorization", "")
+    token = auth[7:].strip() if auth.startswith("Bearer ") else request.args.get("token")
+    tecnico_id, db = ingesta.autenticar(get_db, token)
+    if tecnico_id is None:
+        if db: db.close()
+        return jsonify({"error": "token inválido"}), 401
+    if not ingesta.permitir(token):
+        if db: db.close()
+        return jsonify({"error": "demasiados pedidos"}), 429
+
+    doc = request.get_json(silent=True)
+    if not isinstance(doc, dict) or not isinstance(doc.get("cambios", []), list):
+        if db: db.close()
+        return jsonify({"error": "se esperaba {cursor, cambios: [...]}"}), 400
+
+    db = db or get_db()
+    try:
+        resultados, gps = sincronizacion.aplicar(db, tecnico_id, doc.get("cambios") or [],
+                                                 doc.get("movil"), app.config["UPLOAD_FOLDER"])
+        db.commit()
+    except Exception:
+        db.rollback(); db.close()
+        app.logger.exception("sync: lote rechazado")
+        return jsonify({"error": "no se pudo aplicar el lote; reintentar"}), 500
+    if gps:
+        ingesta.confirmar(tecnico_id, gps["ultimo"], gps["eventos"])
+    cursor = doc.get("cursor")
+    datos = sincronizacion.delta(db, tecnico_id, cursor if isinstance(cursor, int) else None)
+    db.close()
+    return jsonify(dict(datos, resultados=resultados))
+
+@app.route("/api/tecnicos/<int:tid>/tracking_token", methods=["POST"], endpoint="api_tracking_token")
+def api_tracking_token(tid):
+    """Genera el token de tracking del técnico (se muestra una sola vez)."""
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    from ingesta import emitir_token
+    db = get_db()
+    if not db.execute("SELECT 1 FROM tecnicos WHERE id = ?", (tid,)).fetchone():
+        db.close()
+        return jsonify({"error": "técnico no encontrado"}), 404
+    token = emitir_token(db, tid)
+    db.commit(); db.close()
+    return jsonify({"tecnico_id": tid, "token": token})
+
+@app.route("/api/tickets/<int:tid>/geocerca", endpoint="api_ticket_geocerca")
+def api_ticket_geocerca(tid):
+    """Llegadas y salidas del técnico a este ticket (detectadas por GPS)."""
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    db = get_db()
+    rows = db.execute("""
+        SELECT g.tecnico_id, t.nombre AS tecnico, g.tipo, g.ts, g.lat, g.lng
+          FROM geocerca_eventos g
+          LEFT JOIN tecnicos t ON t.id = g.tecnico_id
+         WHERE g.ticket_id = ?
+         ORDER BY g.id
+    """, (tid,)).fetchall()
+    db.close()
+    return jsonify([dict(r) for r in rows])
+
+@app.route("/api/tickets/<int:tid>/historial", endpoint="api_ticket_historial")
+def api_ticket_historial(tid):
+    """Línea de tiempo del ticket (ticket_events) y sus tiempos de SLA."""
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    import eventos
+    db = get_db()
+    datos = {"eventos": eventos.linea_de_tiempo(db, tid), "sla": eventos.sla(db, tid)}
+    db.close()
+    return jsonify(datos)
+
+@app.route("/api/sla/vencidos", endpoint="api_sla_vencidos")
+def api_sla_vencidos():
+    """Tickets abiertos con el SLA vencido o por vencer, del más atrasado al menos."""
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    import sla
+    limite = min(max(1, request.args.get("limite", 200, type=int)), 1000)
+    db = get_db()
+    datos = dict(sla.vencidos(db, limite=limite), vigilante=sla.estado())
+    db.close()
+    return jsonify(datos)
+
+@app.route("/api/cobranza/recordatorios", methods=["GET", "POST"], endpoint="api_cobranza_recordatorios")
+def api_cobranza_recordatorios():
+    """Job diario: encola avisos de vencimiento por barrio/técnico; los manda el despachador."""
+    cron_ok = bool(CRON_SECRET) and request.headers.get("Authorization") == f"Bearer {CRON_SECRET}"
+    if not cron_ok and "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    import cobranza
+    dias = min(max(0, request.args.get("dias", cobranza.VENTANA_DIAS, type=int)), 31)
+    db = get_db()
+    try:
+        datos = cobranza.correr(db, DB_PATH, dias=dias)
+    finally:
+        db.close()
+    return jsonify(datos)
+
+@app.route("/api/outbox/metricas", endpoint="api_outbox_metricas")
+def api_outbox_metricas():
+    """Throughput, latencias y estado de la cola de notificaciones."""
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    from outbox import metricas
+    db = get_db()
+    datos = metricas(db)
+    db.close()
+    return jsonify(datos)
+
+@app.route("/api/eventos", endpoint="api_eventos")
+def api_eventos():
+    """Cola de cambios de tickets: ?desde=<cursor> devuelve los eventos posteriores y el cursor nuevo."""
+    if "usuario" not in session and "usuario_id" not in session:
+        return jsonify({"error":"no_auth"}), 401
+    import eventos
+    cursor = request.args.get("desde", type=int) or 0
+    limite = min(request.args.get("limite", eventos.LIMITE, type=int), eventos.LIMITE)
+    db = get_db()
+    datos = eventos.desde(db, cursor, max(1, limite))
+    db.close()
+    return jsonify(datos)
+
 # ===========================
 #  Main (solo local)
 # ===========================
@@ -0,0 +1,77 @@
+# archivos.py
+"""
+Servido de archivos con caché HTTP agresivo.
+
+- ETag fuerte = hash del contenido (si el nombre ya es un hash, se usa tal cual).
+- Peticiones condicionales (If-None-Match) y Range las resuelve send_file.
+- Cache-Control inmutable: el contenido de una URL con hash nunca cambia.
+- static/: version_estatico() da el ?v=<hash> (fingerprint) de sus URLs.
+"""
+import os
+import re
+import hashlib
+import threading
+
+from flask import send_file, abort
+
+UN_ANIO = 365 * 24 * 3600
+
+_RE_HASH = re.compile(r"^[0-9a-f]{32}(_[a-z]+)?\.[a-z0-9]+$")
+_memo = {}          # ruta -> (mtime_ns, size, hash)
+_memo_lock = threading.Lock()
+
+
+def hash_archivo(ruta):
+    """SHA-256 (32 hex) del archivo; memorizado mientras no cambie mtime/tamaño."""
+    st = os.stat(ruta)
+    with _memo_lock:
+        hit = _memo.get(ruta)
+        if hit and hit[0] == st.st_mtime_ns and hit[1] == st.st_size:
+            return hit[2]
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for buf in iter(lambda: f.read(64 * 1024), b""):
+            h.update(buf)
+    digest = h.hexdigest()[:32]
+    with _memo_lock:
+        _memo[ruta] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def etag_de(ruta):
+    nombre = os.path.basename(ruta)
+    if _RE_HASH.match(nombre):
+        return nombre.rsplit(".", 1)[0]
+    return hash_archivo(ruta)
+
+
+def enviar_inmutable(carpeta, nombre, privado=True):
+    """
+    send_file con ETag fuerte, soporte de Range/condicionales y caché de un año
+    (si el nombre es un hash de contenido).
+    privado=True para contenido detrás de login (no lo guardan CDNs compartidos).
+    """
+    base = os.path.realpath(carpeta)
+    ruta = os.path.realpath(os.path.join(base, nombre))
+    if not ruta.startswith(base + os.sep) or not os.path.isfile(ruta):
+        abort(404)
+
+    if not _RE_HASH.match(os.path.basename(ruta)):
+        # Nombre sin hash (subidas viejas): puede cambiar, se revalida con el ETag
+        resp = send_file(ruta, etag=etag_de(ruta), conditional=True, max_age=0)
+        resp.cache_control.no_cache = True
+        return resp
+
+    resp = send_file(ruta, etag=etag_de(ruta), conditional=True, max_age=UN_ANIO)
+    resp.cache_control.public = not privado
+    resp.cache_control.private = privado or None
+    resp.cache_control.immutable = True
+    return resp
+
+
+def version_estatico(carpeta, filename):
+    """Fingerprint corto para ?v= en URLs de static/ (None si no existe)."""
+    ruta = os.path.join(carpeta, filename)
+    if not os.path.isfile(ruta):
+        return None
+    return hash_archivo(ruta)[:12]
@@ -0,0 +1,190 @@
+# asignacion.py
+"""
+Motor de asignación de técnicos.
+
+Para un ticket se toman los técnicos activos más cercanos (índice en grilla
+sobre su última posición) y se puntúa cada uno con:
+  distancia (km) * peso_km  +  tickets abiertos * peso_carga  +  choque de agenda
+Los pesos dependen de la prioridad: en "Alta" pesa más llegar rápido, en
+"Baja" repartir la carga. Menor puntaje = mejor candidato. Los técnicos sin
+posición conocida compiten igual, con KM_SIN_POSICION como distancia.
+
+La carga abierta sale de ticket_stats (analitica.py) y los choques de agenda
+de un rango sobre idx_asistencias_prog: nada escanea asistencias completa.
+"""
+import time
+import threading
+from datetime import datetime, timedelta
+
+from geo import IndiceGrilla
+from cache import version as version_datos
+from analitica import ABIERTOS
+
+# prioridad -> (peso por km, peso por ticket abierto)
+PESOS = {"Alta": (3.0, 0.5), "Media": (1.0, 1.0), "Baja": (0.5, 2.0)}
+PENALIDAD_CHOQUE = 25.0       # equivale a ~25 km extra en prioridad media
+VENTANA_CHOQUE = timedelta(minutes=90)
+CANDIDATOS = 15               # vecinos a evaluar en detalle
+KM_SIN_POSICION = 10.0        # distancia supuesta de un técnico sin posición
+
+_lock = threading.Lock()
+_indice = None
+_nombres = {}
+_version = None
+
+
+def indice_tecnicos(conn):
+    """Índice de técnicos activos por posición; se reconstruye si cambiaron los datos."""
+    global _indice, _nombres, _version
+    v = version_datos("tecnicos", "tecnico_pos")
+    with _lock:
+        if _indice is not None and _version == v:
+            return _indice, _nombres
+        idx, nombres = IndiceGrilla(), {}
+        rows = conn.execute("""
+            SELECT t.id, t.nombre,
+                   COALESCE(t.lat, p.lat) AS lat, COALESCE(t.lng, p.lng) AS lng
+              FROM tecnicos t
+              LEFT JOIN (
+                    SELECT tp.tecnico_id, tp.lat, tp.lng
+                      FROM tecnico_pos tp
+                      JOIN (SELECT tecnico_id, MAX(ts) AS mts FROM tecnico_pos GROUP BY tecnico_id) x
+                        ON x.tecnico_id = tp.tecnico_id AND x.mts = tp.ts
+              ) p ON p.tecnico_id = t.id
+             WHERE t.activo = 1
+        """).fetchall()
+        for r in rows:
+            nombres[r[0]] = r[1]
+            if r[2] is not None and r[3] is not None:
+                idx.insertar(r[0], r[2], r[3])
+        _indice, _nombres, _version = idx, nombres, v
+        return idx, nombres
+
+
+def carga_abierta(conn):
+    """tecnico_id -> tickets abiertos (lectura directa de ticket_stats)."""
+    marcas = ", ".join("?" * len(ABIERTOS))
+    rows = conn.execute(f"""
+        SELECT valor, SUM(n) FROM ticket_stats
+         WHERE dimension = 'tecnico_id' AND dia = '' AND estado IN ({marcas}) AND valor <> ''
+         GROUP BY valor
+    """, list(ABIERTOS)).fetchall()
+    return {int(r[0]): r[1] for r in rows}
+
+
+def ocupados(conn, programada_en, excluir_tid=None):
+    """Técnicos con otro ticket abierto agendado cerca de programada_en."""
+    try:
+        t = datetime.strptime(programada_en[:16], "%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        return set()
+    desde = (t - VENTANA_CHOQUE).strftime("%Y-%m-%d %H:%M")
+    hasta = (t + VENTANA_CHOQUE).strftime("%Y-%m-%d %H:%M:59")
+    marcas = ", ".join("?" * len(ABIERTOS))
+    rows = conn.execute(f"""
+        SELECT DISTINCT tecnico_id FROM asistencias
+         WHERE programada_en BETWEEN ? AND ?
+           AND tecnico_id IS NOT NULL AND id <> ? AND estado IN ({marcas})
+    """, [desde, hasta, excluir_tid or 0] + list(ABIERTOS)).fetchall()
+    return {r[0] for r in rows}
+
+
+def ubicacion_ticket(conn, tid):
+    r = conn.execute("""
+        SELECT a.id, a.prioridad, a.programada_en,
+               COALESCE(a.lat, c.lat) AS lat, COALESCE(a.lng, c.lng) AS lng
+          FROM asistencias a
+          LEFT JOIN clientes c ON c.id = a.cliente_id
+         WHERE a.id = ?
+    """, (tid,)).fetchone()
+    return dict(zip(("id", "prioridad", "programada_en", "lat", "lng"), r)) if r else None
+
+
+def sugerir(conn, tid, k=5):
+    """
+    Candidatos ordenados para el ticket: lista de dicts con tecnico_id, nombre,
+    dist_km, carga, choque y puntaje. Devuelve (candidatos, ms de decisión).
+    """
+    t0 = time.perf_counter()
+    ticket = ubicacion_ticket(conn, tid)
+    if ticket is None:
+        return [], 0.0
+
+    idx, nombres = indice_tecnicos(conn)
+    carga = carga_abierta(conn)
+    choques = ocupados(conn, ticket["programada_en"], tid) if ticket["programada_en"] else set()
+    peso_km, peso_carga = PESOS.get(ticket["prioridad"] or "Media", PESOS["Media"])
+
+    if ticket["lat"] is not None and ticket["lng"] is not None and len(idx):
+        vecinos = [(d, tec) for d, tec, _, _ in idx.cercanos(ticket["lat"], ticket["lng"], k=CANDIDATOS)]
+        # Los que no tienen posición no salen del índice: entran por carga
+        vecinos += [(None, tec) for tec in nombres if tec not in idx]
+        km_sin_pos = KM_SIN_POSICION
+    else:
+        # Sin coordenadas: solo cuenta la carga
+        vecinos = [(None, tec) for tec in nombres]
+        km_sin_pos = 0.0
+
+    candidatos = []
+    for dist, tec in vecinos:
+        puntaje = (km_sin_pos if dist is None else dist) * peso_km + carga.get(tec, 0) * peso_carga
+        if tec in choques:
+            puntaje += PENALIDAD_CHOQUE
+        candidatos.append({
+            "tecnico_id": tec,
+            "nombre": nombres.get(tec),
+            "dist_km": round(dist, 2) if dist is not None else None,
+            "carga": carga.get(tec, 0),
+            "choque": tec in choques,
+            "puntaje": round(puntaje, 3),
+        })
+    candidatos.sort(key=lambda c: c["puntaje"])
+    return candidatos[:k], round((time.perf_counter() - t0) * 1000, 2)
+
+
+if __name__ == "__main__":
+    import sys
+    import random
+    import sqlite3
+    import analitica
+    from migraciones import migrar
+
+    if "--bench" not in sys.argv:
+        print("Uso: python asignacion.py --bench [tecnicos] [tickets]")
+        sys.exit(1)
+    args = [int(a) for a in sys.argv[1:] if a != "--bench"]
+    n_tec = args[0] if args else 200
+    n_tix = args[1] if len(args) > 1 else 20_000
+
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    migrar(conn)
+    # Asunción y alrededores; un 10% de técnicos sin posición
+    def punto():
+        return -25.28 + random.uniform(-0.15, 0.15), -57.63 + random.uniform(-0.15, 0.15)
+    conn.executemany("INSERT INTO tecnicos (nombre, lat, lng, activo) VALUES (?, ?, ?, 1)",
+                     [(f"Tec {i}",) + (punto() if i % 10 else (None, None)) for i in range(n_tec)])
+    hoy = datetime.now().strftime("%Y-%m-%d")
+    conn.executemany("""
+        INSERT INTO asistencias (cliente, fecha, estado, prioridad, tipo, tecnico_id, programada_en, lat, lng)
+        VALUES (?, ?, ?, ?, 'Reparación', ?, ?, ?, ?)
+    """, [(f"Cliente {i}", f"{hoy} 08:00:00", random.choice(("pendiente", "en_progreso", "resuelto")),
+           random.choice(("Alta", "Media", "Baja")), random.randint(1, n_tec),
+           f"{hoy} {random.randint(8, 18):02d}:{random.choice(('00', '30'))}") + punto()
+          for i in range(n_tix)])
+    analitica.reconstruir(conn)
+    conn.commit()
+
+    indice_tecnicos(conn)                                   # índice en frío aparte
+    ids = [r[0] for r in conn.execute("SELECT id FROM asistencias ORDER BY random() LIMIT 1000")]
+    tiempos, sin_pos = [], 0
+    for tid in ids:
+        t0 = time.perf_counter()
+        candidatos, _ = sugerir(conn, tid)
+        tiempos.append((time.perf_counter() - t0) * 1000)
+        sin_pos += any(c["dist_km"] is None for c in candidatos)
+    tiempos.sort()
+    print(f"{n_tec} técnicos, {n_tix} tickets, {len(ids)} sugerencias")
+    print(f"  p50 {tiempos[len(tiempos) // 2]:.2f} ms · p95 {tiempos[int(len(tiempos) * 0.95)]:.2f} ms"
+          f" · máx {tiempos[-1]:.2f} ms")
+    print(f"  sugerencias con algún técnico sin posición en el top 5: {sin_pos}")
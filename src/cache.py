@@ -0,0 +1,130 @@
+# cache.py
+"""
+Cache en proceso (LRU + TTL) para páginas renderizadas y payloads JSON.
+
+La clave incluye la ruta, los query args normalizados, el usuario y la
+"versión de datos" de cada tabla que lee la vista. Las escrituras llaman a
+tocar(tabla) y eso invalida todas las entradas que dependían de ella sin
+recorrer el cache. Las versiones son por proceso: otra instancia serverless
+no se entera, por eso el TTL acota cuánto puede quedar desactualizada.
+"""
+import time
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+from flask import request, session, make_response
+
+
+class CacheLRU:
+    def __init__(self, max_items=256, ttl=30):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._datos = OrderedDict()   # clave -> (vence, valor)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, clave):
+        with self._lock:
+            item = self._datos.get(clave)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._datos[clave]
+                self.misses += 1
+                return None
+            self._datos.move_to_end(clave)
+            self.hits += 1
+            return item[1]
+
+    def set(self, clave, valor, ttl=None):
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + (ttl or self.ttl), valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "items": len(self._datos),
+            "max_items": self.max_items,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else None,
+        }
+
+
+# ------------------ Versiones de datos ------------------
+_versiones = {}
+_versiones_lock = threading.Lock()
+
+def tocar(*tablas):
+    """Marca tablas como modificadas (invalida lo cacheado que las lee)."""
+    with _versiones_lock:
+        for t in tablas:
+            _versiones[t] = _versiones.get(t, 0) + 1
+
+def version(*tablas):
+    return tuple(_versiones.get(t, 0) for t in tablas)
+
+
+# ------------------ Espacios ------------------
+# Cada módulo que cachea datos propios (recorridos, feed de SLA) usa su
+# propio espacio: no desaloja páginas del LRU de vistas ni mezcla contadores.
+_espacios = {}
+
+def espacio(nombre, max_items=256, ttl=30):
+    """CacheLRU con nombre (se crea la primera vez)."""
+    with _versiones_lock:
+        if nombre not in _espacios:
+            _espacios[nombre] = CacheLRU(max_items, ttl)
+        return _espacios[nombre]
+
+def stats():
+    """{espacio: stats} de todos los caches del proceso."""
+    return {nombre: c.stats() for nombre, c in sorted(_espacios.items())}
+
+
+# ------------------ Decorador para vistas ------------------
+cache = espacio("vistas")
+
+def cache_vista(*tablas, ttl=None):
+    """
+    Cachea la respuesta 200 de la vista mientras no cambien `tablas`.
+    Sin sesión, o con mensajes flash pendientes, la vista se ejecuta normal.
+    """
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            uid = session.get("usuario_id") or session.get("usuario")
+            if not uid or session.get("_flashes"):
+                return fn(*args, **kwargs)
+
+            clave = (
+                request.endpoint,
+                tuple(sorted(kwargs.items())),
+                tuple(sorted(request.args.items(multi=True))),
+                uid,
+                version(*tablas),
+            )
+            hit = cache.get(clave)
+            if hit is not None:
+                data, status, mimetype = hit
+                resp = make_response(data, status)
+                resp.mimetype = mimetype
+                resp.headers["X-Cache"] = "HIT"
+                return resp
+
+            resp = make_response(fn(*args, **kwargs))
+            if resp.status_code == 200 and not resp.direct_passthrough:
+                cache.set(clave, (resp.get_data(), resp.status_code, resp.mimetype), ttl)
+            resp.headers["X-Cache"] = "MISS"
+            return resp
+        return wrapper
+    return deco
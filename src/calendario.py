@@ -0,0 +1,157 @@
+# calendario.py
+"""
+Agenda de varios días: choques de horario y utilización por técnico.
+
+Cada ticket agendado ocupa [programada_en, programada_en + duración), con
+la duración según el tipo. Todo el rango sale de una sola consulta sobre
+idx_asistencias_prog; los choques se detectan con un barrido por técnico
+(intervalos ordenados por inicio). Para un ticket puntual alcanza con
+leer del índice los que empiezan entre inicio - MAX_DURACION y su fin.
+"""
+import os
+import time
+import unicodedata
+from datetime import datetime, timedelta
+
+from analitica import ABIERTOS
+
+# Tipos del formulario de alta (nuevo_ticket.html); otros valores usan el defecto
+DURACION_MIN = {"Instalación": 120, "Reparación": 60, "Cambio de router": 45, "Otro": 60}
+DURACION_DEFECTO = 60
+MAX_DURACION = max(list(DURACION_MIN.values()) + [DURACION_DEFECTO])
+JORNADA_MIN = int(float(os.environ.get("JORNADA_HORAS", 8)) * 60)
+MAX_DIAS = 31
+
+FMT = "%Y-%m-%d %H:%M"
+
+
+def _clave_tipo(tipo):
+    s = unicodedata.normalize("NFD", (tipo or "").strip().lower())
+    return s.encode("ascii", "ignore").decode("ascii")
+
+
+# "Instalacion", "reparación " y similares caen en el mismo tipo
+_DURACION_POR_CLAVE = {_clave_tipo(t): m for t, m in DURACION_MIN.items()}
+
+
+def duracion(tipo):
+    return timedelta(minutes=_DURACION_POR_CLAVE.get(_clave_tipo(tipo), DURACION_DEFECTO))
+
+
+def _inicio(programada_en):
+    try:
+        return datetime.strptime((programada_en or "")[:16], FMT)
+    except ValueError:
+        return None
+
+
+def cargar(conn, desde, hasta, tecnico_id=None):
+    """Tickets abiertos agendados en [desde, hasta] (días), con inicio/fin calculados."""
+    marcas = ", ".join("?" * len(ABIERTOS))
+    sql = f"""
+        SELECT a.id, a.tecnico_id, t.nombre AS tecnico, a.cliente, a.tipo, a.prioridad,
+               a.estado, a.programada_en
+          FROM asistencias a
+          LEFT JOIN tecnicos t ON t.id = a.tecnico_id
+         WHERE a.programada_en >= ? AND a.programada_en < date(?, '+1 day')
+           AND a.estado IN ({marcas})
+    """
+    params = [desde, hasta] + list(ABIERTOS)
+    if tecnico_id:
+        sql += " AND a.tecnico_id = ?"
+        params.append(tecnico_id)
+    sql += " ORDER BY a.programada_en"
+
+    eventos = []
+    for r in conn.execute(sql, params):
+        ini = _inicio(r["programada_en"])
+        if ini is None:
+            continue
+        e = dict(r)
+        e["inicio"], e["fin"] = ini, ini + duracion(r["tipo"])
+        eventos.append(e)
+    return eventos
+
+
+def conflictos(eventos):
+    """Pares (a, b) de tickets del mismo técnico que se pisan (barrido por inicio)."""
+    por_tecnico = {}
+    for e in eventos:
+        if e["tecnico_id"] is not None:
+            por_tecnico.setdefault(e["tecnico_id"], []).append(e)
+    pares = []
+    for tec, lista in por_tecnico.items():
+        lista.sort(key=lambda e: e["inicio"])
+        activos = []          # intervalos que todavía no terminaron
+        for e in lista:
+            activos = [x for x in activos if x["fin"] > e["inicio"]]
+            pares += [{"tecnico_id": tec, "a": x["id"], "b": e["id"]} for x in activos]
+            activos.append(e)
+    return pares
+
+
+def utilizacion(eventos):
+    """tecnico_id -> dia -> {minutos, pct} sobre una jornada de JORNADA_MIN."""
+    uso = {}
+    for e in eventos:
+        if e["tecnico_id"] is None:
+            continue
+        dia = e["inicio"].strftime("%Y-%m-%d")
+        d = uso.setdefault(e["tecnico_id"], {}).setdefault(dia, {"minutos": 0, "pct": 0.0})
+        d["minutos"] += int((e["fin"] - e["inicio"]).total_seconds() // 60)
+        d["pct"] = round(100.0 * d["minutos"] / JORNADA_MIN, 1)
+    return uso
+
+
+def choques_de(conn, tid, tecnico_id=None, programada_en=None):
+    """
+    Tickets abiertos del técnico que se pisan con `tid` (con los valores
+    propuestos si se pasan). Una consulta acotada al entorno del horario.
+    """
+    r = conn.execute("SELECT tecnico_id, tipo, programada_en FROM asistencias WHERE id = ?",
+                     (tid,)).fetchone()
+    if r is None:
+        return []
+    tecnico_id = tecnico_id or r["tecnico_id"]
+    ini = _inicio(programada_en or r["programada_en"])
+    if not tecnico_id or ini is None:
+        return []
+    fin = ini + duracion(r["tipo"])
+
+    marcas = ", ".join("?" * len(ABIERTOS))
+    filas = conn.execute(f"""
+        SELECT id, tipo, programada_en, cliente FROM asistencias
+         WHERE programada_en >= ? AND programada_en < ?
+           AND tecnico_id = ? AND id <> ? AND estado IN ({marcas})
+         ORDER BY programada_en
+    """, [(ini - timedelta(minutes=MAX_DURACION)).strftime(FMT), fin.strftime(FMT),
+          tecnico_id, tid] + list(ABIERTOS)).fetchall()
+
+    choques = []
+    for f in filas:
+        i = _inicio(f["programada_en"])
+        if i is not None and i < fin and i + duracion(f["tipo"]) > ini:
+            choques.append(dict(f))
+    return choques
+
+
+def semana(conn, desde, hasta=None, tecnico_id=None):
+    """Agenda del rango (por defecto 7 días) con choques y utilización."""
+    t0 = time.perf_counter()
+    d0 = datetime.strptime(desde, "%Y-%m-%d")
+    d1 = datetime.strptime(hasta, "%Y-%m-%d") if hasta else d0 + timedelta(days=6)
+    if (d1 - d0).days > MAX_DIAS:
+        raise ValueError(f"rango máximo: {MAX_DIAS} días")
+    eventos = cargar(conn, d0.strftime("%Y-%m-%d"), d1.strftime("%Y-%m-%d"), tecnico_id)
+    choques = conflictos(eventos)
+    uso = utilizacion(eventos)
+    for e in eventos:
+        e["inicio"], e["fin"] = e["inicio"].strftime(FMT), e["fin"].strftime(FMT)
+    return {
+        "desde": d0.strftime("%Y-%m-%d"),
+        "hasta": d1.strftime("%Y-%m-%d"),
+        "eventos": eventos,
+        "conflictos": choques,
+        "utilizacion": uso,
+        "ms": round((time.perf_counter() - t0) * 1000, 2),
+    }
@@ -0,0 +1,143 @@
+# cobranza.py
+"""
+Recordatorios de vencimiento de facturación (clientes.vencimiento).
+
+clientes_importar deja vencimiento como fecha ISO ('YYYY-MM-DD'), así
+que "vencen en los próximos N días" es un rango sobre
+idx_clientes_vencimiento. Los valores que no son fecha ISO (p. ej. solo
+el día del mes) quedan fuera del rango y no se avisan.
+
+Los clientes se agrupan por (barrio, técnico) — el técnico es el del
+último ticket del cliente — y cada grupo genera un mensaje en la outbox
+para ese técnico (o para la oficina si no hay técnico). La clave del
+mensaje incluye el día, así correr el job dos veces el mismo día no
+duplica avisos.
+
+Se corre una vez por día: cron de Vercel contra /api/cobranza/recordatorios
+o `python cobranza.py [ruta_db]`. El job solo encola; los manda el
+despachador de outbox.py, junto con el resto de los avisos.
+"""
+import os
+from datetime import date, timedelta
+
+import outbox
+
+VENTANA_DIAS = int(os.environ.get("COBRANZA_VENTANA_DIAS", "3"))
+DESTINO_OFICINA = os.environ.get("COBRANZA_DESTINO_OFICINA", "oficina")
+MAX_LINEAS = 200          # clientes listados por mensaje
+
+
+def por_vencer(conn, desde, hasta):
+    """Clientes activos con vencimiento en [desde, hasta], con el técnico de su último ticket."""
+    return conn.execute("""
+        SELECT c.id, c.nombre, c.apellido, c.barrio, c.telefono, c.valor, c.vencimiento,
+               (SELECT a.tecnico_id FROM asistencias a
+                 WHERE a.cliente_id = c.id AND a.tecnico_id IS NOT NULL
+                 ORDER BY a.fecha DESC LIMIT 1) AS tecnico_id
+          FROM clientes c
+         WHERE c.vencimiento >= ? AND c.vencimiento <= ?
+           AND c.activo = 1 AND IFNULL(c.exonerado, 0) = 0
+         ORDER BY c.vencimiento
+    """, (desde, hasta)).fetchall()
+
+
+def agrupar(clientes):
+    """{(barrio, tecnico_id): [clientes]}"""
+    grupos = {}
+    for c in clientes:
+        grupos.setdefault(((c["barrio"] or "").strip() or "Sin barrio", c["tecnico_id"]), []).append(c)
+    return grupos
+
+
+def _mensaje(dia, desde, hasta, barrio, tecnico, clientes):
+    lineas = [f"Vencimientos {desde} a {hasta} — {barrio} ({len(clientes)} clientes):"]
+    for c in clientes[:MAX_LINEAS]:
+        nombre = f"{c['nombre'] or ''} {c['apellido'] or ''}".strip() or f"Cliente #{c['id']}"
+        lineas.append(f"- {nombre} · {c['telefono'] or 's/tel'} · vence {c['vencimiento']}"
+                      + (f" · {c['valor']}" if c["valor"] else ""))
+    if len(clientes) > MAX_LINEAS:
+        lineas.append(f"... y {len(clientes) - MAX_LINEAS} más")
+    if tecnico and (tecnico["telefono_whatsapp"] or tecnico["telefono"]):
+        canal, destino = "whatsapp", tecnico["telefono_whatsapp"] or tecnico["telefono"]
+    else:
+        canal, destino = "oficina", DESTINO_OFICINA
+    return {
+        "canal": canal,
+        "destino": destino,
+        "asunto": f"Vencimientos {barrio}",
+        "cuerpo": "\n".join(lineas),
+        "clave": f"cobranza:{dia}:{barrio}:{tecnico['id'] if tecnico else '-'}",
+    }
+
+
+def encolar_recordatorios(conn, hoy=None, dias=VENTANA_DIAS):
+    """Encola un aviso por grupo (sin commit). Devuelve conteos."""
+    hoy = hoy or date.today()
+    desde, hasta = hoy.isoformat(), (hoy + timedelta(days=dias)).isoformat()
+    clientes = por_vencer(conn, desde, hasta)
+    grupos = agrupar(clientes)
+    tecnicos = {r["id"]: r for r in conn.execute(
+        "SELECT id, nombre, telefono, telefono_whatsapp FROM tecnicos")}
+    mensajes = [_mensaje(desde, desde, hasta, barrio, tecnicos.get(tec), lista)
+                for (barrio, tec), lista in sorted(grupos.items(), key=lambda g: (g[0][0], g[0][1] or 0))]
+    nuevos = outbox.encolar_muchos(conn, mensajes)
+    return {"desde": desde, "hasta": hasta, "clientes": len(clientes),
+            "grupos": len(grupos), "encolados": nuevos}
+
+
+def correr(conn, db_path=None, hoy=None, dias=VENTANA_DIAS):
+    """
+    Job diario: encola los recordatorios y, con db_path, despierta al
+    despachador de la outbox (no espera los envíos).
+    """
+    res = encolar_recordatorios(conn, hoy, dias)
+    conn.commit()
+    if db_path:
+        outbox.despertar(db_path)
+    return res
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    import random
+    import sqlite3
+    from migraciones import migrar
+
+    if "--bench" not in sys.argv:
+        conn = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else "/tmp/asistencias.db")
+        conn.row_factory = sqlite3.Row
+        migrar(conn)
+        print(correr(conn))
+        sys.exit(0)
+
+    args = [a for a in sys.argv[1:] if a != "--bench"]
+    n = int(args[0]) if args else 100_000
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    migrar(conn)
+    hoy = date.today()
+    conn.executemany("INSERT INTO tecnicos (nombre, telefono_whatsapp, activo) VALUES (?, ?, 1)",
+                     [(f"Tec {i}", f"5959810000{i:02d}") for i in range(20)])
+    conn.executemany("""
+        INSERT INTO clientes (nombre, barrio, telefono, valor, vencimiento, activo) VALUES (?, ?, ?, ?, ?, 1)
+    """, [(f"Cliente {i}", f"Barrio {i % 40}", f"0981{i:06d}", "130.000",
+           (hoy + timedelta(days=random.randint(-15, 45))).isoformat()) for i in range(n)])
+    conn.executemany("INSERT INTO asistencias (cliente_id, tecnico_id, fecha) VALUES (?, ?, ?)",
+                     [(random.randint(1, n), random.randint(1, 20), f"{hoy.isoformat()} 10:00:00")
+                      for _ in range(n // 2)])
+    conn.commit()
+
+    t0 = time.perf_counter()
+    plan = conn.execute("EXPLAIN QUERY PLAN " + """
+        SELECT id FROM clientes WHERE vencimiento >= ? AND vencimiento <= ?""", ("a", "b")).fetchall()
+    res = encolar_recordatorios(conn, hoy)
+    conn.commit()
+    t1 = time.perf_counter()
+    # Lo que después hace el despachador (en el bench la cola tiene solo estos avisos)
+    envio = outbox.procesar(conn, outbox.TransporteLocal())
+    t2 = time.perf_counter()
+    print(f"{n} clientes: {res['clientes']} vencen en {VENTANA_DIAS} días, {res['grupos']} grupos")
+    print(f"  consulta + agrupado + encolado: {(t1 - t0) * 1000:.1f} ms")
+    print(f"  despacho ({envio['enviados']} mensajes, transporte local): {(t2 - t1) * 1000:.1f} ms")
+    print("  plan:", plan[0][-1])
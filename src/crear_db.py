@@ -3,6 +3,9 @@ import os
 import sqlite3
 from datetime import datetime
 
+import analitica
+from migraciones import migrar, vincular_tickets_por_nombre, VERSION_ACTUAL
+
 DB_PATH = os.path.join(os.path.dirname(__file__), "asistencias.db")
 
 # Hash opcional para usuarios
@@ -24,34 +27,6 @@ def has_column(cur, table, column):
     cur.execute(f"PRAGMA table_info({table})")
     return any(r[1] == column for r in cur.fetchall())
 
-def ensure_table(cur, create_sql):
-    cur.execute(create_sql)
-
-def add_column_constant_default_if_missing(cur, table, name, type_sql, default_constant=None):
-    """
-    Agrega columna si falta; SOLO defaults CONSTANTES (no funciones como datetime('now')).
-    """
-    if not has_column(cur, table, name):
-        if default_constant is None:
-            cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_sql}")
-        else:
-            if isinstance(default_constant, str):
-                cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_sql} DEFAULT '{default_constant}'")
-            else:
-                cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_sql} DEFAULT {default_constant}")
-
-def add_timestamp_column_and_backfill_now(cur, table, name):
-    """
-    Agrega TEXT si falta y luego rellena con datetime('now') vía UPDATE
-    (evita DEFAULT con funciones que SQLite no permite en ALTER TABLE).
-    """
-    if not has_column(cur, table, name):
-        cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} TEXT")
-    cur.execute(f"UPDATE {table} SET {name} = COALESCE({name}, datetime('now'))")
-
-def ensure_index(cur, name, table, cols):
-    cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({cols})")
-
 
 # ------------------ Seeds / Migraciones ------------------
 def seed_admin(cur):
@@ -178,9 +153,9 @@ def seed_demo_map(cur):
     cur.execute("SELECT COUNT(*) FROM asistencias")
     if cur.fetchone()[0] == 0:
         cur.execute("""
-            INSERT INTO asistencias (cliente, direccion, tipo, prioridad, tecnico, problema, fecha, pppoe, lat, lng, estado, canal)
+            INSERT INTO asistencias (cliente, direccion, tipo, prioridad, tecnico, problema, fecha, pppoe, lat, lng, pos_manual, estado, canal)
             VALUES ('Cliente Demo', 'Centro Asunción', 'Soporte', 'Media', 'Juan', 'Problema de prueba',
-                    datetime('now'), 'cliente@spynet.com', -25.286, -57.645, 'pendiente', 'web')
+                    datetime('now'), 'cliente@spynet.com', -25.286, -57.645, 1, 'pendiente', 'web')
         """)
         print("✅ Ticket demo con coordenadas creado.")
     else:
@@ -190,195 +165,31 @@ def seed_demo_map(cur):
 # ------------------ Main migration ------------------
 def main():
     conn = connect()
-    cur = conn.cursor()
-
-    # ---------- Asistencias ----------
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS asistencias (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        cliente TEXT,
-        direccion TEXT,
-        tipo TEXT,
-        prioridad TEXT,
-        tecnico TEXT,
-        problema TEXT,
-        fecha TEXT,
-        pppoe TEXT
-    )""")
-    # ampliaciones
-    add_column_constant_default_if_missing(cur, "asistencias", "estado", "TEXT", default_constant="pendiente")
-    add_column_constant_default_if_missing(cur, "asistencias", "lat", "REAL")
-    add_column_constant_default_if_missing(cur, "asistencias", "lng", "REAL")
-    add_column_constant_default_if_missing(cur, "asistencias", "cliente_id", "INTEGER")
-    add_column_constant_default_if_missing(cur, "asistencias", "cedula", "TEXT")
-    add_column_constant_default_if_missing(cur, "asistencias", "programada_en", "TEXT")
-    add_column_constant_default_if_missing(cur, "asistencias", "tecnico_id", "INTEGER")
-    add_column_constant_default_if_missing(cur, "asistencias", "canal", "TEXT", default_constant="web")
-    cur.execute("UPDATE asistencias SET estado='pendiente' WHERE estado IS NULL OR TRIM(estado)=''")
-    cur.execute("UPDATE asistencias SET canal='web'      WHERE canal  IS NULL OR TRIM(canal)  =''")
 
-    # ---------- Equipos / Herramientas / Uso ----------
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS equipos (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        nombre TEXT NOT NULL,
-        tipo TEXT NOT NULL,
-        descripcion TEXT
-    )""")
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS herramientas (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        nombre TEXT NOT NULL,
-        tipo TEXT,
-        imagen TEXT
-    )""")
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS uso_items (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        item_type TEXT NOT NULL,  -- 'equipo' | 'herramienta'
-        item_id INTEGER NOT NULL,
-        tecnico TEXT NOT NULL,
-        fecha TEXT NOT NULL,
-        servicio TEXT
-    )""")
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS fotos_asistencia (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        asistencia_id INTEGER,
-        tecnico TEXT,
-        ruta_foto TEXT NOT NULL,
-        descripcion TEXT,
-        fecha TEXT
-    )""")
-
-    # ---------- Usuarios ----------
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS usuarios (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        usuario TEXT UNIQUE NOT NULL,
-        contrasena TEXT
-    )""")
-    add_column_constant_default_if_missing(cur, "usuarios", "password_hash", "TEXT")
-    add_column_constant_default_if_missing(cur, "usuarios", "email", "TEXT")
-    add_column_constant_default_if_missing(cur, "usuarios", "nombre", "TEXT")
-    add_column_constant_default_if_missing(cur, "usuarios", "rol", "TEXT", default_constant="operador")
-    add_column_constant_default_if_missing(cur, "usuarios", "foto_url", "TEXT")
-    add_column_constant_default_if_missing(cur, "usuarios", "telefono", "TEXT")
-    add_column_constant_default_if_missing(cur, "usuarios", "area", "TEXT")
-    add_column_constant_default_if_missing(cur, "usuarios", "turno", "TEXT")
-    add_column_constant_default_if_missing(cur, "usuarios", "dark_mode", "INTEGER", default_constant=0)
-    add_column_constant_default_if_missing(cur, "usuarios", "notifs", "INTEGER", default_constant=1)
-    add_timestamp_column_and_backfill_now(cur, "usuarios", "created_at")
-    add_timestamp_column_and_backfill_now(cur, "usuarios", "updated_at")
+    # Esquema: lo maneja el runner versionado (solo aplica pasos pendientes)
+    aplicadas = migrar(conn)
+    if aplicadas:
+        print(f"✅ Migraciones aplicadas: {', '.join(map(str, aplicadas))}.")
+    else:
+        print(f"ℹ️ Esquema al día (versión {VERSION_ACTUAL}).")
 
+    cur = conn.cursor()
     seed_admin(cur)
     migrated = migrate_passwords_to_hash(cur)
     if migrated:
         print(f"🔐 Migradas {migrated} contraseñas a password_hash.")
 
-    # ---------- Clientes ----------
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS clientes (
-      id           INTEGER PRIMARY KEY AUTOINCREMENT,
-      external_id  TEXT,           -- ID externo
-      nombre       TEXT,
-      referencia   TEXT,
-      barrio       TEXT,
-      telefono     TEXT,
-      situacion    TEXT,
-      exonerado    INTEGER DEFAULT 0,
-      tipo         TEXT,           -- p.ej. 'cliente'
-      valor        TEXT,           -- p.ej. '130.000'
-      tipo_valor   TEXT,           -- compatibilidad si viene junto
-      vencimiento  TEXT,
-      cedula       TEXT,
-      pppoe        TEXT,
-      activo       INTEGER DEFAULT 1
-    )""")
-    # faltantes (si ya existía)
-    add_column_constant_default_if_missing(cur, "clientes", "external_id", "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "nombre",      "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "referencia",  "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "barrio",      "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "telefono",    "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "situacion",   "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "exonerado",   "INTEGER", default_constant=0)
-    add_column_constant_default_if_missing(cur, "clientes", "tipo",        "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "valor",       "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "tipo_valor",  "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "vencimiento", "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "cedula",      "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "pppoe",       "TEXT")
-    add_column_constant_default_if_missing(cur, "clientes", "activo",      "INTEGER", default_constant=1)
-
-    # ---------- Técnicos ----------
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS tecnicos (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      nombre TEXT,
-      telefono TEXT,
-      activo INTEGER DEFAULT 1
-    )""")
-    add_column_constant_default_if_missing(cur, "tecnicos", "telefono_whatsapp", "TEXT")
-    add_column_constant_default_if_missing(cur, "tecnicos", "movil", "TEXT")
-    add_column_constant_default_if_missing(cur, "tecnicos", "tracking_token", "TEXT")
-    add_column_constant_default_if_missing(cur, "tecnicos", "lat", "REAL")
-    add_column_constant_default_if_missing(cur, "tecnicos", "lng", "REAL")
-    add_column_constant_default_if_missing(cur, "tecnicos", "pos_updated_at", "TEXT")
-
-    # ---------- Tracking de técnicos (histórico) ----------
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS tecnico_tracks (
-      id         INTEGER PRIMARY KEY AUTOINCREMENT,
-      tecnico_id INTEGER NOT NULL,
-      movil      TEXT,
-      lat        REAL NOT NULL,
-      lng        REAL NOT NULL,
-      accuracy   REAL,
-      battery    REAL,
-      source     TEXT,
-      ts         TEXT NOT NULL
-    )""")
-
-    # ---------- Posiciones puntuales (para el mapa) ----------
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS tecnico_pos (
-      id         INTEGER PRIMARY KEY AUTOINCREMENT,
-      tecnico_id INTEGER NOT NULL,
-      lat        REAL NOT NULL,
-      lng        REAL NOT NULL,
-      ts         TEXT NOT NULL
-    )""")
-
-    # ---------- ticket_fotos (opcional) ----------
-    ensure_table(cur, """
-    CREATE TABLE IF NOT EXISTS ticket_fotos (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      ticket_id INTEGER NOT NULL,
-      archivo TEXT NOT NULL,
-      created_at TEXT
-    )""")
-    add_timestamp_column_and_backfill_now(cur, "ticket_fotos", "created_at")
-
-    # ---------- Índices ----------
-    ensure_index(cur, "idx_asistencias_fecha",   "asistencias", "fecha")
-    ensure_index(cur, "idx_asistencias_estado",  "asistencias", "estado")
-    ensure_index(cur, "idx_asistencias_prog",    "asistencias", "programada_en")
-    ensure_index(cur, "idx_asistencias_tecnico", "asistencias", "tecnico_id")
-
-    ensure_index(cur, "idx_clientes_external", "clientes", "external_id")
-    ensure_index(cur, "idx_clientes_tel",      "clientes", "telefono")
-    ensure_index(cur, "idx_clientes_cedula",   "clientes", "cedula")
-    ensure_index(cur, "idx_clientes_pppoe",    "clientes", "pppoe")
-
-    ensure_index(cur, "idx_tracks_tecnico_ts",      "tecnico_tracks", "tecnico_id, ts")
-    ensure_index(cur, "idx_tecnico_pos_tecnico_ts", "tecnico_pos",    "tecnico_id, ts")
-    ensure_index(cur, "idx_uso_items_fecha",        "uso_items",      "fecha")
-
     # ---------- Seeds ----------
     seed_demo_items(cur)
     seed_demo_map(cur)
 
+    # Tickets cargados solo con nombre → cliente_id (si el nombre es único)
+    vinculados = vincular_tickets_por_nombre(conn)
+    if vinculados:
+        # Esos tickets pasan de barrio '' al de su cliente: rehacer los rollups
+        analitica.reconstruir(conn)
+        print(f"🔗 Vinculados {vinculados} tickets a su cliente.")
+
     conn.commit()
     conn.close()
     print("\n✅ Tablas, columnas e índices verificados/creados. BD lista.")
@@ -0,0 +1,210 @@
+# eventos.py
+"""
+Historial append-only de tickets (ticket_events).
+
+Cada escritura de un ticket (alta, estado, técnico, horario, cambios del
+móvil o de geocercas) agrega una fila con los valores nuevos de los campos
+tocados; nunca se actualiza ni se borra. Se escribe desde
+sincronizacion.marcar(), que ya es el paso obligado de todas esas rutas.
+
+- id es AUTOINCREMENT: sirve de cursor global ("qué cambió desde X") para
+  caches y vistas en vivo (desde()).
+- (ticket_id, id) indexa la línea de tiempo de un ticket.
+- Además de "alta" y "cambio" hay eventos de marca (MARCAS, p. ej.
+  "vencido" del vigilante de SLA): registran un hecho con sus datos pero
+  no cambian los valores del ticket.
+- replay() pliega los eventos en un acumulador (valores actuales, tiempo
+  en cada estado, primera vez en cada estado) del que salen las métricas
+  de SLA. Cada SNAPSHOT_CADA eventos de un ticket se guarda el acumulador
+  en ticket_snapshots, así un replay lee a lo sumo ese número de eventos.
+"""
+import json
+from datetime import datetime
+
+from analitica import ABIERTOS
+
+FMT = "%Y-%m-%d %H:%M:%S"
+SNAPSHOT_CADA = 25
+LIMITE = 500
+
+# campos de asistencias que se historian; "alta" guarda CAMPOS_ALTA
+CAMPOS = ("estado", "tecnico_id", "programada_en", "prioridad", "problema", "lat", "lng")
+CAMPOS_ALTA = ("estado", "tecnico_id", "programada_en", "prioridad")
+# tipo de evento de marca -> columnas de asistencias que guarda
+MARCAS = {"vencido": ("due_at",)}
+
+
+def _segundos(ts):
+    try:
+        return datetime.fromisoformat(str(ts)[:19]).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def _en_bloques(ids, n=500):
+    ids = list(ids)
+    for i in range(0, len(ids), n):
+        yield ids[i:i + n]
+
+
+# ===========================
+#  Escritura
+# ===========================
+def registrar(conn, tids, campos, ts=None, origen="web", usuario=None):
+    """
+    Agrega un evento por ticket con los valores actuales de `campos` (leídos
+    de asistencias, así que se llama después del UPDATE). campos=["vencido"]
+    (o otra de MARCAS) registra ese evento de marca. No hace commit.
+    """
+    tids = list(tids)
+    marca = next((c for c in campos if c in MARCAS), None)
+    if marca:
+        tipo, cols = marca, MARCAS[marca]
+    elif "alta" in campos:
+        tipo, cols = "alta", CAMPOS_ALTA
+    else:
+        tipo, cols = "cambio", [c for c in CAMPOS if c in campos]
+    if not tids or not cols:
+        return
+    ts = ts or datetime.now().strftime(FMT)
+
+    filas = []
+    for parte in _en_bloques(tids):
+        for r in conn.execute(
+                f"SELECT id, {', '.join(cols)} FROM asistencias WHERE id IN ({', '.join('?' * len(parte))})",
+                parte):
+            datos = dict(zip(cols, tuple(r)[1:]))
+            filas.append((r[0], tipo, json.dumps(datos, ensure_ascii=False), origen, usuario, ts))
+    conn.executemany("""
+        INSERT INTO ticket_events (ticket_id, tipo, datos, origen, usuario, ts)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, filas)
+    _snapshots(conn, [f[0] for f in filas])
+
+
+def _snapshots(conn, tids):
+    """Snapshot de los tickets que juntaron SNAPSHOT_CADA eventos desde el último."""
+    for parte in _en_bloques(tids, 400):
+        marcas = ", ".join("?" * len(parte))
+        vencidos = [r[0] for r in conn.execute(f"""
+            SELECT e.ticket_id
+              FROM ticket_events e
+              LEFT JOIN (SELECT ticket_id, MAX(evento_id) AS ultimo FROM ticket_snapshots
+                          WHERE ticket_id IN ({marcas}) GROUP BY ticket_id) s
+                     ON s.ticket_id = e.ticket_id
+             WHERE e.ticket_id IN ({marcas}) AND e.id > IFNULL(s.ultimo, 0)
+             GROUP BY e.ticket_id
+            HAVING COUNT(*) >= ?
+        """, parte + parte + [SNAPSHOT_CADA])]
+        for tid in vencidos:
+            acum = replay(conn, tid)
+            conn.execute("INSERT OR REPLACE INTO ticket_snapshots (ticket_id, evento_id, estado) VALUES (?, ?, ?)",
+                         (tid, acum["evento_id"], json.dumps(acum, ensure_ascii=False)))
+
+
+# ===========================
+#  Replay
+# ===========================
+def _vacio():
+    return {"evento_id": 0, "eventos": 0, "valores": {}, "alta": None,
+            "estado_desde": None, "en_estado": {}, "primera": {}}
+
+
+def plegar(acum, tipo, datos, ts, evento_id):
+    """Aplica un evento al acumulador (lo modifica y lo devuelve)."""
+    if tipo in MARCAS:
+        # Un hecho, no un cambio del ticket: no toca valores ni estados
+        acum.setdefault("marcas", {})[tipo] = ts
+        acum["evento_id"] = evento_id
+        acum["eventos"] += 1
+        return acum
+    previo = acum["valores"].get("estado")
+    nuevo = datos.get("estado", previo)
+    if tipo == "alta" and acum["alta"] is None:
+        acum["alta"] = ts
+    if nuevo is not None and (nuevo != previo or acum["estado_desde"] is None):
+        if previo is not None and acum["estado_desde"]:
+            a, b = _segundos(acum["estado_desde"]), _segundos(ts)
+            if a is not None and b is not None:
+                acum["en_estado"][previo] = acum["en_estado"].get(previo, 0) + max(0.0, b - a)
+        acum["estado_desde"] = ts
+        acum["primera"].setdefault(nuevo, ts)
+    acum["valores"].update(datos)
+    acum["evento_id"] = evento_id
+    acum["eventos"] += 1
+    return acum
+
+
+def replay(conn, tid, hasta=None):
+    """Acumulador del ticket hasta el evento `hasta` (inclusive; None = todos)."""
+    hasta = hasta if hasta is not None else 2 ** 62
+    snap = conn.execute("""
+        SELECT estado FROM ticket_snapshots
+         WHERE ticket_id = ? AND evento_id <= ? ORDER BY evento_id DESC LIMIT 1
+    """, (tid, hasta)).fetchone()
+    acum = json.loads(snap[0]) if snap else _vacio()
+    for eid, tipo, datos, ts in conn.execute("""
+        SELECT id, tipo, datos, ts FROM ticket_events
+         WHERE ticket_id = ? AND id > ? AND id <= ? ORDER BY id
+    """, (tid, acum["evento_id"], hasta)):
+        plegar(acum, tipo, json.loads(datos), ts, eid)
+    return acum
+
+
+def sla(conn, tid, ahora=None):
+    """Tiempos del ticket en minutos: respuesta, resolución y permanencia por estado."""
+    acum = replay(conn, tid)
+    if not acum["eventos"]:
+        return None
+    ahora = ahora or datetime.now().strftime(FMT)
+    en_estado = dict(acum["en_estado"])
+    actual = acum["valores"].get("estado")
+    if actual in ABIERTOS and acum["estado_desde"]:
+        a, b = _segundos(acum["estado_desde"]), _segundos(ahora)
+        if a is not None and b is not None:
+            en_estado[actual] = en_estado.get(actual, 0) + max(0.0, b - a)
+
+    def minutos_hasta(estado):
+        a, b = _segundos(acum["alta"]), _segundos(acum["primera"].get(estado))
+        return round((b - a) / 60.0, 1) if a is not None and b is not None else None
+
+    return {
+        "ticket_id": tid,
+        "estado": actual,
+        "alta": acum["alta"],
+        "respuesta_min": minutos_hasta("en_progreso"),
+        "resolucion_min": minutos_hasta("resuelto"),
+        "en_estado_min": {e: round(s / 60.0, 1) for e, s in en_estado.items()},
+        "eventos": acum["eventos"],
+    }
+
+
+# ===========================
+#  Lectura
+# ===========================
+def _evento(r):
+    return {"id": r[0], "ticket_id": r[1], "tipo": r[2], "datos": json.loads(r[3]),
+            "origen": r[4], "usuario": r[5], "ts": r[6]}
+
+
+def linea_de_tiempo(conn, tid, limite=LIMITE):
+    """Eventos del ticket, del más viejo al más nuevo."""
+    return [_evento(r) for r in conn.execute("""
+        SELECT id, ticket_id, tipo, datos, origen, usuario, ts FROM ticket_events
+         WHERE ticket_id = ? ORDER BY id LIMIT ?
+    """, (tid, limite))]
+
+
+def ultimo(conn):
+    return conn.execute("SELECT IFNULL(MAX(id), 0) FROM ticket_events").fetchone()[0]
+
+
+def desde(conn, cursor=0, limite=LIMITE):
+    """Cola global: eventos con id > cursor. {"cursor", "eventos", "mas"}."""
+    filas = conn.execute("""
+        SELECT id, ticket_id, tipo, datos, origen, usuario, ts FROM ticket_events
+         WHERE id > ? ORDER BY id LIMIT ?
+    """, (cursor or 0, limite + 1)).fetchall()
+    mas = len(filas) > limite
+    eventos = [_evento(r) for r in filas[:limite]]
+    return {"cursor": eventos[-1]["id"] if eventos else (cursor or 0), "eventos": eventos, "mas": mas}
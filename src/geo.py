@@ -0,0 +1,102 @@
+# geo.py
+"""
+Utilidades geográficas: distancia haversine e índice espacial en grilla.
+
+IndiceGrilla reparte puntos en celdas de `celda` grados. Buscar los k más
+cercanos recorre anillos de celdas alrededor del punto y corta apenas el
+anillo siguiente ya no puede mejorar el resultado, así el costo depende de
+la densidad local y no del total de puntos.
+"""
+import math
+
+RADIO_TIERRA_KM = 6371.0088
+KM_POR_GRADO = 111.32
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class IndiceGrilla:
+    def __init__(self, celda=0.05):   # ~5 km
+        self.celda = celda
+        self._celdas = {}     # (i, j) -> {clave: (lat, lng)}
+        self._pos = {}        # clave -> (i, j)
+
+    def __len__(self):
+        return len(self._pos)
+
+    def __contains__(self, clave):
+        return clave in self._pos
+
+    def _ij(self, lat, lng):
+        return (math.floor(lat / self.celda), math.floor(lng / self.celda))
+
+    def insertar(self, clave, lat, lng):
+        self.quitar(clave)
+        ij = self._ij(lat, lng)
+        self._celdas.setdefault(ij, {})[clave] = (lat, lng)
+        self._pos[clave] = ij
+
+    def quitar(self, clave):
+        ij = self._pos.pop(clave, None)
+        if ij is not None:
+            celda = self._celdas[ij]
+            celda.pop(clave, None)
+            if not celda:
+                del self._celdas[ij]
+
+    def _anillo(self, ci, cj, r):
+        if r == 0:
+            yield (ci, cj)
+            return
+        for i in range(ci - r, ci + r + 1):
+            yield (i, cj - r)
+            yield (i, cj + r)
+        for j in range(cj - r + 1, cj + r):
+            yield (ci - r, j)
+            yield (ci + r, j)
+
+    def cercanos(self, lat, lng, k=5, radio_max_km=None):
+        """Lista de (dist_km, clave, lat, lng) ordenada, con hasta k elementos."""
+        if not self._pos:
+            return []
+        ci, cj = self._ij(lat, lng)
+        # ancho mínimo de una celda en km (lng se achica con la latitud)
+        km_celda = self.celda * KM_POR_GRADO * max(0.1, math.cos(math.radians(min(89.0, abs(lat) + 1))))
+        max_r = max(max(abs(i - ci), abs(j - cj)) for i, j in self._celdas)
+
+        hallados = []
+        for r in range(0, max_r + 1):
+            for ij in self._anillo(ci, cj, r):
+                for clave, (plat, plng) in self._celdas.get(ij, {}).items():
+                    d = haversine_km(lat, lng, plat, plng)
+                    if radio_max_km is None or d <= radio_max_km:
+                        hallados.append((d, clave, plat, plng))
+            cota = r * km_celda   # lo no visitado está al menos a esta distancia
+            if radio_max_km is not None and cota > radio_max_km:
+                break
+            if len(hallados) >= k:
+                hallados.sort(key=lambda h: h[0])
+                del hallados[k:]
+                if hallados[-1][0] <= cota:
+                    break
+        hallados.sort(key=lambda h: h[0])
+        return hallados[:k]
+
+    def en_caja(self, sur, oeste, norte, este):
+        """Itera (clave, lat, lng) dentro del rectángulo (solo visita sus celdas)."""
+        i0, j0 = self._ij(sur, oeste)
+        i1, j1 = self._ij(norte, este)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._celdas):
+            celdas = [ij for ij in self._celdas if i0 <= ij[0] <= i1 and j0 <= ij[1] <= j1]
+        else:
+            celdas = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+        for ij in celdas:
+            for clave, (lat, lng) in self._celdas.get(ij, {}).items():
+                if sur <= lat <= norte and oeste <= lng <= este:
+                    yield clave, lat, lng
@@ -0,0 +1,143 @@
+# geocercas.py
+"""
+Llegada/salida automática de técnicos a sus tickets.
+
+Cada fix GPS se compara contra un círculo alrededor de cada ticket abierto
+y geolocalizado del técnico. Esos tickets se guardan en memoria por
+técnico y se recargan (solo los de ese técnico) cuando cambian
+asistencias/clientes, así evaluar un fix cuesta O(tickets abiertos del
+técnico) y no toca la BD salvo que haya un evento. Las versiones de cache.py
+son por proceso: lo que escribe otra instancia se ve al vencer TTL_ESTADO_S.
+
+Se usa histéresis (se entra a RADIO_ENTRADA_KM, se sale recién pasando
+RADIO_SALIDA_KM) para que el ruido del GPS en el borde no genere eventos
+repetidos. Los eventos quedan en geocerca_eventos; con GEOCERCA_INICIAR=1
+la llegada pasa el ticket de 'pendiente' a 'en_progreso'.
+
+evaluar() trabaja sobre una copia de "dentro"; el estado compartido se
+actualiza con confirmar(), bajo el lock y después del commit, así una
+transacción revertida no deja al técnico "dentro" sin evento en la BD.
+"""
+import os
+import time
+import threading
+
+import analitica
+from geo import haversine_km
+from cache import tocar, version as version_datos
+from sincronizacion import marcar
+
+RADIO_ENTRADA_KM = 0.10
+RADIO_SALIDA_KM = 0.15
+INICIAR_AL_LLEGAR = os.environ.get("GEOCERCA_INICIAR", "0") == "1"
+TTL_ESTADO_S = int(os.environ.get("GEOCERCA_TTL", "60"))   # recarga aunque no cambie nada acá
+
+_lock = threading.Lock()
+_por_tecnico = {}      # tecnico_id -> {"version", "cargado", "tickets": {tid: (lat, lng)}, "dentro": set()}
+
+
+def _cargar(conn, tecnico_id):
+    marcas = ", ".join("?" * len(analitica.ABIERTOS))
+    tickets = {}
+    for tid, lat, lng in conn.execute(f"""
+        SELECT a.id, COALESCE(a.lat, c.lat), COALESCE(a.lng, c.lng)
+          FROM asistencias a
+          LEFT JOIN clientes c ON c.id = a.cliente_id
+         WHERE a.tecnico_id = ? AND a.estado IN ({marcas})
+    """, [tecnico_id] + list(analitica.ABIERTOS)):
+        if lat is not None and lng is not None:
+            tickets[tid] = (lat, lng)
+
+    # Dónde estaba según el último evento de cada ticket (sobrevive reinicios)
+    dentro = {tid for tid, tipo in conn.execute("""
+        SELECT ticket_id, tipo FROM geocerca_eventos
+         WHERE id IN (SELECT MAX(id) FROM geocerca_eventos WHERE tecnico_id = ? GROUP BY ticket_id)
+    """, (tecnico_id,)) if tipo == "llegada" and tid in tickets}
+    return tickets, dentro
+
+
+def _estado(conn, tecnico_id):
+    v = version_datos("asistencias", "clientes")
+    ahora = time.monotonic()
+    with _lock:
+        e = _por_tecnico.get(tecnico_id)
+        if e is not None and e["version"] == v and ahora - e["cargado"] < TTL_ESTADO_S:
+            return e
+    tickets, dentro = _cargar(conn, tecnico_id)
+    e = {"version": v, "cargado": ahora, "tickets": tickets, "dentro": dentro}
+    with _lock:
+        _por_tecnico[tecnico_id] = e
+    return e
+
+
+def dentro_actual(conn, tecnico_id):
+    """Copia de los tickets donde está el técnico, para evaluar varios fixes seguidos."""
+    e = _estado(conn, int(tecnico_id))
+    with _lock:
+        return set(e["dentro"])
+
+
+def evaluar(conn, tecnico_id, lat, lng, ts, dentro=None):
+    """
+    Procesa un fix. Devuelve la lista de eventos generados
+    [{"ticket_id", "tipo": "llegada"|"salida", "dist_km"}]. No hace commit ni
+    toca el estado compartido: `dentro` (de dentro_actual(), se modifica) es
+    la copia sobre la que avanza un lote; después del commit, confirmar().
+    """
+    tecnico_id = int(tecnico_id)
+    e = _estado(conn, tecnico_id)
+    if dentro is None:
+        with _lock:
+            dentro = set(e["dentro"])
+    eventos = []
+    for tid, (tlat, tlng) in e["tickets"].items():
+        d = haversine_km(lat, lng, tlat, tlng)
+        if tid in dentro:
+            if d > RADIO_SALIDA_KM:
+                dentro.discard(tid)
+                eventos.append({"ticket_id": tid, "tipo": "salida", "dist_km": round(d, 3)})
+        elif d <= RADIO_ENTRADA_KM:
+            dentro.add(tid)
+            eventos.append({"ticket_id": tid, "tipo": "llegada", "dist_km": round(d, 3)})
+
+    if not eventos:
+        return eventos
+
+    conn.executemany("""
+        INSERT INTO geocerca_eventos (tecnico_id, ticket_id, tipo, lat, lng, ts)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(tecnico_id, ev["ticket_id"], ev["tipo"], lat, lng, ts) for ev in eventos])
+
+    if INICIAR_AL_LLEGAR:
+        for ev in eventos:
+            if ev["tipo"] != "llegada":
+                continue
+            antes = analitica.fila_ticket(conn, ev["ticket_id"])
+            cur = conn.execute("UPDATE asistencias SET estado = 'en_progreso' WHERE id = ? AND estado = 'pendiente'",
+                               (ev["ticket_id"],))
+            if cur.rowcount:
+                analitica.mover(conn, antes, analitica.fila_ticket(conn, ev["ticket_id"]))
+                marcar(conn, ev["ticket_id"], ["estado"], origen="geocerca")
+                ev["iniciado"] = True
+    return eventos
+
+
+def confirmar(tecnico_id, eventos):
+    """Después del commit: aplica los eventos al estado en memoria del técnico."""
+    tecnico_id = int(tecnico_id)
+    iniciados = any(ev.get("iniciado") for ev in eventos)
+    if iniciados:
+        tocar("asistencias")
+    with _lock:
+        e = _por_tecnico.get(tecnico_id)
+        if e is None:
+            return                     # se recarga desde la BD, que ya tiene los eventos
+        for ev in eventos:
+            if ev["tipo"] == "llegada":
+                e["dentro"].add(ev["ticket_id"])
+            else:
+                e["dentro"].discard(ev["ticket_id"])
+        if iniciados:
+            # El índice de este técnico sigue valiendo: en_progreso sigue abierto
+            e["version"] = version_datos("asistencias", "clientes")
+
@@ -0,0 +1,385 @@
+# geocodificacion.py
+"""
+Geocodificación de direcciones de clientes y tickets.
+
+- normalizar(): clave canónica de una dirección (minúsculas, sin tildes ni
+  puntuación, abreviaturas expandidas). Dos direcciones escritas distinto
+  pero equivalentes comparten clave y se resuelven una sola vez.
+- geocache: tabla persistente clave -> (lat, lng). También guarda los "no
+  encontrado" para no volver a preguntar hasta REINTENTO_DIAS.
+- Proveedores intercambiables (GEOCODER=gazetteer|nominatim). El gazetteer
+  local es offline: lee un CSV (GEOCODER_GAZETTEER) y aprende de las filas
+  que ya tienen coordenadas cargadas a mano.
+- pendientes(): completa lat/lng de clientes y asistencias que no tienen,
+  agrupando por clave. encolar(db_path, tabla, id) geocodifica en un thread
+  aparte solo la fila que cambió (crear un ticket nunca espera a la
+  geocodificación); encolar(db_path) sin fila hace la pasada completa.
+"""
+import os
+import re
+import csv
+import json
+import time
+import sqlite3
+import logging
+import threading
+import unicodedata
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+log = logging.getLogger(__name__)
+
+LOTE = 200
+REINTENTO_DIAS = 30
+MAX_PALABRAS_LUGAR = 6    # subfrases más largas no se buscan en el gazetteer
+MIN_LARGO_LUGAR = 4       # subfrases más cortas (letras) no se buscan
+
+ABREVIATURAS = {
+    "av": "avenida", "avda": "avenida", "cl": "calle",
+    "esq": "esquina", "nro": "numero", "n": "numero", "no": "numero",
+    "bo": "barrio", "bto": "barrio", "gral": "general", "tte": "teniente",
+    "cnel": "coronel", "mcal": "mariscal", "sta": "santa", "sto": "santo",
+}
+# Palabras que solas no identifican un lugar ("calle", "barrio", "de"...)
+GENERICAS = set(ABREVIATURAS.values()) | {
+    "de", "del", "la", "las", "el", "los", "y", "e", "casi", "entre", "frente",
+    "san", "ruta", "km", "casa", "lote", "manzana", "edificio", "piso", "dpto",
+}
+
+
+def normalizar(direccion):
+    """Clave canónica de una dirección ('' si no hay nada útil)."""
+    s = unicodedata.normalize("NFD", (direccion or "").lower())
+    s = s.encode("ascii", "ignore").decode("ascii")
+    s = re.sub(r"[^a-z0-9]+", " ", s)
+    return " ".join(ABREVIATURAS.get(p, p) for p in s.split())
+
+
+# ===========================
+#  Proveedores
+# ===========================
+class Gazetteer:
+    """
+    Proveedor offline: coincidencia exacta o el lugar conocido más largo
+    contenido en la dirección (palabras completas; subfrases de solo
+    palabras genéricas o números, o de menos de MIN_LARGO_LUGAR letras, no
+    cuentan).
+    """
+    nombre = "gazetteer"
+
+    def __init__(self, entradas=None):
+        self.entradas = {}
+        for texto, lat, lng in entradas or []:
+            self.agregar(texto, lat, lng)
+
+    def agregar(self, texto, lat, lng):
+        clave = normalizar(texto)
+        if clave:
+            self.entradas[clave] = (float(lat), float(lng))
+
+    @classmethod
+    def desde_csv(cls, ruta):
+        """CSV con columnas direccion,lat,lng (p. ej. centros de barrio)."""
+        g = cls()
+        with open(ruta, newline="", encoding="utf-8") as f:
+            for fila in csv.DictReader(f):
+                g.agregar(fila["direccion"], fila["lat"], fila["lng"])
+        return g
+
+    def buscar(self, clave):
+        if clave in self.entradas:
+            return self.entradas[clave]
+        # Subfrases de la dirección, de la más larga a la más corta (costo según
+        # las palabras de la dirección, no según el tamaño del gazetteer)
+        palabras = clave.split()
+        utiles = [p not in GENERICAS and not p.isdigit() for p in palabras]
+        for largo in range(min(len(palabras), MAX_PALABRAS_LUGAR), 0, -1):
+            for i in range(len(palabras) - largo + 1):
+                if not any(utiles[i:i + largo]):
+                    continue
+                frase = " ".join(palabras[i:i + largo])
+                if len(frase) < MIN_LARGO_LUGAR:
+                    continue
+                pos = self.entradas.get(frase)
+                if pos:
+                    return pos
+        return None
+
+
+class Nominatim:
+    """Proveedor online (OpenStreetMap). Respeta 1 pedido por segundo."""
+    nombre = "nominatim"
+    URL = "https://nominatim.openstreetmap.org/search"
+
+    def __init__(self, pais=None, agente="spynet-asistencias"):
+        self.pais = pais or os.environ.get("GEOCODER_PAIS")
+        self.agente = agente
+        self._ultimo = 0.0
+
+    def buscar(self, clave):
+        espera = 1.0 - (time.monotonic() - self._ultimo)
+        if espera > 0:
+            time.sleep(espera)
+        params = {"q": clave, "format": "json", "limit": 1}
+        if self.pais:
+            params["countrycodes"] = self.pais
+        req = Request(f"{self.URL}?{urlencode(params)}", headers={"User-Agent": self.agente})
+        try:
+            with urlopen(req, timeout=10) as r:
+                datos = json.load(r)
+        finally:
+            self._ultimo = time.monotonic()
+        return (float(datos[0]["lat"]), float(datos[0]["lon"])) if datos else None
+
+
+# Cualquier clase con `nombre` y buscar(clave) -> (lat, lng) | None sirve de proveedor
+PROVEEDORES = {"gazetteer": Gazetteer, "nominatim": Nominatim}
+
+
+def proveedor_por_defecto():
+    tipo = os.environ.get("GEOCODER", "gazetteer")
+    ruta = os.environ.get("GEOCODER_GAZETTEER")
+    if tipo == "gazetteer" and ruta and os.path.exists(ruta):
+        return Gazetteer.desde_csv(ruta)
+    return PROVEEDORES.get(tipo, Gazetteer)()
+
+
+# ===========================
+#  Cache y proceso por lotes
+# ===========================
+def _texto_cliente():
+    # Los clientes suelen tener solo referencia/barrio: se arma una dirección con lo que haya
+    return ("TRIM(COALESCE(NULLIF(direccion,''), referencia, '') || "
+            "CASE WHEN IFNULL(barrio,'') <> '' THEN ' ' || barrio ELSE '' END)")
+
+
+def desde_cache(conn, direccion):
+    """(lat, lng) si la dirección ya fue resuelta; una lectura por clave primaria."""
+    r = conn.execute("SELECT lat, lng FROM geocache WHERE clave = ? AND estado = 'ok'",
+                     (normalizar(direccion),)).fetchone()
+    return (r[0], r[1]) if r else None
+
+
+def _fuentes():
+    return {"clientes": _texto_cliente(), "asistencias": "direccion"}
+
+
+def aprender(conn, proveedor, filas=None):
+    """
+    Las coordenadas cargadas a mano (pos_manual = 1) alimentan al gazetteer y
+    a la cache. Las que vinieron de la propia cache no: con una dirección
+    editada guardarían la posición vieja bajo la clave nueva.
+    filas={tabla: [ids]} aprende solo de esas filas; None recorre todo.
+    """
+    ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if filas is None:
+        filas = conn.execute(f"""
+            SELECT direccion, lat, lng FROM asistencias
+             WHERE pos_manual = 1 AND lat IS NOT NULL AND lng IS NOT NULL
+               AND IFNULL(direccion,'') <> ''
+            UNION ALL
+            SELECT {_texto_cliente()}, lat, lng FROM clientes
+             WHERE pos_manual = 1 AND lat IS NOT NULL AND lng IS NOT NULL
+        """).fetchall()
+    else:
+        filas = [r for tabla, ids in filas.items() for r in conn.execute(f"""
+            SELECT {_fuentes()[tabla]}, lat, lng FROM {tabla}
+             WHERE id IN ({", ".join("?" * len(ids))}) AND pos_manual = 1
+               AND lat IS NOT NULL AND lng IS NOT NULL
+        """, list(ids))]
+    nuevas = {}
+    for texto, lat, lng in filas:
+        clave = normalizar(texto)
+        if clave:
+            nuevas[clave] = (clave, lat, lng, "manual", "ok", ahora)
+            if isinstance(proveedor, Gazetteer):
+                proveedor.agregar(clave, lat, lng)
+    conn.executemany("""
+        INSERT INTO geocache (clave, lat, lng, proveedor, estado, actualizado)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(clave) DO UPDATE SET lat = excluded.lat, lng = excluded.lng,
+            proveedor = excluded.proveedor, estado = excluded.estado,
+            actualizado = excluded.actualizado
+         WHERE geocache.estado <> 'ok'
+    """, list(nuevas.values()))
+
+
+def resolver(conn, proveedor, claves):
+    """
+    clave -> (lat, lng) para las claves pedidas. Primero la cache; lo que falta
+    se pregunta al proveedor una sola vez por clave y se guarda.
+    """
+    claves = {c for c in claves if c}
+    hallado, faltan = {}, set(claves)
+    lista = list(claves)
+    limite = (datetime.now() - timedelta(days=REINTENTO_DIAS)).strftime("%Y-%m-%d %H:%M:%S")
+    for i in range(0, len(lista), 500):
+        parte = lista[i:i + 500]
+        for clave, lat, lng, estado, actualizado in conn.execute(f"""
+            SELECT clave, lat, lng, estado, actualizado FROM geocache
+             WHERE clave IN ({", ".join("?" * len(parte))})
+        """, parte):
+            if estado == "ok":
+                hallado[clave] = (lat, lng)
+                faltan.discard(clave)
+            elif actualizado >= limite:
+                faltan.discard(clave)      # no encontrado hace poco: no reintentar
+
+    ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for clave in faltan:
+        try:
+            pos = proveedor.buscar(clave)
+        except Exception:
+            log.warning("Geocodificación falló para %r", clave, exc_info=True)
+            continue                       # error transitorio: no se cachea
+        conn.execute("""
+            INSERT INTO geocache (clave, lat, lng, proveedor, estado, actualizado)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(clave) DO UPDATE SET lat = excluded.lat, lng = excluded.lng,
+                proveedor = excluded.proveedor, estado = excluded.estado,
+                actualizado = excluded.actualizado
+        """, (clave, pos[0] if pos else None, pos[1] if pos else None,
+              proveedor.nombre, "ok" if pos else "no_encontrado", ahora))
+        if pos:
+            hallado[clave] = pos
+    return hallado
+
+
+def _completar(conn, proveedor, tabla, filas):
+    """Resuelve [(id, texto)] de `tabla` agrupando por clave. Devuelve filas actualizadas."""
+    por_clave = {}
+    for rid, t in filas:
+        por_clave.setdefault(normalizar(t), []).append(rid)
+    por_clave.pop("", None)
+    hallado = resolver(conn, proveedor, por_clave)
+    cambios = [(lat, lng, rid)
+               for clave, (lat, lng) in hallado.items() for rid in por_clave[clave]]
+    conn.executemany(f"UPDATE {tabla} SET lat = ?, lng = ? WHERE id = ? AND lat IS NULL", cambios)
+    return len(cambios)
+
+
+def _tocar(actualizados):
+    if any(actualizados.values()):
+        from cache import tocar
+        tocar("clientes", "asistencias")
+    return actualizados
+
+
+def pendientes(conn, proveedor=None, lote=LOTE):
+    """
+    Completa lat/lng de clientes y asistencias sin coordenadas. Recorre por id
+    en lotes y commitea cada lote. Devuelve {"clientes": n, "asistencias": n}.
+    """
+    proveedor = proveedor or proveedor_por_defecto()
+    aprender(conn, proveedor)
+    conn.commit()
+
+    actualizados = {}
+    for tabla, texto in _fuentes().items():
+        total, ultimo = 0, 0
+        while True:
+            filas = conn.execute(f"""
+                SELECT id, {texto} FROM {tabla}
+                 WHERE (lat IS NULL OR lng IS NULL) AND id > ?
+                 ORDER BY id LIMIT ?
+            """, (ultimo, lote)).fetchall()
+            if not filas:
+                break
+            ultimo = filas[-1][0]
+            total += _completar(conn, proveedor, tabla, filas)
+            conn.commit()
+        actualizados[tabla] = total
+    return _tocar(actualizados)
+
+
+def geocodificar(conn, proveedor, filas):
+    """
+    Como pendientes() pero solo para filas={tabla: [ids]} (las que se acaban
+    de crear o editar): aprende de las que traen coordenadas y resuelve las
+    que no tienen.
+    """
+    aprender(conn, proveedor, filas)
+    actualizados = {}
+    for tabla, ids in filas.items():
+        ids = list(ids)
+        total = 0
+        for i in range(0, len(ids), LOTE):
+            parte = ids[i:i + LOTE]
+            sin_pos = conn.execute(f"""
+                SELECT id, {_fuentes()[tabla]} FROM {tabla}
+                 WHERE id IN ({", ".join("?" * len(parte))}) AND (lat IS NULL OR lng IS NULL)
+            """, parte).fetchall()
+            total += _completar(conn, proveedor, tabla, sin_pos)
+        actualizados[tabla] = total
+    conn.commit()
+    return _tocar(actualizados)
+
+
+# ===========================
+#  Segundo plano
+# ===========================
+_lock = threading.Lock()
+_estado = {"corriendo": False, "completa": False, "ultimo": None}
+_cola = {"clientes": set(), "asistencias": set()}
+_proveedor = None         # se conserva entre vueltas (el gazetteer ya aprendido)
+
+
+def _trabajar(db_path):
+    global _proveedor
+    while True:
+        with _lock:
+            completa, _estado["completa"] = _estado["completa"], False
+            filas = {t: sorted(ids) for t, ids in _cola.items() if ids}
+            for ids in _cola.values():
+                ids.clear()
+            if not completa and not filas:
+                _estado["corriendo"] = False
+                return
+        try:
+            conn = sqlite3.connect(db_path, timeout=30)
+            try:
+                if _proveedor is None:
+                    # Primera vuelta del proceso: la pasada completa aprende de todo
+                    _proveedor, completa = proveedor_por_defecto(), True
+                if completa:
+                    _estado["ultimo"] = pendientes(conn, _proveedor)
+                else:
+                    _estado["ultimo"] = geocodificar(conn, _proveedor, filas)
+            finally:
+                conn.close()
+        except Exception:
+            log.exception("Geocodificación en segundo plano falló")
+
+
+def encolar(db_path, tabla=None, rid=None):
+    """
+    Geocodifica en segundo plano la fila (tabla, rid), o todo lo pendiente si
+    no se indica fila. No bloquea: si ya hay una vuelta corriendo, la fila
+    queda en la cola para la siguiente.
+    """
+    with _lock:
+        if tabla is None:
+            _estado["completa"] = True
+        else:
+            _cola[tabla].add(rid)
+        if _estado["corriendo"]:
+            return
+        _estado["corriendo"] = True
+    threading.Thread(target=_trabajar, args=(db_path,), daemon=True,
+                     name="geocodificacion").start()
+
+
+def estado():
+    with _lock:
+        en_cola = sum(len(ids) for ids in _cola.values())
+    return {"corriendo": _estado["corriendo"], "en_cola": en_cola, "ultimo": _estado["ultimo"]}
+
+
+if __name__ == "__main__":
+    import sys
+    conn = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else "/tmp/asistencias.db")
+    from migraciones import migrar
+    migrar(conn)
+    print(pendientes(conn))
+    conn.close()
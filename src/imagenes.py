@@ -0,0 +1,124 @@
+# imagenes.py
+"""
+Pipeline de subida de imágenes.
+
+- guardar_subida(): copia el upload a disco en bloques mientras calcula su
+  SHA-256; el nombre final es el hash, así dos fotos idénticas ocupan un
+  solo archivo (deduplicación).
+- Variantes 'thumb' y 'web' (JPEG redimensionado) se generan fuera del
+  request en un pool de threads. Mientras no existan, ruta_variante()
+  devuelve el original.
+"""
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Pillow es opcional: sin él se guardan originales y no hay variantes
+try:
+    from PIL import Image, ImageOps
+    CAN_RESIZE = True
+except Exception:
+    CAN_RESIZE = False
+
+CHUNK = 64 * 1024
+VARIANTES = {"thumb": 320, "web": 1280}   # lado mayor en px
+DIR_VARIANTES = "variantes"
+
+_pool = None
+_pool_lock = threading.Lock()
+_pendientes = set()
+_fallidos = set()     # archivos que Pillow no pudo abrir: no se reintentan
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="imagenes")
+        return _pool
+
+
+def guardar_subida(file_storage, carpeta):
+    """
+    Guarda el FileStorage en `carpeta` con nombre <sha256>.<ext>.
+    Devuelve (nombre, es_nuevo). Si el contenido ya existía no se reescribe.
+    """
+    os.makedirs(carpeta, exist_ok=True)
+    ext = file_storage.filename.rsplit(".", 1)[-1].lower() if "." in file_storage.filename else "bin"
+    h = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=carpeta, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                buf = file_storage.stream.read(CHUNK)
+                if not buf:
+                    break
+                h.update(buf)
+                out.write(buf)
+        nombre = f"{h.hexdigest()[:32]}.{ext}"
+        destino = os.path.join(carpeta, nombre)
+        if os.path.exists(destino):
+            os.remove(tmp)
+            return nombre, False
+        os.replace(tmp, destino)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    generar_variantes(carpeta, nombre)
+    return nombre, True
+
+
+def _nombre_variante(nombre, variante):
+    return f"{nombre.rsplit('.', 1)[0]}_{variante}.jpg"
+
+
+def _generar(carpeta, nombre):
+    try:
+        origen = os.path.join(carpeta, nombre)
+        dir_var = os.path.join(carpeta, DIR_VARIANTES)
+        os.makedirs(dir_var, exist_ok=True)
+        with Image.open(origen) as img:
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            for variante, lado in VARIANTES.items():
+                destino = os.path.join(dir_var, _nombre_variante(nombre, variante))
+                if os.path.exists(destino):
+                    continue
+                copia = img.copy()
+                copia.thumbnail((lado, lado))
+                tmp = destino + ".part"
+                copia.save(tmp, "JPEG", quality=82, optimize=True, progressive=True)
+                os.replace(tmp, destino)
+    except Exception:
+        _fallidos.add((carpeta, nombre))
+        log.exception("No se pudieron generar variantes de %s", nombre)
+    finally:
+        _pendientes.discard((carpeta, nombre))
+
+
+def generar_variantes(carpeta, nombre):
+    """Encola la generación de variantes (no bloquea el request)."""
+    if not CAN_RESIZE or (carpeta, nombre) in _pendientes or (carpeta, nombre) in _fallidos:
+        return
+    _pendientes.add((carpeta, nombre))
+    _executor().submit(_generar, carpeta, nombre)
+
+
+def ruta_variante(carpeta, nombre, variante):
+    """
+    Ruta relativa a `carpeta` de la variante pedida, o del original si la
+    variante todavía no existe (en ese caso se encola).
+    """
+    nombre = os.path.basename(nombre or "")
+    if variante in VARIANTES:
+        rel = os.path.join(DIR_VARIANTES, _nombre_variante(nombre, variante))
+        if os.path.exists(os.path.join(carpeta, rel)):
+            return rel
+        if os.path.exists(os.path.join(carpeta, nombre)):
+            generar_variantes(carpeta, nombre)
+    return nombre
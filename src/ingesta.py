@@ -0,0 +1,218 @@
+# ingesta.py
+"""
+Ingesta de fixes GPS desde los dispositivos de los técnicos.
+
+- Autenticación por token (tecnicos.tracking_token guarda el SHA-256 del
+  token, nunca el token). Los tokens conocidos se resuelven en memoria;
+  solo un token desconocido consulta la BD, y los inválidos quedan en
+  cache negativa un rato para que un cliente mal configurado no martille
+  SQLite.
+- Límite por dispositivo con token bucket (RAFAGA fixes de golpe, después
+  RITMO por segundo).
+- Se descartan antes de escribir los fixes repetidos o que llegan fuera
+  de orden (ts <= último aceptado para ese técnico). La memoria rechaza
+  rápido; lo que pasa se compara además con tecnico_pos, que también ve
+  lo guardado por otra instancia o antes de un arranque en frío.
+- guardar_lote(): lotes de telemetría (ver telemetria.py) a
+  tecnico_tracks, validando precisión, rango y hora.
+- El estado en memoria (último fix, geocercas) avanza recién con
+  confirmar(), que el que llama corre después del commit: si la
+  transacción se revierte, el reintento no se toma por repetido.
+"""
+import os
+import time
+import hashlib
+import secrets
+import threading
+from datetime import datetime
+
+RAFAGA = 20            # fixes permitidos de golpe (p. ej. al recuperar señal)
+RITMO = 1.0            # fixes por segundo sostenidos
+TTL_TOKEN = 300        # s que un token válido vive en memoria sin revalidar
+TTL_INVALIDO = 60      # s de cache negativa para tokens desconocidos
+FMT = "%Y-%m-%d %H:%M:%S"
+MAX_ACCURACY_M = float(os.environ.get("TELEMETRIA_MAX_ACCURACY", "100"))
+MAX_ADELANTO_S = 300   # tolerancia de reloj del dispositivo hacia el futuro
+MAX_FIXES_LOTE = 5000
+
+_lock = threading.Lock()
+_tokens = {}           # sha256 -> (tecnico_id | None, vence)
+_cubetas = {}          # sha256 -> [fichas, ultimo_monotonic]
+_ultimo_fix = {}       # tecnico_id -> (ts, lat, lng)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def emitir_token(conn, tecnico_id):
+    """Genera un token nuevo para el técnico (invalida el anterior) y lo devuelve en claro."""
+    token = secrets.token_urlsafe(24)
+    conn.execute("UPDATE tecnicos SET tracking_token = ? WHERE id = ?", (hash_token(token), tecnico_id))
+    with _lock:
+        for h, (tid, _) in list(_tokens.items()):
+            if tid == tecnico_id:
+                del _tokens[h]
+    return token
+
+
+def autenticar(abrir_db, token):
+    """
+    tecnico_id del token, o None. abrir_db() se llama solo si el token no está
+    en memoria (la conexión queda abierta para el que llama: se devuelve también).
+    """
+    if not token:
+        return None, None
+    h = hash_token(token)
+    ahora = time.monotonic()
+    with _lock:
+        hit = _tokens.get(h)
+    if hit is not None and hit[1] > ahora:
+        return hit[0], None
+    conn = abrir_db()
+    r = conn.execute("SELECT id FROM tecnicos WHERE tracking_token = ? AND activo = 1", (h,)).fetchone()
+    tecnico_id = r[0] if r else None
+    with _lock:
+        _tokens[h] = (tecnico_id, ahora + (TTL_TOKEN if tecnico_id else TTL_INVALIDO))
+    return tecnico_id, conn
+
+
+def permitir(clave, costo=1):
+    """Token bucket por dispositivo: True si hay fichas para `costo` fixes."""
+    ahora = time.monotonic()
+    with _lock:
+        c = _cubetas.get(clave)
+        if c is None:
+            c = _cubetas[clave] = [float(RAFAGA), ahora]
+        c[0] = min(float(RAFAGA), c[0] + (ahora - c[1]) * RITMO)
+        c[1] = ahora
+        if c[0] < costo:
+            return False
+        c[0] -= costo
+        return True
+
+
+def parsear_ts(valor):
+    """
+    ts del dispositivo (epoch s/ms o 'YYYY-MM-DD HH:MM:SS'/ISO) -> texto FMT;
+    None si no vino. ValueError si no se entiende o está fuera de rango.
+    """
+    if valor in (None, ""):
+        return None
+    try:
+        n = float(valor)
+    except (TypeError, ValueError):
+        n = None
+    try:
+        if n is not None:
+            return datetime.fromtimestamp(n / 1000 if n > 1e11 else n).strftime(FMT)
+        return datetime.fromisoformat(str(valor).replace("Z", "")[:19]).strftime(FMT)
+    except (ValueError, OverflowError, OSError):
+        raise ValueError(f"ts inválido: {valor!r}") from None
+
+
+def _ultimo_ts(conn, tecnico_id):
+    """ts del último fix guardado del técnico ('' si no hay): memoria o BD, el mayor."""
+    with _lock:
+        previo = (_ultimo_fix.get(tecnico_id) or ("",))[0]
+    r = conn.execute("SELECT MAX(ts) FROM tecnico_pos WHERE tecnico_id = ?", (tecnico_id,)).fetchone()
+    return max(previo, r[0] or "")
+
+
+def aceptar_fix(conn, tecnico_id, ts):
+    """False si el fix repite o es anterior al último guardado del técnico (no cambia nada)."""
+    with _lock:
+        previo = _ultimo_fix.get(tecnico_id)
+    if previo is not None and ts <= previo[0]:
+        return False                       # sin tocar la BD
+    return ts > _ultimo_ts(conn, tecnico_id)
+
+
+def confirmar(tecnico_id, ultimo, eventos=()):
+    """
+    Después del commit: avanza el último fix del técnico (ultimo = (ts, lat,
+    lng) o None) y el estado de geocercas con los eventos escritos.
+    """
+    if ultimo is not None:
+        with _lock:
+            previo = _ultimo_fix.get(tecnico_id)
+            if previo is None or ultimo[0] > previo[0]:
+                _ultimo_fix[tecnico_id] = tuple(ultimo)
+    if eventos:
+        from geocercas import confirmar as confirmar_geocercas
+        confirmar_geocercas(tecnico_id, eventos)
+
+
+def guardar_lote(conn, tecnico_id, fixes, movil=None, source=None, historicos=False):
+    """
+    fixes: [(ts_epoch, lat, lng, accuracy, battery)] en orden. Inserta los
+    válidos en tecnico_tracks (un executemany), actualiza la última posición
+    y evalúa geocercas. No hace commit. Devuelve conteos por motivo, más
+    "ultimo" y "eventos" para pasarle a confirmar() después del commit, y
+    "motivos": por fix, None si se guardó, "historicos" si se guardó como
+    recorrido pasado, o el motivo del descarte.
+
+    historicos=True (cambios offline): los fixes anteriores al último
+    aceptado no se descartan; van a tecnico_tracks como recorrido pasado
+    (sin mover la posición ni evaluar geocercas), salvo que ese ts ya esté.
+    """
+    from geocercas import evaluar, dentro_actual
+    limite = time.time() + MAX_ADELANTO_S
+    filas, viejas, motivos = [], {}, []
+    cuenta = {"aceptados": 0, "historicos": 0, "precision": 0, "rango": 0, "repetidos": 0}
+    ultimo_ts = _ultimo_ts(conn, tecnico_id)
+    for i, (t, lat, lng, acc, bat) in enumerate(fixes):
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180) or not (0 <= t <= limite):
+            motivos.append("rango")
+            continue
+        if acc is not None and not (0 <= acc <= MAX_ACCURACY_M):
+            motivos.append("precision")
+            continue
+        ts = datetime.fromtimestamp(t).strftime(FMT)
+        fila = (tecnico_id, movil, lat, lng, acc, bat, source, ts)
+        if ts > ultimo_ts:
+            ultimo_ts = ts
+            filas.append(fila)
+            motivos.append(None)
+        elif historicos and ts not in viejas:
+            viejas[ts] = (i, fila)
+            motivos.append(None)
+        else:
+            motivos.append("repetidos")
+
+    if viejas:
+        # Los que ya están (reintento, o el mismo fix llegó en vivo) no se duplican
+        claves = list(viejas)
+        for j in range(0, len(claves), 500):
+            parte = claves[j:j + 500]
+            for (ts,) in conn.execute(f"""
+                SELECT DISTINCT ts FROM tecnico_tracks
+                 WHERE tecnico_id = ? AND ts IN ({", ".join("?" * len(parte))})
+            """, [tecnico_id] + parte):
+                motivos[viejas.pop(ts)[0]] = "repetidos"
+        for i, _ in viejas.values():
+            motivos[i] = "historicos"
+    for m in motivos:
+        if m:
+            cuenta[m] += 1
+
+    eventos = []
+    if filas or viejas:
+        conn.executemany("""
+            INSERT INTO tecnico_tracks (tecnico_id, movil, lat, lng, accuracy, battery, source, ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, filas + [f for _, f in viejas.values()])
+    if filas:
+        dentro = dentro_actual(conn, tecnico_id)      # copia: el lote avanza sobre ella
+        for _, _, lat, lng, _, _, _, ts in filas:
+            eventos += evaluar(conn, tecnico_id, lat, lng, ts, dentro)
+        _, _, lat, lng, _, _, _, ts = filas[-1]
+        conn.execute("INSERT INTO tecnico_pos (tecnico_id, lat, lng, ts) VALUES (?,?,?,?)",
+                     (tecnico_id, lat, lng, ts))
+        conn.execute("UPDATE tecnicos SET lat=?, lng=?, pos_updated_at=? WHERE id=?",
+                     (lat, lng, ts, tecnico_id))
+    cuenta["aceptados"] = len(filas)
+    cuenta["ultimo"] = (filas[-1][7], filas[-1][2], filas[-1][3]) if filas else None
+    cuenta["motivos"] = motivos
+    cuenta["eventos"] = eventos
+    return cuenta
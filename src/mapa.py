@@ -0,0 +1,133 @@
+# mapa.py
+"""
+Consultas del mapa por viewport.
+
+Los tickets geolocalizados de los últimos DIAS_MAPA días y la última
+posición de cada técnico se cargan en índices en grilla (geo.IndiceGrilla)
+que se reconstruyen solo cuando cambian asistencias/tecnicos/tecnico_pos
+o cambia el día. Cada pedido del mapa recorre únicamente las celdas del
+bbox visible.
+
+Con zoom bajo (o demasiados puntos en pantalla) los tickets se agrupan en
+el servidor: grilla de ~PX_CLUSTER píxeles según el zoom, y se devuelve
+un cluster por celda con su cantidad, centroide y extensión.
+"""
+import threading
+from datetime import datetime
+
+from geo import IndiceGrilla
+from cache import version as version_datos
+
+DIAS_MAPA = 15
+ZOOM_DETALLE = 14        # desde este zoom se mandan marcadores sueltos
+MAX_MARCADORES = 400     # más que esto en pantalla: se agrupa igual
+PX_CLUSTER = 60          # tamaño aproximado de la celda de agrupamiento
+
+_lock = threading.Lock()
+_estado = {"clave": None}
+
+
+def _cargar(conn):
+    tickets = IndiceGrilla(celda=0.02)
+    tecnicos = IndiceGrilla(celda=0.05)
+    filas_t, filas_p = {}, {}
+
+    for r in conn.execute(f"""
+        SELECT a.id, a.cliente, a.direccion, a.tipo, a.prioridad, a.estado,
+               a.programada_en, a.lat, a.lng,
+               COALESCE(t.nombre, a.tecnico) AS tecnico
+        FROM asistencias a
+        LEFT JOIN tecnicos t ON a.tecnico_id = t.id
+        WHERE a.lat IS NOT NULL AND a.lng IS NOT NULL
+          AND date(a.fecha) >= date('now','-{DIAS_MAPA} day')
+    """):
+        fila = dict(r)
+        filas_t[fila["id"]] = fila
+        tickets.insertar(fila["id"], fila["lat"], fila["lng"])
+
+    for r in conn.execute("""
+        SELECT tp.tecnico_id, tp.lat, tp.lng, tp.ts, te.nombre
+        FROM tecnico_pos tp
+        JOIN (
+            SELECT tecnico_id, MAX(ts) AS mts
+            FROM tecnico_pos GROUP BY tecnico_id
+        ) x ON x.tecnico_id = tp.tecnico_id AND x.mts = tp.ts
+        LEFT JOIN tecnicos te ON te.id = tp.tecnico_id
+    """):
+        filas_p[r["tecnico_id"]] = {"id": r["tecnico_id"], "nombre": r["nombre"],
+                                    "lat": r["lat"], "lng": r["lng"], "ts": r["ts"]}
+        tecnicos.insertar(r["tecnico_id"], r["lat"], r["lng"])
+
+    extension = _extension(list(filas_t.values()) + list(filas_p.values()))
+    return tickets, filas_t, tecnicos, filas_p, extension
+
+
+def indices(conn):
+    clave = (version_datos("asistencias", "tecnicos", "tecnico_pos"),
+             datetime.now().strftime("%Y-%m-%d"))
+    with _lock:
+        if _estado["clave"] != clave:
+            _estado["datos"] = _cargar(conn)
+            _estado["clave"] = clave
+        return _estado["datos"]
+
+
+def _extension(filas):
+    if not filas:
+        return None
+    lats = [f["lat"] for f in filas]
+    lngs = [f["lng"] for f in filas]
+    return [[min(lats), min(lngs)], [max(lats), max(lngs)]]
+
+
+def agrupar(puntos, zoom):
+    """puntos: [(lat, lng)] -> clusters {lat, lng, n, extension} en grilla de ~PX_CLUSTER px."""
+    paso = 360.0 / (2 ** max(0, zoom)) * (PX_CLUSTER / 256.0)
+    celdas = {}
+    for lat, lng in puntos:
+        c = celdas.get((lat // paso, lng // paso))
+        if c is None:
+            celdas[(lat // paso, lng // paso)] = [1, lat, lng, lat, lng, lat, lng]
+        else:
+            c[0] += 1
+            c[1] += lat
+            c[2] += lng
+            c[3] = min(c[3], lat); c[4] = min(c[4], lng)
+            c[5] = max(c[5], lat); c[6] = max(c[6], lng)
+    return [{"lat": c[1] / c[0], "lng": c[2] / c[0], "n": c[0],
+             "extension": [[c[3], c[4]], [c[5], c[6]]]} for c in celdas.values()]
+
+
+def consultar(conn, bbox=None, zoom=None):
+    """
+    bbox: (sur, oeste, norte, este) o None (todo). zoom: nivel de Leaflet o None.
+    Devuelve dict con tickets, clusters, tecnicos y la extensión total de los datos.
+    """
+    idx_t, filas_t, idx_p, filas_p, extension = indices(conn)
+
+    if bbox is None:
+        tickets = list(filas_t.values())
+        tecnicos = list(filas_p.values())
+    else:
+        tickets = [filas_t[k] for k, _, _ in idx_t.en_caja(*bbox)]
+        tecnicos = [filas_p[k] for k, _, _ in idx_p.en_caja(*bbox)]
+
+    clusters = []
+    if zoom is not None and (zoom < ZOOM_DETALLE or len(tickets) > MAX_MARCADORES):
+        sueltos = []
+        for c in agrupar([(t["lat"], t["lng"]) for t in tickets], zoom):
+            if c["n"] == 1:
+                sueltos.append(c)
+            else:
+                clusters.append(c)
+        # Los clusters de un solo ticket se mandan como marcador normal
+        unicos = {(c["lat"], c["lng"]) for c in sueltos}
+        tickets = [t for t in tickets if (t["lat"], t["lng"]) in unicos]
+
+    return {
+        "tickets": tickets,
+        "clusters": clusters,
+        "tecnicos": tecnicos,
+        "extension": extension,
+        "total": len(filas_t),
+    }
@@ -0,0 +1,487 @@
+# migraciones.py
+"""
+Migraciones versionadas de la BD, indexadas por PRAGMA user_version.
+
+Cada paso se aplica una sola vez y dentro de su propia transacción; al
+terminar se sube user_version. Con la BD al día, migrar() cuesta una
+lectura de PRAGMA. Para agregar cambios de esquema: sumar una función
+_vN al final de MIGRACIONES (nunca editar pasos ya publicados).
+"""
+
+# ------------------ Helpers ------------------
+def columnas(conn, table):
+    return {r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+
+def agregar_columna(conn, table, name, type_sql, default_constant=None):
+    """Agrega columna si falta; SOLO defaults CONSTANTES (SQLite no acepta funciones en ALTER)."""
+    if name in columnas(conn, table):
+        return
+    if default_constant is None:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_sql}")
+    elif isinstance(default_constant, str):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_sql} DEFAULT '{default_constant}'")
+    else:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_sql} DEFAULT {default_constant}")
+
+def crear_indice(conn, name, table, cols):
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({cols})")
+
+
+# ------------------ Pasos ------------------
+def _v1_esquema_base(conn):
+    """Esquema que antes armaba crear_db.py (tablas, columnas, backfills e índices)."""
+    # ---------- Asistencias ----------
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS asistencias (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        cliente TEXT,
+        direccion TEXT,
+        tipo TEXT,
+        prioridad TEXT,
+        tecnico TEXT,
+        problema TEXT,
+        fecha TEXT,
+        pppoe TEXT
+    )""")
+    agregar_columna(conn, "asistencias", "estado", "TEXT", default_constant="pendiente")
+    agregar_columna(conn, "asistencias", "lat", "REAL")
+    agregar_columna(conn, "asistencias", "lng", "REAL")
+    agregar_columna(conn, "asistencias", "cliente_id", "INTEGER")
+    agregar_columna(conn, "asistencias", "cedula", "TEXT")
+    agregar_columna(conn, "asistencias", "programada_en", "TEXT")
+    agregar_columna(conn, "asistencias", "tecnico_id", "INTEGER")
+    agregar_columna(conn, "asistencias", "canal", "TEXT", default_constant="web")
+    conn.execute("UPDATE asistencias SET estado='pendiente' WHERE estado IS NULL OR TRIM(estado)=''")
+    conn.execute("UPDATE asistencias SET canal='web'      WHERE canal  IS NULL OR TRIM(canal)  =''")
+
+    # ---------- Equipos / Herramientas / Uso ----------
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS equipos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT NOT NULL,
+        tipo TEXT NOT NULL,
+        descripcion TEXT
+    )""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS herramientas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT NOT NULL,
+        tipo TEXT,
+        imagen TEXT
+    )""")
+    agregar_columna(conn, "herramientas", "tipo", "TEXT")
+    agregar_columna(conn, "herramientas", "descripcion", "TEXT")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS uso_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        item_type TEXT NOT NULL,  -- 'equipo' | 'herramienta'
+        item_id INTEGER NOT NULL,
+        tecnico TEXT NOT NULL,
+        fecha TEXT NOT NULL,
+        servicio TEXT
+    )""")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS fotos_asistencia (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        asistencia_id INTEGER,
+        tecnico TEXT,
+        ruta_foto TEXT NOT NULL,
+        descripcion TEXT,
+        fecha TEXT
+    )""")
+    agregar_columna(conn, "fotos_asistencia", "tecnico", "TEXT")
+
+    # ---------- Usuarios ----------
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS usuarios (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        usuario TEXT UNIQUE NOT NULL,
+        contrasena TEXT
+    )""")
+    agregar_columna(conn, "usuarios", "password_hash", "TEXT")
+    agregar_columna(conn, "usuarios", "email", "TEXT")
+    agregar_columna(conn, "usuarios", "nombre", "TEXT")
+    agregar_columna(conn, "usuarios", "rol", "TEXT", default_constant="operador")
+    agregar_columna(conn, "usuarios", "foto_url", "TEXT")
+    agregar_columna(conn, "usuarios", "telefono", "TEXT")
+    agregar_columna(conn, "usuarios", "area", "TEXT")
+    agregar_columna(conn, "usuarios", "turno", "TEXT")
+    agregar_columna(conn, "usuarios", "dark_mode", "INTEGER", default_constant=0)
+    agregar_columna(conn, "usuarios", "notifs", "INTEGER", default_constant=1)
+    for name in ("created_at", "updated_at"):
+        agregar_columna(conn, "usuarios", name, "TEXT")
+        conn.execute(f"UPDATE usuarios SET {name} = datetime('now') WHERE {name} IS NULL")
+
+    # ---------- Clientes ----------
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS clientes (
+      id           INTEGER PRIMARY KEY AUTOINCREMENT,
+      external_id  TEXT,           -- ID externo
+      nombre       TEXT,
+      apellido     TEXT,
+      direccion    TEXT,
+      referencia   TEXT,
+      barrio       TEXT,
+      telefono     TEXT,
+      situacion    TEXT,
+      exonerado    INTEGER DEFAULT 0,
+      tipo         TEXT,           -- p.ej. 'cliente'
+      valor        TEXT,           -- p.ej. '130.000'
+      tipo_valor   TEXT,           -- compatibilidad si viene junto
+      vencimiento  TEXT,
+      cedula       TEXT,
+      pppoe        TEXT,
+      activo       INTEGER DEFAULT 1
+    )""")
+    for name, type_sql in (("external_id", "TEXT"), ("nombre", "TEXT"), ("apellido", "TEXT"),
+                           ("direccion", "TEXT"), ("referencia", "TEXT"), ("barrio", "TEXT"),
+                           ("telefono", "TEXT"), ("situacion", "TEXT"), ("tipo", "TEXT"),
+                           ("valor", "TEXT"), ("tipo_valor", "TEXT"), ("vencimiento", "TEXT"),
+                           ("cedula", "TEXT"), ("pppoe", "TEXT"), ("email", "TEXT"),
+                           ("plan", "TEXT"), ("lat", "REAL"), ("lng", "REAL"),
+                           ("telefono_whatsapp", "TEXT")):
+        agregar_columna(conn, "clientes", name, type_sql)
+    agregar_columna(conn, "clientes", "exonerado", "INTEGER", default_constant=0)
+    agregar_columna(conn, "clientes", "activo",    "INTEGER", default_constant=1)
+
+    # ---------- Técnicos ----------
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS tecnicos (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      nombre TEXT,
+      telefono TEXT,
+      activo INTEGER DEFAULT 1
+    )""")
+    agregar_columna(conn, "tecnicos", "telefono_whatsapp", "TEXT")
+    agregar_columna(conn, "tecnicos", "movil", "TEXT")
+    agregar_columna(conn, "tecnicos", "tracking_token", "TEXT")
+    agregar_columna(conn, "tecnicos", "lat", "REAL")
+    agregar_columna(conn, "tecnicos", "lng", "REAL")
+    agregar_columna(conn, "tecnicos", "pos_updated_at", "TEXT")
+
+    # ---------- Tracking de técnicos (histórico) ----------
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS tecnico_tracks (
+      id         INTEGER PRIMARY KEY AUTOINCREMENT,
+      tecnico_id INTEGER NOT NULL,
+      movil      TEXT,
+      lat        REAL NOT NULL,
+      lng        REAL NOT NULL,
+      accuracy   REAL,
+      battery    REAL,
+      source     TEXT,
+      ts         TEXT NOT NULL
+    )""")
+
+    # ---------- Posiciones puntuales (para el mapa) ----------
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS tecnico_pos (
+      id         INTEGER PRIMARY KEY AUTOINCREMENT,
+      tecnico_id INTEGER NOT NULL,
+      lat        REAL NOT NULL,
+      lng        REAL NOT NULL,
+      ts         TEXT NOT NULL
+    )""")
+
+    # ---------- ticket_fotos (opcional) ----------
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ticket_fotos (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      ticket_id INTEGER NOT NULL,
+      archivo TEXT NOT NULL,
+      created_at TEXT
+    )""")
+    agregar_columna(conn, "ticket_fotos", "created_at", "TEXT")
+    conn.execute("UPDATE ticket_fotos SET created_at = datetime('now') WHERE created_at IS NULL")
+
+    # ---------- Índices ----------
+    crear_indice(conn, "idx_asistencias_fecha",   "asistencias", "fecha")
+    crear_indice(conn, "idx_asistencias_estado",  "asistencias", "estado")
+    crear_indice(conn, "idx_asistencias_prog",    "asistencias", "programada_en")
+    crear_indice(conn, "idx_asistencias_tecnico", "asistencias", "tecnico_id")
+
+    crear_indice(conn, "idx_clientes_external", "clientes", "external_id")
+    crear_indice(conn, "idx_clientes_tel",      "clientes", "telefono")
+    crear_indice(conn, "idx_clientes_cedula",   "clientes", "cedula")
+    crear_indice(conn, "idx_clientes_pppoe",    "clientes", "pppoe")
+
+    crear_indice(conn, "idx_tracks_tecnico_ts",      "tecnico_tracks", "tecnico_id, ts")
+    crear_indice(conn, "idx_tecnico_pos_tecnico_ts", "tecnico_pos",    "tecnico_id, ts")
+    crear_indice(conn, "idx_uso_items_fecha",        "uso_items",      "fecha")
+
+
+def _v2_uso_items_dia(conn):
+    """Resumen diario de uso (un registro por día/ítem) para las stats de /equipos."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS uso_items_dia (
+      dia       TEXT NOT NULL,     -- 'YYYY-MM-DD'
+      item_type TEXT NOT NULL,
+      item_id   INTEGER NOT NULL,
+      usos      INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (dia, item_type, item_id)
+    ) WITHOUT ROWID""")
+    conn.execute("""
+        INSERT OR IGNORE INTO uso_items_dia (dia, item_type, item_id, usos)
+        SELECT substr(fecha, 1, 10), item_type, item_id, COUNT(*)
+          FROM uso_items
+         GROUP BY substr(fecha, 1, 10), item_type, item_id
+    """)
+
+
+def _v3_fotos_por_ticket(conn):
+    """Fotos por ticket: índice (asistencia_id, fecha) y alta de lo que hubiera en ticket_fotos."""
+    crear_indice(conn, "idx_fotos_asistencia_fecha", "fotos_asistencia", "asistencia_id, fecha")
+    conn.execute("""
+        INSERT INTO fotos_asistencia (asistencia_id, ruta_foto, fecha)
+        SELECT tf.ticket_id, tf.archivo, tf.created_at
+          FROM ticket_fotos tf
+         WHERE NOT EXISTS (SELECT 1 FROM fotos_asistencia f
+                            WHERE f.asistencia_id = tf.ticket_id AND f.ruta_foto = tf.archivo)
+    """)
+
+
+def vincular_tickets_por_nombre(conn):
+    """
+    Backfill masivo: completa asistencias.cliente_id en tickets viejos que solo
+    tienen el nombre. Solo vincula si el nombre completo identifica a un único
+    cliente (ignorando mayúsculas/espacios). Devuelve cuántos tickets vinculó.
+    Fuera de las migraciones, quien lo llama rehace ticket_stats si vinculó
+    algo (el barrio de esos tickets cambia).
+    """
+    conn.execute("DROP TABLE IF EXISTS temp._nombres_clientes")
+    conn.execute("""
+        CREATE TEMP TABLE _nombres_clientes AS
+        SELECT lower(trim(IFNULL(nombre,'') || ' ' || IFNULL(apellido,''))) AS clave,
+               MIN(id) AS cliente_id
+          FROM clientes
+         GROUP BY 1
+        HAVING COUNT(*) = 1 AND clave <> ''
+    """)
+    conn.execute("CREATE UNIQUE INDEX temp._idx_nombres_clientes ON _nombres_clientes (clave)")
+    cur = conn.execute("""
+        UPDATE asistencias
+           SET cliente_id = (SELECT n.cliente_id FROM _nombres_clientes n
+                              WHERE n.clave = lower(trim(asistencias.cliente)))
+         WHERE cliente_id IS NULL
+           AND IFNULL(cliente,'') <> ''
+           AND lower(trim(cliente)) IN (SELECT clave FROM _nombres_clientes)
+    """)
+    conn.execute("DROP TABLE temp._nombres_clientes")
+    return cur.rowcount
+
+def _v4_historial_por_cliente(conn):
+    """Historial de tickets por cliente_id (índice + vínculo de tickets viejos)."""
+    crear_indice(conn, "idx_asistencias_cliente_fecha", "asistencias", "cliente_id, fecha")
+    vincular_tickets_por_nombre(conn)
+
+
+def _v5_ticket_stats(conn):
+    """Rollups de tickets (ver analitica.py), cargados desde lo existente."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ticket_stats (
+      dimension TEXT NOT NULL,     -- total | prioridad | tipo | tecnico_id | barrio
+      valor     TEXT NOT NULL,
+      dia       TEXT NOT NULL,     -- 'YYYY-MM-DD' de alta, '' = todo el período
+      estado    TEXT NOT NULL,
+      n         INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (dimension, dia, valor, estado)
+    ) WITHOUT ROWID""")
+    from analitica import reconstruir
+    reconstruir(conn)
+
+
+def _v6_geocache(conn):
+    """Cache de geocodificación por dirección normalizada (ver geocodificacion.py)."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS geocache (
+      clave       TEXT PRIMARY KEY,  -- dirección normalizada
+      lat         REAL,
+      lng         REAL,
+      proveedor   TEXT,
+      estado      TEXT NOT NULL,     -- ok | no_encontrado
+      actualizado TEXT NOT NULL
+    ) WITHOUT ROWID""")
+
+
+def _v7_geocerca_eventos(conn):
+    """Llegadas/salidas detectadas por GPS (ver geocercas.py)."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS geocerca_eventos (
+      id         INTEGER PRIMARY KEY AUTOINCREMENT,
+      tecnico_id INTEGER NOT NULL,
+      ticket_id  INTEGER NOT NULL,
+      tipo       TEXT NOT NULL,      -- llegada | salida
+      lat        REAL,
+      lng        REAL,
+      ts         TEXT NOT NULL
+    )""")
+    crear_indice(conn, "idx_geocerca_ticket",  "geocerca_eventos", "ticket_id, id")
+    crear_indice(conn, "idx_geocerca_tecnico", "geocerca_eventos", "tecnico_id, ticket_id")
+
+
+def _v8_tracking_token(conn):
+    """Búsqueda de técnico por token de tracking (hash SHA-256, ver ingesta.py)."""
+    crear_indice(conn, "idx_tecnicos_tracking_token", "tecnicos", "tracking_token")
+
+
+def _v9_sincronizacion(conn):
+    """Versiones por campo de tickets y cambios ya aplicados del móvil (ver sincronizacion.py)."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ticket_campos (
+      ticket_id INTEGER NOT NULL,
+      campo     TEXT NOT NULL,
+      ts        TEXT NOT NULL,       -- última escritura (LWW)
+      seq       INTEGER NOT NULL,    -- orden global de cambios (cursor de sync)
+      origen    TEXT,
+      PRIMARY KEY (ticket_id, campo)
+    ) WITHOUT ROWID""")
+    crear_indice(conn, "idx_ticket_campos_seq", "ticket_campos", "seq")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sync_aplicados (
+      cambio_id  TEXT PRIMARY KEY,     -- id generado por el cliente
+      tecnico_id INTEGER NOT NULL,
+      recibido   TEXT NOT NULL,
+      resultado  TEXT
+    ) WITHOUT ROWID""")
+
+def _v10_ticket_events(conn):
+    """Historial append-only de tickets y sus snapshots (ver eventos.py); alta de los existentes."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ticket_events (
+      id        INTEGER PRIMARY KEY AUTOINCREMENT,   -- cursor global (nunca se reusa)
+      ticket_id INTEGER NOT NULL,
+      tipo      TEXT NOT NULL,       -- alta | cambio
+      datos     TEXT NOT NULL,       -- JSON {campo: valor nuevo}
+      origen    TEXT,                -- web | movil | geocerca | lote | migracion
+      usuario   TEXT,
+      ts        TEXT NOT NULL
+    )""")
+    crear_indice(conn, "idx_ticket_events_ticket", "ticket_events", "ticket_id, id")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ticket_snapshots (
+      ticket_id INTEGER NOT NULL,
+      evento_id INTEGER NOT NULL,    -- último evento incluido
+      estado    TEXT NOT NULL,       -- JSON del acumulador de eventos.replay()
+      PRIMARY KEY (ticket_id, evento_id)
+    ) WITHOUT ROWID""")
+    conn.execute("""
+        INSERT INTO ticket_events (ticket_id, tipo, datos, origen, ts)
+        SELECT id, 'alta',
+               json_object('estado', estado, 'tecnico_id', tecnico_id,
+                           'programada_en', programada_en, 'prioridad', prioridad),
+               'migracion', COALESCE(fecha, datetime('now', 'localtime'))
+          FROM asistencias ORDER BY id
+    """)
+
+
+def _v11_sla(conn):
+    """Vencimiento de SLA por ticket (ver sla.py), calculado para los existentes."""
+    agregar_columna(conn, "asistencias", "due_at", "TEXT")
+    # Plazos vigentes al publicar este paso (congelados; sla.POLITICAS puede cambiar)
+    conn.execute("""
+        UPDATE asistencias SET due_at = datetime(substr(fecha, 1, 19), '+' || (
+            CASE
+              WHEN prioridad = 'Alta' AND tipo = 'Reparación' THEN 120
+              WHEN prioridad = 'Alta'  THEN 240
+              WHEN prioridad = 'Media' THEN 1440
+              WHEN prioridad = 'Baja'  THEN 4320
+              ELSE 2880
+            END) || ' minutes')
+         WHERE due_at IS NULL
+    """)
+    crear_indice(conn, "idx_asistencias_estado_due", "asistencias", "estado, due_at")
+
+
+def _v12_cobranza_outbox(conn):
+    """Índice de vencimientos de clientes y bandeja de salida de notificaciones (ver outbox.py)."""
+    crear_indice(conn, "idx_clientes_vencimiento", "clientes", "vencimiento")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+      id              INTEGER PRIMARY KEY AUTOINCREMENT,
+      canal           TEXT NOT NULL,     -- whatsapp | oficina | ...
+      destino         TEXT NOT NULL,
+      asunto          TEXT,
+      cuerpo          TEXT NOT NULL,
+      clave           TEXT UNIQUE,       -- idempotencia: el mismo aviso no se encola dos veces
+      estado          TEXT NOT NULL DEFAULT 'pendiente',   -- pendiente | enviado | error
+      intentos        INTEGER NOT NULL DEFAULT 0,
+      proximo_intento TEXT NOT NULL,
+      creado          TEXT NOT NULL,
+      enviado_en      TEXT,
+      error           TEXT
+    )""")
+    crear_indice(conn, "idx_outbox_estado_proximo", "outbox", "estado, proximo_intento")
+
+
+def _v13_turnos(conn):
+    """Turnos (lease) de tareas de fondo entre instancias."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS turnos (
+      tarea     TEXT PRIMARY KEY,      -- p. ej. 'sla'
+      instancia TEXT NOT NULL,         -- quién la corre
+      vence     TEXT NOT NULL          -- si no renueva antes, otra instancia la toma
+    ) WITHOUT ROWID""")
+
+
+def _v14_pos_manual(conn):
+    """Marca de coordenadas cargadas a mano (las únicas que aprende geocodificacion)."""
+    # Las existentes quedan en 0: no se sabe si vinieron de la cache o de una persona
+    agregar_columna(conn, "asistencias", "pos_manual", "INTEGER NOT NULL DEFAULT 0")
+    agregar_columna(conn, "clientes", "pos_manual", "INTEGER NOT NULL DEFAULT 0")
+
+
+# (version, descripción, función) — en orden, sin huecos
+MIGRACIONES = [
+    (1, "esquema base", _v1_esquema_base),
+    (2, "resumen diario de uso_items", _v2_uso_items_dia),
+    (3, "fotos por ticket", _v3_fotos_por_ticket),
+    (4, "historial por cliente_id", _v4_historial_por_cliente),
+    (5, "rollups de tickets", _v5_ticket_stats),
+    (6, "cache de geocodificación", _v6_geocache),
+    (7, "eventos de geocerca", _v7_geocerca_eventos),
+    (8, "índice de tracking_token", _v8_tracking_token),
+    (9, "sincronización offline", _v9_sincronizacion),
+    (10, "historial de tickets", _v10_ticket_events),
+    (11, "vencimientos de SLA", _v11_sla),
+    (12, "recordatorios de cobranza", _v12_cobranza_outbox),
+    (13, "turnos de tareas de fondo", _v13_turnos),
+    (14, "origen de coordenadas", _v14_pos_manual),
+]
+
+VERSION_ACTUAL = MIGRACIONES[-1][0]
+
+
+# ------------------ Runner ------------------
+def version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrar(conn):
+    """
+    Aplica los pasos pendientes y devuelve la lista de versiones aplicadas.
+    Si la BD ya está al día, solo lee PRAGMA user_version.
+    """
+    if version(conn) >= VERSION_ACTUAL:
+        return []
+
+    aplicadas = []
+    nivel_previo = conn.isolation_level
+    conn.isolation_level = None  # manejamos BEGIN/COMMIT a mano (DDL transaccional)
+    try:
+        for num, _desc, paso in MIGRACIONES:
+            # BEGIN IMMEDIATE toma el lock de escritura: si otra instancia migra
+            # en paralelo, esperamos y releemos la versión antes de aplicar.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if version(conn) >= num:
+                    conn.execute("COMMIT")
+                    continue
+                paso(conn)
+                conn.execute(f"PRAGMA user_version = {int(num)}")
+                conn.execute("COMMIT")
+                aplicadas.append(num)
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.isolation_level = nivel_previo
+    return aplicadas
@@ -0,0 +1,439 @@
+# outbox.py
+"""
+Bandeja de salida de notificaciones (tabla outbox).
+
+Quien genera un aviso lo encola con encolar() en su misma transacción;
+si la transacción se deshace, el aviso tampoco existe, y la ruta no
+espera a ninguna API externa. El despachador lo manda después:
+
+- Reclama por lotes de destinatarios con BEGIN IMMEDIATE, pasándolos a
+  'enviando' con un lease (proximo_intento = ahora + LEASE_S); si el
+  proceso muere a mitad de camino, al vencer el lease vuelven a salir.
+- Coalescencia: los avisos reclamados para el mismo (canal, destino) se
+  mandan como un solo mensaje.
+- Los envíos corren en un pool de HILOS threads (son esperas de red).
+- Reintentos con backoff exponencial y jitter hasta MAX_INTENTOS;
+  después quedan en 'error'.
+- metricas(): contadores, throughput del último minuto y latencias
+  (encolado -> enviado, y duración del envío).
+
+El transporte es cualquier objeto con enviar(mensaje) que lanza si no
+pudo. OUTBOX_TRANSPORTE elige entre TRANSPORTES: "webhook" (POST JSON a
+OUTBOX_WEBHOOK_URL, p. ej. la pasarela de WhatsApp/SMS), "local" (solo
+desarrollo: no manda nada, guarda en memoria/archivo) y "falso" (para
+pruebas: latencia y fallas configurables). Sin OUTBOX_TRANSPORTE (o mal
+configurado) no hay despachador: los avisos quedan 'pendiente' hasta que
+se configure, y /health lo informa.
+
+`clave` hace idempotente el encolado: un segundo encolar() con la misma
+clave no agrega nada (p. ej. el recordatorio de cobranza de un día).
+"""
+import os
+import json
+import time
+import random
+import logging
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+FMT = "%Y-%m-%d %H:%M:%S"
+LOTE = 100                # destinatarios por lote
+AVISOS_POR_DESTINO = 20   # tope medio de avisos por destinatario en un lote
+HILOS = int(os.environ.get("OUTBOX_HILOS", "4"))
+MAX_INTENTOS = 6
+BACKOFF_BASE_S = 30
+BACKOFF_MAX_S = 3600
+LEASE_S = 300             # un reclamo sin resultado vuelve a estar disponible pasado este tiempo
+ESPERA_MAX_S = 30         # el despachador revisa la tabla al menos cada tanto
+TRANSPORTE = os.environ.get("OUTBOX_TRANSPORTE") or None
+ARCHIVO_LOCAL = os.environ.get("OUTBOX_ARCHIVO")       # jsonl del transporte local (opcional)
+WEBHOOK_URL = os.environ.get("OUTBOX_WEBHOOK_URL")
+ACTIVO = os.environ.get("OUTBOX_DESPACHADOR", "1") == "1"
+
+
+def ahora():
+    return datetime.now().strftime(FMT)
+
+
+def _en(segundos):
+    return (datetime.now() + timedelta(seconds=segundos)).strftime(FMT)
+
+
+# ===========================
+#  Encolado
+# ===========================
+def encolar_muchos(conn, mensajes):
+    """
+    mensajes: dicts con canal, destino, cuerpo y opcionalmente asunto/clave.
+    No hace commit. Devuelve cuántos se agregaron (los de clave repetida no).
+    """
+    t = ahora()
+    antes = conn.total_changes
+    conn.executemany("""
+        INSERT OR IGNORE INTO outbox (canal, destino, asunto, cuerpo, clave, proximo_intento, creado)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(m["canal"], m["destino"], m.get("asunto"), m["cuerpo"], m.get("clave"), t, t) for m in mensajes])
+    return conn.total_changes - antes
+
+
+def encolar(conn, canal, destino, cuerpo, asunto=None, clave=None):
+    return encolar_muchos(conn, [{"canal": canal, "destino": destino, "cuerpo": cuerpo,
+                                  "asunto": asunto, "clave": clave}]) == 1
+
+
+# ===========================
+#  Transportes
+# ===========================
+class TransporteLocal:
+    """No manda nada: guarda los mensajes en memoria (y en ARCHIVO_LOCAL si está). Para desarrollo."""
+
+    def __init__(self, archivo=None):
+        self.archivo = archivo
+        self.enviados = []
+
+    def enviar(self, mensaje):
+        self.enviados.append(mensaje)
+        if self.archivo:
+            with open(self.archivo, "a", encoding="utf-8") as f:
+                f.write(json.dumps(mensaje, ensure_ascii=False) + "\n")
+
+
+class TransporteFalso(TransporteLocal):
+    """Para pruebas: demora `latencia` s por envío y falla con probabilidad `fallas`."""
+
+    def __init__(self, latencia=0.0, fallas=0.0):
+        super().__init__()
+        self.latencia = latencia
+        self.fallas = fallas
+        self._lock = threading.Lock()
+
+    def enviar(self, mensaje):
+        if self.latencia:
+            time.sleep(self.latencia)
+        if random.random() < self.fallas:
+            raise RuntimeError("falla simulada")
+        with self._lock:
+            self.enviados.append(mensaje)
+
+
+class TransporteWebhook:
+    """POST JSON del mensaje a una pasarela (WhatsApp/SMS); cualquier respuesta != 2xx es falla."""
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def enviar(self, mensaje):
+        from urllib.request import Request, urlopen
+        req = Request(self.url, data=json.dumps(mensaje, ensure_ascii=False).encode("utf-8"),
+                      headers={"Content-Type": "application/json"}, method="POST")
+        with urlopen(req, timeout=self.timeout) as resp:
+            if not 200 <= resp.status < 300:
+                raise RuntimeError(f"HTTP {resp.status}")
+
+
+TRANSPORTES = {
+    "local": lambda: TransporteLocal(ARCHIVO_LOCAL),
+    "falso": lambda: TransporteFalso(),
+    "webhook": lambda: TransporteWebhook(WEBHOOK_URL),
+}
+
+
+def problema_transporte():
+    """Por qué no se puede mandar con la configuración actual (None si está bien)."""
+    if TRANSPORTE is None:
+        return "OUTBOX_TRANSPORTE sin configurar: los avisos quedan pendientes"
+    if TRANSPORTE not in TRANSPORTES:
+        return f"OUTBOX_TRANSPORTE desconocido: {TRANSPORTE!r}"
+    if TRANSPORTE == "webhook" and not WEBHOOK_URL:
+        return "OUTBOX_TRANSPORTE=webhook sin OUTBOX_WEBHOOK_URL"
+    return None
+
+
+def transporte_por_defecto():
+    """El transporte de OUTBOX_TRANSPORTE, o None si no hay uno usable (ver problema_transporte)."""
+    problema = problema_transporte()
+    if problema:
+        with _lock:
+            avisar = not _estado["sin_transporte"]
+            _estado["sin_transporte"] = True
+        if avisar:
+            log.error("Outbox sin transporte: %s", problema)
+        return None
+    return TRANSPORTES[TRANSPORTE]()
+
+
+# ===========================
+#  Métricas
+# ===========================
+_m_lock = threading.Lock()
+_contadores = {"enviados": 0, "mensajes": 0, "fallidos": 0, "reintentos": 0, "descartados": 0, "coalescidos": 0}
+_muestras = deque(maxlen=2000)        # (t_fin monotonic, avisos, latencia_s, envio_s)
+
+
+def _registrar(avisos, latencia_s, envio_s, ok, reintento=False, descartado=False):
+    with _m_lock:
+        if ok:
+            _contadores["enviados"] += avisos
+            _contadores["mensajes"] += 1
+            _contadores["coalescidos"] += avisos - 1
+            _muestras.append((time.monotonic(), avisos, latencia_s, envio_s))
+        else:
+            _contadores["fallidos"] += 1
+            _contadores["reintentos"] += int(reintento)
+            _contadores["descartados"] += avisos if descartado else 0
+
+
+def _percentil(valores, p):
+    if not valores:
+        return None
+    valores = sorted(valores)
+    return round(valores[min(len(valores) - 1, int(p / 100.0 * len(valores)))], 3)
+
+
+def metricas(conn=None):
+    """Contadores del proceso, throughput del último minuto y percentiles de latencia (s)."""
+    limite = time.monotonic() - 60
+    with _m_lock:
+        contadores = dict(_contadores)
+        muestras = list(_muestras)
+    recientes = [m for m in muestras if m[0] >= limite]
+    datos = {
+        "contadores": contadores,
+        "avisos_por_min": sum(m[1] for m in recientes),
+        "latencia_s": {"p50": _percentil([m[2] for m in muestras], 50),
+                       "p95": _percentil([m[2] for m in muestras], 95)},
+        "envio_s": {"p50": _percentil([m[3] for m in muestras], 50),
+                    "p95": _percentil([m[3] for m in muestras], 95)},
+        "despachador": {"corriendo": _estado["corriendo"], "hilos": HILOS, "transporte": TRANSPORTE,
+                        "problema": problema_transporte()},
+    }
+    if conn is not None:
+        datos["cola"] = resumen(conn)
+    return datos
+
+
+# ===========================
+#  Reclamo / envío / resultado
+# ===========================
+_COLUMNAS = ("id", "canal", "destino", "asunto", "cuerpo", "intentos", "creado")
+
+
+def reclamar(conn, lote=LOTE):
+    """
+    Pasa a 'enviando' (con lease) los avisos listos de los primeros `lote`
+    destinatarios (todos los suyos, hasta lote * AVISOS_POR_DESTINO) y los devuelve.
+    """
+    nivel = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            filas, destinos = [], set()
+            for r in conn.execute(f"""
+                SELECT {', '.join(_COLUMNAS)} FROM outbox
+                 WHERE estado IN ('pendiente', 'enviando') AND proximo_intento <= ?
+                 ORDER BY proximo_intento, id
+            """, (ahora(),)):
+                clave = (r[1], r[2])
+                if clave not in destinos:
+                    if len(destinos) >= lote:
+                        continue
+                    destinos.add(clave)
+                filas.append(r)
+                if len(filas) >= lote * AVISOS_POR_DESTINO:
+                    break
+            for i in range(0, len(filas), 500):
+                parte = filas[i:i + 500]
+                conn.execute(f"""
+                    UPDATE outbox SET estado = 'enviando', proximo_intento = ?
+                     WHERE id IN ({', '.join('?' * len(parte))})
+                """, [_en(LEASE_S)] + [r[0] for r in parte])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.isolation_level = nivel
+    return [dict(zip(_COLUMNAS, tuple(r))) for r in filas]
+
+
+def coalescer(avisos):
+    """Un mensaje por (canal, destino) con los cuerpos de todos sus avisos."""
+    grupos = {}
+    for a in avisos:
+        grupos.setdefault((a["canal"], a["destino"]), []).append(a)
+    mensajes = []
+    for (canal, destino), lista in grupos.items():
+        mensajes.append({
+            "ids": [a["id"] for a in lista],
+            "canal": canal,
+            "destino": destino,
+            "asunto": lista[0]["asunto"] if len(lista) == 1 else f"{len(lista)} avisos",
+            "cuerpo": "\n\n".join(a["cuerpo"] for a in lista),
+            "intentos": max(a["intentos"] for a in lista),
+            "creado": min(a["creado"] for a in lista),
+        })
+    return mensajes
+
+
+def _enviar(transporte, mensaje):
+    t0 = time.perf_counter()
+    try:
+        transporte.enviar({k: mensaje[k] for k in ("ids", "canal", "destino", "asunto", "cuerpo")})
+        return mensaje, None, time.perf_counter() - t0
+    except Exception as e:
+        return mensaje, str(e)[:500] or type(e).__name__, time.perf_counter() - t0
+
+
+def _backoff(intentos):
+    s = min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2 ** max(0, intentos - 1))
+    return s * random.uniform(0.8, 1.2)
+
+
+def guardar_resultados(conn, resultados):
+    """Marca enviados / reprograma con backoff / da por perdidos. Un commit."""
+    t = ahora()
+    ok, reintentar, perdidos = [], [], []
+    for mensaje, error, envio_s in resultados:
+        avisos = len(mensaje["ids"])
+        intentos = mensaje["intentos"] + 1
+        if error is None:
+            ok += [(t, i) for i in mensaje["ids"]]
+            try:
+                latencia = (datetime.now() - datetime.fromisoformat(mensaje["creado"])).total_seconds()
+            except ValueError:
+                latencia = envio_s
+            _registrar(avisos, latencia, envio_s, True)
+        elif intentos >= MAX_INTENTOS:
+            perdidos += [(error, i) for i in mensaje["ids"]]
+            _registrar(avisos, None, envio_s, False, descartado=True)
+        else:
+            prox = _en(_backoff(intentos))
+            reintentar += [(error, prox, i) for i in mensaje["ids"]]
+            _registrar(avisos, None, envio_s, False, reintento=True)
+    conn.executemany("""
+        UPDATE outbox SET estado = 'enviado', enviado_en = ?, intentos = intentos + 1, error = NULL WHERE id = ?
+    """, ok)
+    conn.executemany("""
+        UPDATE outbox SET estado = 'pendiente', error = ?, proximo_intento = ?, intentos = intentos + 1 WHERE id = ?
+    """, reintentar)
+    conn.executemany("UPDATE outbox SET estado = 'error', error = ?, intentos = intentos + 1 WHERE id = ?", perdidos)
+    conn.commit()
+    return {"enviados": len(ok), "errores": len(reintentar) + len(perdidos)}
+
+
+def procesar(conn, transporte=None, lote=LOTE, max_lotes=None, pool=None):
+    """
+    Vacía lo que está listo ahora, de a `lote` (un commit por lote), en el
+    thread que llama o repartiendo los envíos en `pool`. Devuelve {"enviados", "errores"}.
+    Sin transporte no reclama nada: los avisos siguen 'pendiente'.
+    """
+    transporte = transporte or transporte_por_defecto()
+    cuenta = {"enviados": 0, "errores": 0}
+    if transporte is None:
+        return cuenta
+    n = 0
+    while max_lotes is None or n < max_lotes:
+        avisos = reclamar(conn, lote)
+        if not avisos:
+            break
+        mensajes = coalescer(avisos)
+        if pool is not None:
+            resultados = list(pool.map(lambda m: _enviar(transporte, m), mensajes))
+        else:
+            resultados = [_enviar(transporte, m) for m in mensajes]
+        for k, v in guardar_resultados(conn, resultados).items():
+            cuenta[k] += v
+        n += 1
+    return cuenta
+
+
+def resumen(conn):
+    return dict(conn.execute("SELECT estado, COUNT(*) FROM outbox GROUP BY estado").fetchall())
+
+
+# ===========================
+#  Despachador en segundo plano
+# ===========================
+_despertar = threading.Event()
+_estado = {"corriendo": False, "db_path": None, "sin_transporte": False}
+_lock = threading.Lock()
+
+
+def _proxima_espera(conn):
+    r = conn.execute("""
+        SELECT MIN(proximo_intento) FROM outbox WHERE estado IN ('pendiente', 'enviando')
+    """).fetchone()[0]
+    if r is None:
+        return ESPERA_MAX_S
+    return max(0.0, min(ESPERA_MAX_S, (datetime.fromisoformat(r) - datetime.now()).total_seconds()))
+
+
+def _despachar(transporte):
+    with ThreadPoolExecutor(max_workers=HILOS, thread_name_prefix="outbox") as pool:
+        while True:
+            try:
+                conn = sqlite3.connect(_estado["db_path"], timeout=30)
+                try:
+                    procesar(conn, transporte, pool=pool)
+                    espera = _proxima_espera(conn)
+                finally:
+                    conn.close()
+            except Exception:
+                log.exception("Despachador de outbox falló")
+                espera = ESPERA_MAX_S
+            _despertar.wait(espera)
+            _despertar.clear()
+
+
+def despertar(db_path, transporte=None):
+    """
+    Avisa que hay algo nuevo en la outbox; arranca el despachador la primera
+    vez. Sin transporte configurado no arranca (los avisos quedan pendientes).
+    """
+    if not ACTIVO:
+        return
+    if not _estado["corriendo"]:
+        transporte = transporte or transporte_por_defecto()
+        if transporte is None:
+            return
+        with _lock:
+            if not _estado["corriendo"]:
+                _estado.update(corriendo=True, db_path=db_path)
+                threading.Thread(target=_despachar, args=(transporte,),
+                                 daemon=True, name="outbox").start()
+    _despertar.set()
+
+
+if __name__ == "__main__":
+    import sys
+    from migraciones import migrar
+
+    if "--bench" not in sys.argv:
+        print("Uso: python outbox.py --bench [n_avisos] [destinos] [latencia_ms]")
+        sys.exit(1)
+    args = [a for a in sys.argv[1:] if a != "--bench"]
+    n = int(args[0]) if args else 5000
+    destinos = int(args[1]) if len(args) > 1 else 200
+    latencia = (float(args[2]) if len(args) > 2 else 20.0) / 1000
+
+    for hilos in (1, HILOS):
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        migrar(conn)
+        encolar_muchos(conn, [{"canal": "whatsapp", "destino": f"tec{i % destinos}", "cuerpo": f"aviso {i}"}
+                              for i in range(n)])
+        conn.commit()
+        transporte = TransporteFalso(latencia=latencia, fallas=0.05)
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=hilos) as pool:
+            res = procesar(conn, transporte, pool=pool)
+        s = time.perf_counter() - t0
+        print(f"{hilos} hilo(s): {res['enviados']} avisos en {len(transporte.enviados)} mensajes, "
+              f"{res['errores']} a reintentar, {s:.2f}s ({res['enviados'] / s:,.0f} avisos/s)")
+    print(json.dumps(metricas(conn), indent=2))
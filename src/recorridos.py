@@ -0,0 +1,218 @@
+# recorridos.py
+"""
+Métricas de recorrido por técnico y día a partir de los fixes GPS
+(tecnico_tracks + tecnico_pos): kilómetros, velocidades, paradas, tiempo
+en sitio por ticket y paradas fuera de tickets (ocioso).
+
+Los fixes del día se cargan como columnas (ts en segundos, lat, lng) y
+las cuentas se hacen sobre los arreglos completos: con NumPy de forma
+vectorizada; sin NumPy, con array('d') y un solo recorrido en Python.
+
+Una parada es una racha de tramos a menos de VEL_PARADA km/h que dura al
+menos MIN_PARADA_S; si su centro cae a menos de RADIO_TICKET_KM de un
+ticket del técnico se cuenta como tiempo en sitio de ese ticket.
+
+Los días pasados se cachean por TTL_PASADO; el día en curso se invalida
+con cada fix nuevo (versión de tecnico_pos/tecnico_tracks).
+"""
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from geo import haversine_km, RADIO_TIERRA_KM
+from cache import espacio, version as version_datos
+
+# NumPy es opcional: sin él se usa el camino en Python puro
+try:
+    import numpy as np
+    CAN_NUMPY = True
+except Exception:
+    CAN_NUMPY = False
+
+VEL_PARADA = 3.0          # km/h: por debajo, el tramo cuenta como detenido
+VEL_MAX = 180.0           # km/h: por encima, el tramo es un salto del GPS y no suma km
+MIN_PARADA_S = 5 * 60
+RADIO_TICKET_KM = 0.15
+TTL_HOY = 60
+TTL_PASADO = 3600
+cache = espacio("recorridos", max_items=128)
+
+
+# ===========================
+#  Carga
+# ===========================
+def cargar(conn, tecnico_id, dia):
+    """Columnas (ts, lat, lng) ordenadas por ts; une tracks y pos sin repetir fixes."""
+    hasta = (datetime.strptime(dia, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    ts, lat, lng = array("d"), array("d"), array("d")
+    for t, la, ln in conn.execute("""
+        SELECT CAST(strftime('%s', ts) AS REAL), lat, lng FROM tecnico_tracks
+         WHERE tecnico_id = ? AND ts >= ? AND ts < ?
+        UNION
+        SELECT CAST(strftime('%s', ts) AS REAL), lat, lng FROM tecnico_pos
+         WHERE tecnico_id = ? AND ts >= ? AND ts < ?
+        ORDER BY 1
+    """, (tecnico_id, dia, hasta, tecnico_id, dia, hasta)):
+        if t is not None:
+            ts.append(t); lat.append(la); lng.append(ln)
+    return ts, lat, lng
+
+
+# ===========================
+#  Cálculo sobre columnas
+# ===========================
+def _rachas_numpy(mascara):
+    """(inicio, fin) inclusivos de las rachas True de un arreglo booleano."""
+    borde = np.diff(np.concatenate(([0], mascara.view(np.int8), [0])))
+    inicios = np.flatnonzero(borde == 1)
+    fines = np.flatnonzero(borde == -1) - 1
+    return list(zip(inicios.tolist(), fines.tolist()))
+
+
+def _tramos_numpy(ts, lat, lng):
+    ts, lat, lng = (np.frombuffer(x, dtype=np.float64) for x in (ts, lat, lng))
+    la, ln = np.radians(lat), np.radians(lng)
+    a = np.sin(np.diff(la) / 2) ** 2 + np.cos(la[:-1]) * np.cos(la[1:]) * np.sin(np.diff(ln) / 2) ** 2
+    d = 2 * RADIO_TIERRA_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    dt = np.diff(ts)
+    v = np.divide(d * 3600.0, dt, out=np.zeros_like(d), where=dt > 0)
+    validos = v < VEL_MAX
+    km = float(d[validos].sum())
+    en_mov = validos & (v >= VEL_PARADA)
+    quieto = ~en_mov
+    paradas = [(i, j + 1, float(ts[j + 1] - ts[i])) for i, j in _rachas_numpy(quieto)]
+    vel_max = float(v[validos].max()) if validos.any() else 0.0
+    horas_mov = float(dt[en_mov].sum()) / 3600.0
+    centro = lambda i, j: (float(lat[i:j + 1].mean()), float(lng[i:j + 1].mean()))
+    return km, vel_max, horas_mov, paradas, centro
+
+
+def _tramos_python(ts, lat, lng):
+    km = vel_max = horas_mov = 0.0
+    paradas, inicio = [], None
+    for k in range(len(ts) - 1):
+        d = haversine_km(lat[k], lng[k], lat[k + 1], lng[k + 1])
+        dt = ts[k + 1] - ts[k]
+        v = d * 3600.0 / dt if dt > 0 else 0.0
+        valido = v < VEL_MAX
+        if valido:
+            km += d
+            vel_max = max(vel_max, v)
+        if valido and v >= VEL_PARADA:
+            horas_mov += dt / 3600.0
+            if inicio is not None:
+                paradas.append((inicio, k, ts[k] - ts[inicio]))
+                inicio = None
+        elif inicio is None:
+            inicio = k
+    if inicio is not None:
+        paradas.append((inicio, len(ts) - 1, ts[-1] - ts[inicio]))
+
+    def centro(i, j):
+        n = j - i + 1
+        return sum(lat[i:j + 1]) / n, sum(lng[i:j + 1]) / n
+    return km, vel_max, horas_mov, paradas, centro
+
+
+def _hora(segundos):
+    # strftime('%s') interpreta ts como UTC: se vuelve a formatear igual
+    return datetime.fromtimestamp(segundos, timezone.utc).strftime("%H:%M")
+
+
+def metricas(ts, lat, lng, tickets=(), usar_numpy=None):
+    """
+    ts/lat/lng: secuencias de floats (ts en segundos). tickets: [(id, lat, lng)].
+    Devuelve dict con km, velocidades, paradas, en_sitio y ociosos.
+    """
+    usar_numpy = CAN_NUMPY if usar_numpy is None else usar_numpy
+    if len(ts) < 2:
+        return {"fixes": len(ts), "km": 0.0, "vel_max": 0.0, "vel_media": 0.0,
+                "paradas": [], "en_sitio": [], "ociosos": []}
+
+    calc = _tramos_numpy if usar_numpy else _tramos_python
+    km, vel_max, horas_mov, rachas, centro = calc(ts, lat, lng)
+
+    paradas, en_sitio, ociosos = [], {}, []
+    for i, j, dur in rachas:
+        if dur < MIN_PARADA_S:
+            continue
+        clat, clng = centro(i, j)
+        ticket = None
+        if tickets:
+            d, tid = min((haversine_km(clat, clng, tl, tg), tid) for tid, tl, tg in tickets)
+            ticket = tid if d <= RADIO_TICKET_KM else None
+        p = {
+            "desde": _hora(ts[i]),
+            "hasta": _hora(ts[j]),
+            "minutos": round(dur / 60.0, 1),
+            "lat": round(clat, 6), "lng": round(clng, 6),
+            "ticket_id": ticket,
+        }
+        paradas.append(p)
+        if ticket is None:
+            ociosos.append(p)
+        else:
+            en_sitio[ticket] = en_sitio.get(ticket, 0.0) + p["minutos"]
+
+    return {
+        "fixes": len(ts),
+        "km": round(km, 2),
+        "vel_max": round(vel_max, 1),
+        "vel_media": round(km / horas_mov, 1) if horas_mov else 0.0,
+        "paradas": paradas,
+        "en_sitio": [{"ticket_id": t, "minutos": round(m, 1)} for t, m in en_sitio.items()],
+        "ociosos": ociosos,
+    }
+
+
+# ===========================
+#  Entrada principal (con cache)
+# ===========================
+def del_dia(conn, tecnico_id, dia):
+    """Métricas del técnico en el día, cacheadas por (técnico, día)."""
+    hoy = dia >= datetime.now().strftime("%Y-%m-%d")
+    clave = ("recorrido", tecnico_id, dia,
+             version_datos("tecnico_pos", "tecnico_tracks", "asistencias") if hoy else None)
+    hit = cache.get(clave)
+    if hit is not None:
+        return dict(hit, cache=True)
+
+    t0 = time.perf_counter()
+    ts, lat, lng = cargar(conn, tecnico_id, dia)
+    tickets = [(r[0], r[1], r[2]) for r in conn.execute("""
+        SELECT a.id, COALESCE(a.lat, c.lat), COALESCE(a.lng, c.lng)
+          FROM asistencias a
+          LEFT JOIN clientes c ON c.id = a.cliente_id
+         WHERE a.tecnico_id = ?
+           AND a.programada_en >= ? AND a.programada_en < date(?, '+1 day')
+    """, (tecnico_id, dia, dia)) if r[1] is not None and r[2] is not None]
+
+    res = metricas(ts, lat, lng, tickets)
+    res.update(tecnico_id=tecnico_id, dia=dia, motor="numpy" if CAN_NUMPY else "python",
+               ms=round((time.perf_counter() - t0) * 1000, 2))
+    cache.set(clave, res, TTL_HOY if hoy else TTL_PASADO)
+    return dict(res, cache=False)
+
+
+if __name__ == "__main__":
+    import sys
+    import random
+    if "--bench" not in sys.argv:
+        print("Uso: python recorridos.py --bench [n_fixes]")
+        sys.exit(1)
+    args = [a for a in sys.argv[1:] if a != "--bench"]
+    n = int(args[0]) if args else 1_000_000
+    ts, lat, lng = array("d"), array("d"), array("d")
+    t, la, ln = 1.7e9, -25.3, -57.6
+    for _ in range(n):
+        t += random.choice((5.0, 10.0, 30.0))
+        if random.random() < 0.7:
+            la += random.uniform(-1e-4, 1e-4)
+            ln += random.uniform(-1e-4, 1e-4)
+        ts.append(t); lat.append(la); lng.append(ln)
+    motores = [("numpy", True), ("python", False)] if CAN_NUMPY else [("python", False)]
+    for nombre, flag in motores:
+        t0 = time.perf_counter()
+        r = metricas(ts, lat, lng, usar_numpy=flag)
+        print(f"{nombre:>6}: {n} fixes en {time.perf_counter() - t0:.3f}s "
+              f"({r['km']} km, {len(r['paradas'])} paradas)")
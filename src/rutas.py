@@ -0,0 +1,92 @@
+# rutas.py
+"""
+Orden de visitas para la agenda de un técnico (TSP abierto).
+
+Se arma la matriz de distancias haversine una sola vez, se construye una
+ruta con vecino más cercano desde la última posición del técnico y se
+mejora con 2-opt hasta que no haya cruces que acortar. Para 30–50 paradas
+termina en pocos milisegundos.
+"""
+import time
+
+from geo import haversine_km
+
+
+def _matriz(puntos):
+    n = len(puntos)
+    m = [[0.0] * n for _ in range(n)]
+    for i in range(n):
+        for j in range(i + 1, n):
+            d = haversine_km(puntos[i][0], puntos[i][1], puntos[j][0], puntos[j][1])
+            m[i][j] = m[j][i] = d
+    return m
+
+
+def _vecino_mas_cercano(m):
+    n = len(m)
+    ruta, libres = [0], set(range(1, n))
+    while libres:
+        ult = ruta[-1]
+        sig = min(libres, key=lambda j: m[ult][j])
+        ruta.append(sig)
+        libres.remove(sig)
+    return ruta
+
+
+def _dos_opt(ruta, m, max_pasadas=50):
+    """2-opt para camino abierto con inicio fijo (ruta[0] = origen)."""
+    n = len(ruta)
+    for _ in range(max_pasadas):
+        mejoro = False
+        for i in range(1, n - 1):
+            a, b = ruta[i - 1], ruta[i]
+            for k in range(i + 1, n):
+                c = ruta[k]
+                d = ruta[k + 1] if k + 1 < n else None
+                antes = m[a][b] + (m[c][d] if d is not None else 0.0)
+                despues = m[a][c] + (m[b][d] if d is not None else 0.0)
+                if despues < antes - 1e-9:
+                    ruta[i:k + 1] = reversed(ruta[i:k + 1])
+                    b = ruta[i]
+                    mejoro = True
+        if not mejoro:
+            break
+    return ruta
+
+
+def largo(ruta, m):
+    return sum(m[ruta[i]][ruta[i + 1]] for i in range(len(ruta) - 1))
+
+
+def planificar(origen, paradas):
+    """
+    origen: (lat, lng) o None (arranca en la primera parada).
+    paradas: lista de dicts con al menos id, lat, lng.
+    Devuelve dict con orden (paradas con tramo_km/acum_km), total_km y ms.
+    """
+    t0 = time.perf_counter()
+    tiene = lambda p: p.get("lat") is not None and p.get("lng") is not None
+    con_coord = [p for p in paradas if tiene(p)]
+    sin_coord = [p for p in paradas if not tiene(p)]
+
+    if origen is None and con_coord:
+        origen = (con_coord[0]["lat"], con_coord[0]["lng"])
+    orden = []
+    total = 0.0
+    if con_coord:
+        puntos = [origen] + [(p["lat"], p["lng"]) for p in con_coord]
+        m = _matriz(puntos)
+        ruta = _dos_opt(_vecino_mas_cercano(m), m)
+        previo = 0
+        for idx in ruta[1:]:
+            tramo = m[previo][idx]
+            total += tramo
+            orden.append(dict(con_coord[idx - 1], tramo_km=round(tramo, 2), acum_km=round(total, 2)))
+            previo = idx
+    # Las paradas sin coordenadas van al final, en su orden original
+    orden += [dict(p, tramo_km=None, acum_km=None) for p in sin_coord]
+    return {
+        "orden": orden,
+        "total_km": round(total, 2),
+        "ms": round((time.perf_counter() - t0) * 1000, 2),
+    }
@@ -0,0 +1,284 @@
+# sincronizacion.py
+"""
+Sincronización offline del cliente móvil de los técnicos.
+
+El dispositivo acumula cambios sin señal y los manda juntos a /api/sync:
+    {"cursor": n | null, "movil": "...",
+     "cambios": [{"id": "<uuid del cliente>", "tipo": "ticket"|"gps"|"foto", "ts": ..., ...}]}
+
+- Idempotente: cada cambio aplicado queda en sync_aplicados con su
+  resultado; si el dispositivo reintenta el mismo id se devuelve lo mismo
+  sin volver a aplicar.
+- Todo el lote se aplica en una transacción (la abre y commitea la ruta).
+- Conflictos: last-writer-wins por campo. ticket_campos guarda, por
+  ticket y campo, el ts de la última escritura (web o dispositivo); un
+  cambio del dispositivo solo pisa el campo si su ts es más nuevo.
+- Delta: cada escritura toma un seq creciente en ticket_campos (uno por
+  ticket, también en las operaciones masivas); el dispositivo recibe los
+  tickets suyos que cambiaron desde su cursor.
+- GPS offline: los fixes anteriores al último ping en vivo se guardan en
+  tecnico_tracks como recorrido pasado (resultado "historico"); cada
+  cambio gps informa si se guardó, ya estaba o se descartó y por qué.
+"""
+import io
+import base64
+import json
+from datetime import datetime
+
+import analitica
+import eventos
+from cache import tocar
+
+FMT = "%Y-%m-%d %H:%M:%S"
+ESTADOS = ("pendiente", "en_progreso", "resuelto", "cancelado")
+LIMITE_DELTA = 500
+EXTENSIONES_FOTO = {"png", "jpg", "jpeg", "gif"}   # mismas que ALLOWED_EXTENSIONS de app.py
+
+def _estado(v):
+    if v not in ESTADOS:
+        raise ValueError(v)
+    return v
+
+def _coordenada(limite):
+    def validar(v):
+        v = float(v)
+        if not -limite <= v <= limite:
+            raise ValueError(v)
+        return v
+    return validar
+
+# campo editable desde el móvil -> validador/normalizador (ValueError si no sirve)
+CAMPOS = {
+    "estado": _estado,
+    "problema": lambda v: str(v)[:4000],
+    "lat": _coordenada(90),
+    "lng": _coordenada(180),
+}
+
+
+def ahora():
+    return datetime.now().strftime(FMT)
+
+
+# ===========================
+#  Versiones por campo
+# ===========================
+def marcar(conn, tid, campos, ts=None, origen="web", usuario=None):
+    """
+    Registra la escritura de `campos` del ticket (o lista de tickets) para LWW
+    y el delta, y la agrega al historial (eventos.py). Va después del UPDATE.
+    """
+    ts = ts or ahora()
+    tids = list(tid) if isinstance(tid, (list, tuple, set)) else [tid]
+    # Un seq por ticket: el delta pagina por seq y un lote masivo con un solo
+    # seq no se podría cortar sin perder tickets
+    base = conn.execute("SELECT IFNULL(MAX(seq), 0) + 1 FROM ticket_campos").fetchone()[0]
+    conn.executemany("""
+        INSERT INTO ticket_campos (ticket_id, campo, ts, seq, origen) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(ticket_id, campo) DO UPDATE SET
+            ts = MAX(ticket_campos.ts, excluded.ts), seq = excluded.seq, origen = excluded.origen
+    """, [(t, c, ts, base + i, origen) for i, t in enumerate(tids) for c in campos])
+    eventos.registrar(conn, tids, campos, ts, origen, usuario)
+
+
+def _aplicar_ticket(conn, tecnico_id, cambio, ts):
+    tid = cambio.get("ticket_id")
+    fila = conn.execute("SELECT tecnico_id FROM asistencias WHERE id = ?", (tid,)).fetchone()
+    if fila is None or fila[0] != tecnico_id:
+        return {"ok": False, "error": "ticket ajeno o inexistente"}
+
+    pedidos = cambio.get("campos") or {}
+    versiones = dict(conn.execute(
+        f"SELECT campo, ts FROM ticket_campos WHERE ticket_id = ? AND campo IN ({', '.join('?' * len(pedidos))})",
+        [tid] + list(pedidos)).fetchall()) if pedidos else {}
+
+    aplicados, rechazados = {}, {}
+    for campo, valor in pedidos.items():
+        if campo not in CAMPOS:
+            rechazados[campo] = "no editable"
+            continue
+        try:
+            valor = CAMPOS[campo](valor)
+        except (TypeError, ValueError):
+            rechazados[campo] = "inválido"
+            continue
+        if versiones.get(campo) and versiones[campo] >= ts:
+            rechazados[campo] = "obsoleto"        # el servidor tiene una escritura más nueva
+            continue
+        aplicados[campo] = valor
+
+    if aplicados:
+        antes = analitica.fila_ticket(conn, tid)
+        sets = ", ".join(f"{c} = ?" for c in aplicados)
+        if "lat" in aplicados or "lng" in aplicados:
+            sets += ", pos_manual = 1"            # las marcó el técnico en el lugar
+        conn.execute(f"UPDATE asistencias SET {sets} WHERE id = ?", list(aplicados.values()) + [tid])
+        if "estado" in aplicados:
+            analitica.mover(conn, antes, analitica.fila_ticket(conn, tid))
+        marcar(conn, tid, aplicados, ts, origen="movil")
+    return {"ok": True, "aplicados": sorted(aplicados), "rechazados": rechazados}
+
+
+def _aplicar_foto(conn, tecnico_id, tecnico, cambio, ts, carpeta):
+    from werkzeug.datastructures import FileStorage
+    from imagenes import guardar_subida
+    fila = conn.execute("SELECT tecnico_id FROM asistencias WHERE id = ?", (cambio.get("ticket_id"),)).fetchone()
+    if fila is None or fila[0] != tecnico_id:
+        return {"ok": False, "error": "ticket ajeno o inexistente"}
+    try:
+        datos = base64.b64decode(cambio["datos"], validate=True)
+    except (KeyError, TypeError, ValueError):
+        return {"ok": False, "error": "foto sin datos base64"}
+    nombre = str(cambio.get("nombre") or "foto.jpg")
+    if nombre.rsplit(".", 1)[-1].lower() not in EXTENSIONES_FOTO:
+        return {"ok": False, "error": "formato de archivo no permitido"}
+    ruta, _ = guardar_subida(FileStorage(io.BytesIO(datos), filename=nombre), carpeta)
+    conn.execute("""
+        INSERT INTO fotos_asistencia (asistencia_id, tecnico, ruta_foto, descripcion, fecha)
+        VALUES (?, ?, ?, ?, ?)
+    """, (cambio.get("ticket_id"), tecnico, ruta, cambio.get("descripcion") or "", ts))
+    return {"ok": True, "archivo": ruta}
+
+
+# ===========================
+#  Lote
+# ===========================
+# motivo de descarte de ingesta.guardar_lote() -> resultado del cambio gps
+_RESULTADO_GPS = {
+    None: {"ok": True},
+    "historicos": {"ok": True, "historico": True},      # guardado en el recorrido, no como posición actual
+    "repetidos": {"ok": True, "repetido": True},        # ya estaba guardado
+    "rango": {"ok": False, "error": "gps fuera de rango"},
+    "precision": {"ok": False, "error": "gps con precisión insuficiente"},
+}
+
+
+def _id_valido(c):
+    return isinstance(c, dict) and isinstance(c.get("id"), str) and c["id"] != ""
+
+
+def aplicar(conn, tecnico_id, cambios, movil=None, carpeta_fotos=None):
+    """
+    Aplica el changelog (sin commit). Devuelve ({id_cambio: resultado}, gps):
+    gps es el resultado de ingesta.guardar_lote() (o None), para
+    ingesta.confirmar() después del commit. Los cambios ya aplicados en un
+    envío anterior devuelven su resultado guardado. Un cambio mal formado
+    (no es un objeto o no trae id) se rechaza solo, con clave "#<posición>".
+    """
+    from ingesta import parsear_ts, guardar_lote
+    tecnico = (conn.execute("SELECT nombre FROM tecnicos WHERE id = ?", (tecnico_id,)).fetchone() or [None])[0]
+    ids = [c["id"] for c in cambios if _id_valido(c)]
+    previos = {}
+    for i in range(0, len(ids), 500):
+        parte = ids[i:i + 500]
+        previos.update(conn.execute(
+            f"SELECT cambio_id, resultado FROM sync_aplicados WHERE cambio_id IN ({', '.join('?' * len(parte))})",
+            parte).fetchall())
+
+    resultados, fixes, tablas, nuevos = {}, [], set(), []
+    limite = ahora()
+    for pos, c in enumerate(cambios):
+        if not _id_valido(c):
+            resultados[f"#{pos}"] = {"ok": False, "error": "cambio inválido: se esperaba un objeto con id"}
+            continue
+        cid = c["id"]
+        if cid in previos:
+            resultados[cid] = json.loads(previos[cid])
+            continue
+        try:
+            ts = min(parsear_ts(c.get("ts")) or limite, limite)   # relojes adelantados no ganan LWW
+        except ValueError:
+            resultados[cid] = {"ok": False, "error": "ts inválido"}
+            continue
+
+        tipo = c.get("tipo")
+        if tipo == "ticket":
+            res = _aplicar_ticket(conn, tecnico_id, c, ts)
+            tablas.add("asistencias")
+        elif tipo == "gps":
+            try:
+                t = datetime.strptime(ts, FMT).timestamp()
+                fixes.append((cid, (t, float(c["lat"]), float(c["lng"]),
+                                    c.get("acc"), c.get("bat"))))
+                res = None                     # se resuelve con el lote de fixes
+            except (KeyError, TypeError, ValueError):
+                res = {"ok": False, "error": "gps sin lat/lng"}
+        elif tipo == "foto" and carpeta_fotos:
+            res = _aplicar_foto(conn, tecnico_id, tecnico, c, ts, carpeta_fotos)
+            tablas.add("fotos_asistencia")
+        else:
+            res = {"ok": False, "error": f"tipo desconocido: {tipo}"}
+
+        resultados[cid] = res
+        previos[cid] = json.dumps(res)      # ids repetidos dentro del mismo lote
+        nuevos.append(cid)
+
+    gps = None
+    if fixes:
+        # Los fixes offline suelen ser anteriores al último ping en vivo: van al recorrido
+        fixes.sort(key=lambda f: f[1][0])
+        gps = guardar_lote(conn, tecnico_id, [f for _, f in fixes], movil, "sync", historicos=True)
+        for (cid, _), motivo in zip(fixes, gps.pop("motivos")):
+            resultados[cid] = dict(_RESULTADO_GPS[motivo])
+        tablas.update(("tecnico_pos", "tecnico_tracks", "tecnicos"))
+
+    conn.executemany("INSERT INTO sync_aplicados (cambio_id, tecnico_id, recibido, resultado) VALUES (?, ?, ?, ?)",
+                     [(cid, tecnico_id, limite, json.dumps(resultados[cid])) for cid in nuevos])
+    if tablas:
+        tocar(*tablas)
+    return resultados, gps
+
+
+def delta(conn, tecnico_id, cursor=None):
+    """Tickets del técnico que cambiaron desde `cursor` (todos los abiertos si no hay cursor)."""
+    if not cursor:
+        actual = conn.execute("SELECT IFNULL(MAX(seq), 0) FROM ticket_campos").fetchone()[0]
+        marcas = ", ".join("?" * len(analitica.ABIERTOS))
+        filas = conn.execute(f"""
+            SELECT * FROM asistencias WHERE tecnico_id = ? AND estado IN ({marcas}) ORDER BY id
+        """, [tecnico_id] + list(analitica.ABIERTOS)).fetchall()
+        return {"cursor": actual, "tickets": [dict(r) for r in filas], "quitados": [], "mas": False}
+
+    # Solo los tickets del técnico, o los que le sacaron (cambiaron de técnico
+    # y el historial dice que fueron suyos; un EXISTS por índice de ese ticket)
+    sql = """
+        SELECT tc.ticket_id, MAX(tc.seq) AS s, MAX(tc.campo = 'tecnico_id') AS reasignado
+          FROM ticket_campos tc
+          JOIN asistencias a ON a.id = tc.ticket_id
+         WHERE tc.seq > ?
+         GROUP BY tc.ticket_id
+        HAVING (MAX(a.tecnico_id) = ?
+                OR (reasignado AND EXISTS (
+                    SELECT 1 FROM ticket_events e
+                     WHERE e.ticket_id = tc.ticket_id
+                       AND json_extract(e.datos, '$.tecnico_id') = ?))) {extra}
+         ORDER BY s, tc.ticket_id
+    """
+    cambiados = conn.execute(sql.format(extra="") + " LIMIT ?",
+                             (cursor, tecnico_id, tecnico_id, LIMITE_DELTA + 1)).fetchall()
+    mas = len(cambiados) > LIMITE_DELTA
+    if mas and cambiados[LIMITE_DELTA][1] == cambiados[LIMITE_DELTA - 1][1]:
+        # El corte cae dentro de un seq compartido (datos de antes del seq por
+        # ticket): la página se extiende hasta cerrar ese seq
+        ultimo = cambiados[LIMITE_DELTA - 1][1]
+        cambiados = [r for r in cambiados if r[1] < ultimo] + conn.execute(
+            sql.format(extra="AND s = ?"), (cursor, tecnico_id, tecnico_id, ultimo)).fetchall()
+        mas = conn.execute(sql.format(extra="AND s > ?") + " LIMIT 1",
+                           (cursor, tecnico_id, tecnico_id, ultimo)).fetchone() is not None
+    else:
+        cambiados = cambiados[:LIMITE_DELTA]
+    if not cambiados:
+        return {"cursor": cursor, "tickets": [], "quitados": [], "mas": False}
+
+    ids = [r[0] for r in cambiados]
+    marcas = ", ".join("?" * len(ids))
+    filas = conn.execute(f"SELECT * FROM asistencias WHERE id IN ({marcas})", ids).fetchall()
+    tickets = [dict(r) for r in filas if r["tecnico_id"] == tecnico_id]
+    suyos = {t["id"] for t in tickets}
+    return {
+        "cursor": cambiados[-1][1],
+        "tickets": tickets,
+        # Suyos reasignados a otro técnico desde el cursor: el móvil los borra
+        "quitados": [r[0] for r in cambiados if r[2] and r[0] not in suyos],
+        "mas": mas,
+    }
@@ -0,0 +1,287 @@
+# sla.py
+"""
+Plazos de respuesta (SLA) de los tickets.
+
+- POLITICAS fija el plazo por (prioridad, tipo), con caída a (prioridad,
+  None) y a PLAZO_DEFECTO_MIN. El vencimiento se calcula una vez, al dar
+  de alta el ticket, y queda en asistencias.due_at; el índice
+  (estado, due_at) hace que "abiertos vencidos" sea un rango del índice
+  y no un recorrido de la tabla parseando fechas.
+- vencidos() es el feed de vencidos / por vencer para la agenda y el mapa.
+- El vigilante (iniciar()) es un thread con un heap de los próximos
+  vencimientos: duerme hasta el siguiente y al cumplirse registra un
+  evento 'vencido' (eventos.registrar) y toca "sla" (invalida el feed
+  cacheado). Carga de a VENTANA vencimientos; los tickets nuevos entran
+  con programar(). Los que vencieron con el vigilante apagado no generan
+  evento, pero aparecen igual en el feed.
+- Con varias instancias, solo dispara la que tiene el turno 'sla' (lease
+  en la tabla turnos, renovado cada TURNO_S / 3). Las demás esperan a que
+  venza. Además, cada (ticket, due_at) genera a lo sumo un 'vencido': se
+  comprueba en la misma transacción que lo escribe.
+"""
+import os
+import json
+import uuid
+import heapq
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import eventos
+from analitica import ABIERTOS
+from cache import espacio, tocar, version as version_datos
+
+log = logging.getLogger(__name__)
+
+FMT = "%Y-%m-%d %H:%M:%S"
+# (prioridad, tipo) -> minutos; tipo None = cualquier tipo
+POLITICAS = {
+    ("Alta", "Reparación"): 2 * 60,
+    ("Alta", None): 4 * 60,
+    ("Media", None): 24 * 60,
+    ("Baja", None): 72 * 60,
+}
+PLAZO_DEFECTO_MIN = 48 * 60
+AVISO_MIN = 60            # "por vencer": vence dentro de esta ventana
+VENTANA = 500             # vencimientos que el vigilante tiene en memoria
+RECARGA_S = 600           # relectura del heap aunque no haya vencimientos
+TTL_FEED = 60
+TURNO_S = 90              # lease del vigilante entre instancias
+ACTIVO = os.environ.get("SLA_VIGILANTE", "1") == "1"
+cache = espacio("sla", max_items=64, ttl=TTL_FEED)
+
+
+def plazo(prioridad, tipo=None):
+    """Minutos de plazo para la combinación (prioridad, tipo)."""
+    return POLITICAS.get((prioridad, tipo), POLITICAS.get((prioridad, None), PLAZO_DEFECTO_MIN))
+
+
+def vence(fecha, prioridad, tipo=None):
+    """due_at (texto FMT) para un ticket dado de alta en `fecha`; None si la fecha no se entiende."""
+    try:
+        alta = datetime.fromisoformat(str(fecha)[:19])
+    except (TypeError, ValueError):
+        return None
+    return (alta + timedelta(minutes=plazo(prioridad, tipo))).strftime(FMT)
+
+
+def recalcular(conn):
+    """Completa due_at de los tickets que no lo tienen (p. ej. cargados por fuera de la app)."""
+    filas = conn.execute("SELECT id, fecha, prioridad, tipo FROM asistencias WHERE due_at IS NULL").fetchall()
+    conn.executemany("UPDATE asistencias SET due_at = ? WHERE id = ?",
+                     [(vence(f, p, t), i) for i, f, p, t in filas])
+    return len(filas)
+
+
+# ===========================
+#  Feed
+# ===========================
+def vencidos(conn, ahora=None, limite=200):
+    """
+    Tickets abiertos vencidos o por vencer (AVISO_MIN), del más atrasado al
+    menos. Cacheado hasta que cambian los tickets o vence uno (toca "sla").
+    """
+    ahora = ahora or datetime.now().strftime(FMT)
+    hasta = (datetime.fromisoformat(ahora) + timedelta(minutes=AVISO_MIN)).strftime(FMT)
+    clave = ("sla_feed", ahora[:16], limite, version_datos("asistencias", "sla"))
+    hit = cache.get(clave)
+    if hit is not None:
+        return hit
+
+    marcas = ", ".join("?" * len(ABIERTOS))
+    filas = conn.execute(f"""
+        SELECT a.id, a.cliente, a.tipo, a.prioridad, a.estado, a.tecnico_id, t.nombre AS tecnico,
+               a.due_at, COALESCE(a.lat, c.lat) AS lat, COALESCE(a.lng, c.lng) AS lng
+          FROM asistencias a
+          LEFT JOIN clientes c ON c.id = a.cliente_id
+          LEFT JOIN tecnicos t ON t.id = a.tecnico_id
+         WHERE a.estado IN ({marcas}) AND a.due_at <= ?
+         ORDER BY a.due_at
+         LIMIT ?
+    """, list(ABIERTOS) + [hasta, limite]).fetchall()
+    t_ahora = datetime.fromisoformat(ahora)
+    res = []
+    for r in filas:
+        d = dict(r)
+        atraso = (t_ahora - datetime.fromisoformat(d["due_at"])).total_seconds() / 60.0
+        d["vencido"] = atraso >= 0
+        d["atraso_min"] = round(atraso, 1)
+        res.append(d)
+    datos = {"ahora": ahora, "vencidos": sum(d["vencido"] for d in res),
+             "por_vencer": sum(not d["vencido"] for d in res), "tickets": res}
+    cache.set(clave, datos, TTL_FEED)
+    return datos
+
+
+# ===========================
+#  Vigilante
+# ===========================
+_cond = threading.Condition()
+_heap = []                # (epoch, tid, due_at)
+_en_heap = {}             # tid -> due_at
+_estado = {"corriendo": False, "db_path": None, "lleno": False, "disparados": 0, "ultimo": None,
+           "instancia": uuid.uuid4().hex[:8], "con_turno": False}
+
+
+def _epoch(ts):
+    return datetime.fromisoformat(ts).timestamp()
+
+
+def _cargar(conn):
+    """Llena el heap con los próximos VENTANA vencimientos."""
+    marcas = ", ".join("?" * len(ABIERTOS))
+    filas = conn.execute(f"""
+        SELECT id, due_at FROM asistencias
+         WHERE estado IN ({marcas}) AND due_at > ?
+         ORDER BY due_at LIMIT ?
+    """, list(ABIERTOS) + [datetime.now().strftime(FMT), VENTANA]).fetchall()
+    with _cond:
+        _heap.clear()
+        _en_heap.clear()
+        for tid, due in filas:
+            _heap.append((_epoch(due), tid, due))
+            _en_heap[tid] = due
+        heapq.heapify(_heap)
+        _estado["lleno"] = len(filas) == VENTANA
+
+
+def programar(tid, due_at):
+    """Agrega un vencimiento nuevo al vigilante (si corre) y lo despierta si es el próximo."""
+    if not due_at or not _estado["corriendo"]:
+        return
+    with _cond:
+        if _en_heap.get(tid) == due_at:
+            return
+        _en_heap[tid] = due_at
+        heapq.heappush(_heap, (_epoch(due_at), tid, due_at))
+        if _heap[0][1] == tid:
+            _cond.notify()
+
+
+def _transaccion(conn, fn):
+    """Corre fn(conn) dentro de BEGIN IMMEDIATE (lock de escritura entre instancias)."""
+    nivel = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            res = fn(conn)
+            conn.execute("COMMIT")
+            return res
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.isolation_level = nivel
+
+
+def _turno_vigente(conn):
+    return conn.execute("SELECT 1 FROM turnos WHERE tarea = 'sla' AND instancia = ? AND vence > ?",
+                        (_estado["instancia"], datetime.now().strftime(FMT))).fetchone() is not None
+
+
+def _tomar_turno(conn):
+    """Toma o renueva el turno 'sla' si está libre, vencido o ya es nuestro."""
+    def tomar(c):
+        ahora = datetime.now()
+        vence = (ahora + timedelta(seconds=TURNO_S)).strftime(FMT)
+        c.execute("INSERT OR IGNORE INTO turnos (tarea, instancia, vence) VALUES ('sla', ?, ?)",
+                  (_estado["instancia"], vence))
+        c.execute("""
+            UPDATE turnos SET instancia = ?, vence = ?
+             WHERE tarea = 'sla' AND (instancia = ? OR vence <= ?)
+        """, (_estado["instancia"], vence, _estado["instancia"], ahora.strftime(FMT)))
+        return _turno_vigente(c)
+    return _transaccion(conn, tomar)
+
+
+def _disparar(conn, lote):
+    """Registra 'vencido' de los que siguen abiertos con ese mismo due_at y no lo tienen ya."""
+    ids = [tid for _, tid, _ in lote]
+    marcas = ", ".join("?" * len(ABIERTOS))
+
+    def escribir(c):
+        if not _turno_vigente(c):
+            return 0                   # otra instancia tomó el turno mientras dormíamos
+        vigentes = {(r[0], r[1]) for r in c.execute(f"""
+            SELECT id, due_at FROM asistencias
+             WHERE id IN ({', '.join('?' * len(ids))}) AND estado IN ({marcas})
+        """, ids + list(ABIERTOS))}
+        ya = {(r[0], json.loads(r[1]).get("due_at")) for r in c.execute(f"""
+            SELECT ticket_id, datos FROM ticket_events
+             WHERE ticket_id IN ({', '.join('?' * len(ids))}) AND tipo = 'vencido'
+        """, ids)}
+        tids = [tid for _, tid, due in lote if (tid, due) in vigentes and (tid, due) not in ya]
+        eventos.registrar(c, tids, ["vencido"], origen="sla")
+        return len(tids)
+
+    n = _transaccion(conn, escribir)
+    if n:
+        tocar("sla")
+        _estado["disparados"] += n
+        _estado["ultimo"] = datetime.now().strftime(FMT)
+    return n
+
+
+def _vigilar():
+    recarga = 0.0
+    while True:
+        try:
+            conn = sqlite3.connect(_estado["db_path"], timeout=30)
+            try:
+                con_turno = _tomar_turno(conn)
+                if con_turno and (not _estado["con_turno"] or time.time() >= recarga):
+                    _cargar(conn)      # recién tomado el turno, o toca releer
+                    recarga = time.time() + RECARGA_S
+            finally:
+                conn.close()
+            _estado["con_turno"] = con_turno
+
+            lote = []
+            with _cond:
+                # Se despierta a tiempo de renovar el turno; sin turno no se
+                # dispara, solo se vuelve a intentar tomarlo
+                limite = time.time() + TURNO_S / 3
+                if con_turno:
+                    limite = min(limite, recarga, _heap[0][0] if _heap else limite)
+                espera = limite - time.time()
+                if espera > 0:
+                    _cond.wait(espera)
+                ahora = time.time()
+                while con_turno and _heap and _heap[0][0] <= ahora:
+                    item = heapq.heappop(_heap)
+                    if _en_heap.get(item[1]) == item[2]:
+                        del _en_heap[item[1]]
+                        lote.append(item)
+                if lote and not _heap and _estado["lleno"]:
+                    recarga = 0.0              # ventana agotada: traer la siguiente
+            if lote:
+                conn = sqlite3.connect(_estado["db_path"], timeout=30)
+                try:
+                    for i in range(0, len(lote), 400):
+                        _disparar(conn, lote[i:i + 400])
+                finally:
+                    conn.close()
+        except Exception:
+            log.exception("Vigilante de SLA falló")
+            time.sleep(5)
+
+
+def iniciar(db_path):
+    """Arranca el vigilante una vez por proceso (no-op si SLA_VIGILANTE=0)."""
+    with _cond:
+        if _estado["corriendo"] or not ACTIVO:
+            return
+        _estado.update(corriendo=True, db_path=db_path)
+    threading.Thread(target=_vigilar, daemon=True, name="sla").start()
+
+
+def estado():
+    with _cond:
+        proximo = _heap[0][2] if _heap else None
+        en_memoria = len(_en_heap)
+    return {"corriendo": _estado["corriendo"], "con_turno": _estado["con_turno"],
+            "instancia": _estado["instancia"], "proximo": proximo, "en_memoria": en_memoria,
+            "disparados": _estado["disparados"], "ultimo": _estado["ultimo"]}
@@ -0,0 +1,316 @@
+# snapshots.py
+"""
+Snapshots + cambios incrementales de la BD de /tmp, para instancias serverless
+sin estado.
+
+- Snapshot: copia consistente con la API de backup de SQLite, comprimida (gzip).
+- Cambios: estilo "WAL shipping" a nivel de páginas. Se guardan solo las
+  páginas que difieren de lo ya publicado (más el tamaño final del archivo).
+- Restore: se toma el snapshot más nuevo (leído con mmap y descomprimido en
+  streaming) y se aplican sus cambios en orden.
+
+Cada instancia publica su propia cadena de cambios sobre el snapshot base;
+al restaurar se usa la cadena con el cambio más reciente (último que escribe
+gana). No mezcla escrituras concurrentes de varias instancias.
+
+El almacenamiento es enchufable: cualquier objeto con guardar/listar/ruta.
+AlmacenDirectorio es el backend local (sirve también para pruebas).
+"""
+import os
+import gzip
+import mmap
+import time
+import uuid
+import zlib
+import struct
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+
+log = logging.getLogger(__name__)
+
+_CHUNK = 1 << 20  # 1 MiB
+
+
+# ------------------ Almacenamiento ------------------
+class AlmacenDirectorio:
+    """Backend local: un directorio (en producción sería un bucket)."""
+
+    def __init__(self, directorio):
+        self.directorio = directorio
+        os.makedirs(directorio, exist_ok=True)
+
+    def guardar(self, nombre, origen):
+        """origen: bytes o ruta a un archivo local. Escritura atómica."""
+        destino = os.path.join(self.directorio, nombre)
+        tmp = destino + ".part"
+        if isinstance(origen, (bytes, bytearray)):
+            with open(tmp, "wb") as f:
+                f.write(origen)
+        else:
+            with open(origen, "rb") as src, open(tmp, "wb") as f:
+                while True:
+                    buf = src.read(_CHUNK)
+                    if not buf:
+                        break
+                    f.write(buf)
+        os.replace(tmp, destino)
+
+    def listar(self):
+        return sorted(n for n in os.listdir(self.directorio) if not n.endswith(".part"))
+
+    def ruta(self, nombre):
+        """Ruta local del objeto (un backend remoto lo descargaría a /tmp)."""
+        return os.path.join(self.directorio, nombre)
+
+
+# ------------------ Helpers ------------------
+def _ahora_ms():
+    return int(time.time() * 1000)
+
+def _hash_paginas(path, page_size):
+    hashes = []
+    with open(path, "rb") as f:
+        while True:
+            page = f.read(page_size)
+            if not page:
+                break
+            hashes.append(hashlib.blake2b(page, digest_size=16).digest())
+    return hashes
+
+def _page_size(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA page_size").fetchone()[0]
+    finally:
+        conn.close()
+
+def _copia_consistente(db_path, destino):
+    """Copia de la BD con la API de backup online (no bloquea a los escritores)."""
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(destino)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+# ------------------ Replicador ------------------
+class Replicador:
+    """
+    Publica snapshots y cambios de db_path en un almacén, y restaura desde él.
+
+    Nombres de objetos (ordenables como texto):
+      snap-<ts>.db.gz
+      cambios-<ts_snap>-<ts>-<instancia>.bin.gz
+
+    Tras un restore la instancia no continúa una cadena ajena: su primera
+    publicación es un snapshot nuevo.
+    """
+
+    def __init__(self, db_path, almacen, instancia=None):
+        self.db_path = db_path
+        self.almacen = almacen
+        self.instancia = instancia or uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._en_curso = threading.Lock()   # una sola publicación "tal vez" a la vez
+        self._base = None        # ts del snapshot sobre el que publicamos
+        self._hashes = None      # hashes de páginas ya publicadas
+        self._ultimo_cambio = 0.0
+        self._ultimo_snap = 0.0
+
+    # ---------- Publicación ----------
+    def snapshot(self):
+        """Toma y sube un snapshot completo. Devuelve su nombre."""
+        with self._lock:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                copia = os.path.join(tmpdir, "copia.db")
+                _copia_consistente(self.db_path, copia)
+                comprimido = os.path.join(tmpdir, "copia.db.gz")
+                with open(copia, "rb") as src, gzip.open(comprimido, "wb", compresslevel=6) as dst:
+                    while True:
+                        buf = src.read(_CHUNK)
+                        if not buf:
+                            break
+                        dst.write(buf)
+                ts = _ahora_ms()
+                nombre = f"snap-{ts:015d}.db.gz"
+                self.almacen.guardar(nombre, comprimido)
+                self._base = ts
+                self._hashes = _hash_paginas(copia, _page_size(copia))
+            self._ultimo_snap = self._ultimo_cambio = time.monotonic()
+            return nombre
+
+    def publicar_cambios(self):
+        """Sube las páginas modificadas desde la última publicación (o None si no hay)."""
+        if self._base is None:
+            return self.snapshot()
+        with self._lock:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                copia = os.path.join(tmpdir, "copia.db")
+                _copia_consistente(self.db_path, copia)
+                page_size = _page_size(copia)
+                previos = self._hashes or []
+                nuevos, paginas = [], []
+                with open(copia, "rb") as f:
+                    n = 0
+                    while True:
+                        page = f.read(page_size)
+                        if not page:
+                            break
+                        h = hashlib.blake2b(page, digest_size=16).digest()
+                        nuevos.append(h)
+                        if n >= len(previos) or previos[n] != h:
+                            paginas.append((n, page))
+                        n += 1
+                self._ultimo_cambio = time.monotonic()
+                if not paginas and len(nuevos) == len(previos):
+                    return None
+
+                # Formato: page_size, total_paginas, cantidad, y luego (nro, bytes)*
+                partes = [struct.pack(">III", page_size, len(nuevos), len(paginas))]
+                for nro, page in paginas:
+                    partes.append(struct.pack(">I", nro))
+                    partes.append(page)
+                nombre = f"cambios-{self._base:015d}-{_ahora_ms():015d}-{self.instancia}.bin.gz"
+                self.almacen.guardar(nombre, gzip.compress(b"".join(partes), compresslevel=6))
+                self._hashes = nuevos
+                return nombre
+
+    def vencido(self, cada_cambios=30, cada_snapshot=3600):
+        """True si toca publicar algo (chequeo barato, sin I/O)."""
+        ahora = time.monotonic()
+        return (self._base is None or ahora - self._ultimo_snap >= cada_snapshot
+                or ahora - self._ultimo_cambio >= cada_cambios)
+
+    def tal_vez_publicar(self, cada_cambios=30, cada_snapshot=3600):
+        """
+        Para llamar seguido: publica solo si venció el intervalo. Si otra
+        publicación está en curso no espera: esa ya va a incluir estos cambios.
+        """
+        if not self._en_curso.acquire(blocking=False):
+            return None
+        try:
+            ahora = time.monotonic()
+            if self._base is None or ahora - self._ultimo_snap >= cada_snapshot:
+                return self.snapshot()
+            if ahora - self._ultimo_cambio >= cada_cambios:
+                return self.publicar_cambios()
+            return None
+        finally:
+            self._en_curso.release()
+
+    # ---------- Restore ----------
+    def restaurar(self):
+        """
+        Reconstruye db_path desde el snapshot más nuevo + su cadena de cambios.
+        Devuelve True si restauró algo.
+        """
+        nombres = self.almacen.listar()
+        snaps = [n for n in nombres if n.startswith("snap-")]
+        if not snaps:
+            return False
+        snap = snaps[-1]
+        base = int(snap[len("snap-"):].split(".")[0])
+
+        # Cadena ganadora: la instancia con el cambio más reciente sobre esta base
+        cambios = [n for n in nombres if n.startswith(f"cambios-{base:015d}-")]
+        cadena = []
+        if cambios:
+            inst = cambios[-1].split("-")[3].split(".")[0]
+            cadena = [n for n in cambios if n.split("-")[3].split(".")[0] == inst]
+
+        with self._lock:
+            tmp = self.db_path + ".restore"
+            with open(self.almacen.ruta(snap), "rb") as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                    open(tmp, "wb") as out:
+                dec = zlib.decompressobj(wbits=31)  # gzip
+                vista = memoryview(mm)
+                try:
+                    for i in range(0, len(vista), _CHUNK):
+                        out.write(dec.decompress(vista[i:i + _CHUNK]))
+                    out.write(dec.flush())
+                finally:
+                    vista.release()
+
+            for nombre in cadena:
+                with open(self.almacen.ruta(nombre), "rb") as f:
+                    data = gzip.decompress(f.read())
+                page_size, total, cantidad = struct.unpack_from(">III", data, 0)
+                pos = 12
+                with open(tmp, "r+b") as out:
+                    for _ in range(cantidad):
+                        (nro,) = struct.unpack_from(">I", data, pos)
+                        pos += 4
+                        out.seek(nro * page_size)
+                        out.write(data[pos:pos + page_size])
+                        pos += page_size
+                    out.truncate(total * page_size)
+
+            os.replace(tmp, self.db_path)
+            self._base = None  # la próxima publicación abre una cadena propia
+        log.info("BD restaurada desde %s + %d cambios", snap, len(cadena))
+        return True
+
+
+if __name__ == "__main__":
+    import sys
+    import random
+    import shutil
+
+    if "--bench" not in sys.argv:
+        print("Uso: python snapshots.py --bench [MB ...]")
+        sys.exit(1)
+    tamanios = [int(a) for a in sys.argv[1:] if a != "--bench"] or [1, 10, 50, 200]
+
+    print(f"{'BD MB':>6} {'snap MB':>8} {'snapshot s':>10} {'cambios s':>10} {'restore s':>10} {'MB/s':>7}")
+    for mb in tamanios:
+        tmpdir = tempfile.mkdtemp(prefix="snapbench-")
+        try:
+            db = os.path.join(tmpdir, "bench.db")
+            conn = sqlite3.connect(db)
+            conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, dato TEXT)")
+            filas = mb * 1024 * 1024 // 560
+            conn.executemany("INSERT INTO t (dato) VALUES (?)",
+                             ((os.urandom(256).hex(),) for _ in range(filas)))   # 512 bytes poco comprimibles
+            conn.commit()
+            rep = Replicador(db, AlmacenDirectorio(os.path.join(tmpdir, "almacen")))
+
+            t0 = time.perf_counter()
+            snap = rep.snapshot()
+            t_snap = time.perf_counter() - t0
+
+            # Tres tandas de cambios (~1% de las filas cada una)
+            t0 = time.perf_counter()
+            for _ in range(3):
+                conn.executemany("UPDATE t SET dato = ? WHERE id = ?",
+                                 ((os.urandom(256).hex(), random.randint(1, filas)) for _ in range(max(1, filas // 100))))
+                conn.commit()
+                rep.publicar_cambios()
+            t_cambios = time.perf_counter() - t0
+            # La copia de backup no es idéntica byte a byte al original: se compara el contenido
+            def contenido(c):
+                h = hashlib.blake2b()
+                for fila in c.execute("SELECT id, dato FROM t ORDER BY id"):
+                    h.update(repr(fila).encode())
+                return h.digest()
+            esperado = contenido(conn)
+            conn.close()
+
+            os.remove(db)
+            t0 = time.perf_counter()
+            Replicador(db, rep.almacen).restaurar()
+            t_rest = time.perf_counter() - t0
+            conn = sqlite3.connect(db)
+            assert contenido(conn) == esperado, "restore distinto del original"
+            conn.close()
+
+            tam = os.path.getsize(db) / 1e6
+            print(f"{tam:6.1f} {os.path.getsize(rep.almacen.ruta(snap)) / 1e6:8.1f} {t_snap:10.3f} "
+                  f"{t_cambios:10.3f} {t_rest:10.3f} {tam / t_rest:7.0f}")
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
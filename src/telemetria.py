@@ -0,0 +1,145 @@
+# telemetria.py
+"""
+Formatos de lote para la telemetría de los dispositivos (tecnico_tracks).
+
+Coordenadas en punto fijo (ESCALA = 1e-5 grados, ~1,1 m) y codificadas
+como delta respecto del fix anterior.
+
+Binario (application/octet-stream): uno o más bloques
+    cabecera  "<4sHIii"  b"SPT1", n, ts0 (epoch s), lat0, lng0
+    n fixes   "<HhhHB"   dt (s), dlat, dlng, accuracy (m, 0xFFFF = ?), batería (%, 255 = ?)
+9 bytes por fix. Si un delta no entra en int16 (salto de >~36 km) el
+dispositivo abre un bloque nuevo.
+
+JSON columnar (application/json):
+    {"movil": "...", "ts0": epoch, "lat0": int, "lng0": int,
+     "dt": [...], "dlat": [...], "dlng": [...], "acc": [...], "bat": [...]}
+acc/bat son opcionales (null = desconocido).
+
+decodificar_*() devuelven listas de (ts_epoch, lat, lng, accuracy, battery).
+"""
+import struct
+from itertools import accumulate
+
+ESCALA = 100000
+MAGIA = b"SPT1"
+CABECERA = struct.Struct("<4sHIii")
+FIX = struct.Struct("<HhhHB")
+SIN_ACC = 0xFFFF
+SIN_BAT = 255
+
+
+class FormatoInvalido(ValueError):
+    pass
+
+
+def decodificar_binario(datos):
+    fixes = []
+    pos, total = 0, len(datos)
+    while pos < total:
+        if total - pos < CABECERA.size:
+            raise FormatoInvalido("cabecera incompleta")
+        magia, n, ts, lat, lng = CABECERA.unpack_from(datos, pos)
+        if magia != MAGIA:
+            raise FormatoInvalido("bloque sin SPT1")
+        pos += CABECERA.size
+        fin = pos + n * FIX.size
+        if fin > total:
+            raise FormatoInvalido("bloque truncado")
+        for dt, dlat, dlng, acc, bat in FIX.iter_unpack(datos[pos:fin]):
+            ts += dt
+            lat += dlat
+            lng += dlng
+            fixes.append((ts, lat / ESCALA, lng / ESCALA,
+                          None if acc == SIN_ACC else float(acc),
+                          None if bat == SIN_BAT else float(bat)))
+        pos = fin
+    return fixes
+
+
+def decodificar_columnar(doc):
+    try:
+        dt, dlat, dlng = doc["dt"], doc["dlat"], doc["dlng"]
+        n = len(dt)
+        if len(dlat) != n or len(dlng) != n:
+            raise FormatoInvalido("columnas de distinto largo")
+        acc = doc.get("acc") or [None] * n
+        bat = doc.get("bat") or [None] * n
+        if len(acc) != n or len(bat) != n:
+            raise FormatoInvalido("columnas de distinto largo")
+        ts = accumulate(dt, initial=int(doc["ts0"]))
+        lat = accumulate(dlat, initial=int(doc["lat0"]))
+        lng = accumulate(dlng, initial=int(doc["lng0"]))
+        next(ts); next(lat); next(lng)
+        return [(t, la / ESCALA, ln / ESCALA,
+                 None if a is None else float(a), None if b is None else float(b))
+                for t, la, ln, a, b in zip(ts, lat, lng, acc, bat)]
+    except (KeyError, TypeError, ValueError) as e:
+        raise FormatoInvalido(f"JSON columnar inválido: {e}")
+
+
+def codificar_binario(fixes):
+    """Inverso de decodificar_binario (para clientes de prueba y el benchmark)."""
+    out, bloque, base, prev = [], [], None, None
+
+    def cerrar():
+        if bloque:
+            out.append(CABECERA.pack(MAGIA, len(bloque), *base) + b"".join(bloque))
+
+    for ts, lat, lng, acc, bat in fixes:
+        q = (int(ts), round(lat * ESCALA), round(lng * ESCALA))
+        if prev is not None:
+            d = (q[0] - prev[0], q[1] - prev[1], q[2] - prev[2])
+        if prev is None or len(bloque) == 0xFFFF or not (
+                0 <= d[0] <= 0xFFFF and -32768 <= d[1] <= 32767 and -32768 <= d[2] <= 32767):
+            cerrar()
+            bloque, base, d = [], q, (0, 0, 0)
+        bloque.append(FIX.pack(d[0], d[1], d[2],
+                               SIN_ACC if acc is None else min(int(acc), SIN_ACC - 1),
+                               SIN_BAT if bat is None else int(bat)))
+        prev = q
+    cerrar()
+    return b"".join(out)
+
+
+if __name__ == "__main__":
+    import sys
+    import json
+    import time
+    import random
+    from urllib.parse import urlencode, parse_qs
+
+    if "--bench" not in sys.argv:
+        print("Uso: python telemetria.py --bench [n_fixes]")
+        sys.exit(1)
+    args = [a for a in sys.argv[1:] if a != "--bench"]
+    n = int(args[0]) if args else 200_000
+    fixes, t, la, ln = [], 1.76e9, -25.3, -57.6
+    for _ in range(n):
+        t += 10
+        la += random.uniform(-2e-4, 2e-4)
+        ln += random.uniform(-2e-4, 2e-4)
+        fixes.append((t, la, ln, random.randint(3, 30), random.randint(20, 100)))
+
+    binario = codificar_binario(fixes)
+    q = [(int(f[0]), round(f[1] * ESCALA), round(f[2] * ESCALA)) for f in fixes]
+    columnar = json.dumps({
+        "ts0": q[0][0], "lat0": q[0][1], "lng0": q[0][2],
+        "dt": [0] + [b[0] - a[0] for a, b in zip(q, q[1:])],
+        "dlat": [0] + [b[1] - a[1] for a, b in zip(q, q[1:])],
+        "dlng": [0] + [b[2] - a[2] for a, b in zip(q, q[1:])],
+        "acc": [f[3] for f in fixes], "bat": [f[4] for f in fixes],
+    })
+    # /gps: un request form-encoded por fix
+    forms = [urlencode({"lat": f[1], "lng": f[2], "ts": int(f[0]), "token": "x" * 32}) for f in fixes]
+
+    def medir(nombre, bytes_, fn):
+        t0 = time.perf_counter()
+        fn()
+        s = time.perf_counter() - t0
+        print(f"{nombre:>9}: {bytes_ / n:6.1f} B/fix  {n / s:12,.0f} fixes/s (parseo)")
+
+    medir("binario", len(binario), lambda: decodificar_binario(binario))
+    medir("columnar", len(columnar), lambda: decodificar_columnar(json.loads(columnar)))
+    medir("form /gps", sum(len(f) for f in forms),
+          lambda: [(float(d["lat"][0]), float(d["lng"][0])) for d in map(parse_qs, forms)])